@@ -8,7 +8,10 @@ import torch
 from scripts import(
     BiasTest, Writer, utils
 )
+from scripts.dataloaders.feature_store import FEATURE_STORE
 from scripts.models import TYPE2WRAPPER
+from scripts.experiments import add_stats_args, run_experiments, save_encodings
+from scripts.weat.backend import set_num_threads
 
 def load_eval_params():
     parser = ArgumentParser(config_file_parser_class=YAMLConfigFileParser)
@@ -19,12 +22,20 @@ def load_eval_params():
     parser.add_argument('--val_workers', type=int, default=2)
     parser.add_argument('--batch_size', type=int, default=64)
 
-    parser.add_argument('--num_samples', type=int, default=100000, help='num/samples for p-val permutation test')
+    parser.add_argument('--no_dedup_encodings', dest='dedup_encodings', action='store_false', help='encode each set separately instead of each unique (caption, image) pair once')
+    add_stats_args(parser)
+    parser.add_argument('--export_encodings', action='store_true', help='also save each test\'s encodings to <out_dir>/encodings/<test>.npz for scripts.stats')
     parser.add_argument('--test2features_path', type=str, required=True, help='path to JSON file of features, stored by model and test')
     parser.add_argument('--tests', nargs='+', required=True, help='paths to tests to run')
     parser.add_argument('--model_type', type=str, required=True, choices=['lxmert', 'visualbert', 'vilbert', 'vlbert'])
     parser.add_argument('--model_archive', type=str, required=True, help='path to saved model to load')
     parser.add_argument('--max_seq_length', type=int, default=36)
+    parser.add_argument('--feature_store_mb', type=float, default=None, help='memory budget for the image features kept loaded across tests; least recently used feature files are dropped beyond it (default: keep all)')
+    parser.add_argument('--embedding_cache_dir', type=str, default=None, help='if set, cache encodings here and only encode new (caption, image) pairs on reruns')
+    parser.add_argument('--fused_forward', action='store_true', help='encode the full, vision-masked and text-masked variants of a batch in one forward')
+    parser.add_argument('--max_forward_rows', type=int, default=None, help='with --fused_forward, most rows per forward; halved automatically on running out of GPU memory')
+    parser.add_argument('--layers', type=int, nargs='+', default=None, help='hidden layers to encode in the same forward, e.g. -1 -3 -5 (visualbert and lxmert only; lxmert only encodes its cross-modality layers, -1 to -5 for the base model); the results for layer l go to <save_dir>/layer<l>')
+    parser.add_argument('--output_attentions', action='store_true', help='also compute attention probabilities in each forward (collected per batch and variant in the attentions of the model wrapper); off by default since no experiment uses them')
     
     # add model-specific arguments
     model_type = parser.parse_known_args()[0].model_type
@@ -44,13 +55,23 @@ def main():
     # load params and set up logging
     params = load_eval_params()
     log, save_dir, _ = utils.setup_logging_results(params)
+    set_num_threads(params.backend, params.stats_threads)
+    if params.feature_store_mb is not None:
+        FEATURE_STORE.max_bytes = int(params.feature_store_mb * 2**20)
 
     # load model wrapper
     model_wrapper = TYPE2WRAPPER[params.model_type](params)
     test2features = json.load(open(params.test2features_path))
 
-    # load and run tests
-    writer = Writer(save_dir)
+    # load and run tests; a layer sweep writes the results of each layer to its own dir
+    layer_dirs = {-1 : save_dir} if model_wrapper.layers == [-1] else \
+                 {layer : path.join(save_dir, f'layer{layer}') for layer in model_wrapper.layers}
+    writers = {}
+    for layer, layer_dir in layer_dirs.items():
+        makedirs(layer_dir, exist_ok=True)
+        writers[layer] = Writer(layer_dir)
+        if params.export_encodings:
+            makedirs(path.join(layer_dir, 'encodings'), exist_ok=True)
     for bias_test_fp in params.tests:
         log.info(f'Loading {bias_test_fp}')
         with open(bias_test_fp, 'r') as f:
@@ -58,37 +79,18 @@ def main():
 
         test = BiasTest(params, test_data, test2features.get(params.model_type))
         #log.info(f'Total number of unique images: {test.get_num_unique_images()}')
+        log.info(f'Image feature store: {FEATURE_STORE.stats()}')
         encodings = test.encode_data(model_wrapper)
-        
-        log.info('Running experiment 1: union across attribute A_{X} and A_{Y}')
-        results = test.run_weat_union(encodings, params.num_samples)
-        for test_type, (esize, pval) in results.items():
-            writer.add_results_exp1(test.test_name, test_type, esize, pval)
 
-        log.info('\n\n')
-        log.info('Running experiment 2: corresponding attributes s(X, A_{X}, B_{X}) and s(Y, A_{Y}, B_{Y})')
-        results = test.run_weat_specific(encodings, params.num_samples)
-        for test_type, (esize, pval) in results.items():
-            writer.add_results_exp2(test.test_name, test_type, esize, pval)
-
-        log.info('\n\n')
-        log.info('Running experiment 3: intra-target across target-specific attributes')
-        results = test.run_weat_intra(encodings, params.num_samples)
-        for test_type, (esize_x, pval_x, esize_y, pval_y) in results.items():
-            writer.add_results_exp3(test.test_name, test_type, esize_x, pval_x, esize_y, pval_y)
-        
-        if 'sentence' in test.test_types or 'sent' in test.test_types: # TODO all sentence or all sent
-            log.info('Running experiment 4a: masked language and 4b: masked vision')
-            results = test.run_weat_mask(encodings, params.num_samples)
-            mask_t_esize, mask_t_pval, test_type = results['mask_t']
-            writer.add_results_exp4_mask_t(test.test_name, test_type, mask_t_esize, mask_t_pval)
-            
-            if 'mask_v' in results:
-                mask_v_esize,mask_v_pval,test_type = results['mask_v']
-                writer.add_results_exp4_mask_v(test.test_name, test_type, mask_v_esize, mask_v_pval)
-        
-        writer.flush()
-    writer.close()
+        for layer, layer_encodings in encodings.items():
+            if len(encodings) > 1:
+                log.info(f'Layer {layer}')
+            if params.export_encodings:
+                save_encodings(path.join(layer_dirs[layer], 'encodings', f'{test.test_name}.npz'), test, layer_encodings)
+            run_experiments(test, layer_encodings, params, writers[layer])
+            writers[layer].flush()
+    for writer in writers.values():
+        writer.close()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,8 +1,19 @@
-from .bias_test import BiasTest
-from . import utils
-from .weat.weat_images_union import run_test as weat_union
-from .weat.weat_images_targ_specific import run_test as weat_specific
-from .weat.weat_images_intra_targ import run_test as weat_intra
-from .weat.general_vals import get_general_vals # TODO rename
-from .writer import Writer
+from importlib import import_module
 
+# imported on first use, so that scripts.stats starts without torch or the model code
+_LAZY = {
+    'BiasTest' : ('.bias_test', 'BiasTest'),
+    'utils' : ('.utils', None),
+    'weat_union' : ('.weat.weat_images_union', 'run_test'),
+    'weat_specific' : ('.weat.weat_images_targ_specific', 'run_test'),
+    'weat_intra' : ('.weat.weat_images_intra_targ', 'run_test'),
+    'get_general_vals' : ('.weat.general_vals', 'get_general_vals'), # TODO rename
+    'Writer' : ('.writer', 'Writer')
+}
+
+def __getattr__(name):
+    if name not in _LAZY:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    module_name, attr = _LAZY[name]
+    module = import_module(module_name, __name__)
+    return module if attr is None else getattr(module, attr)
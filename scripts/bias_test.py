@@ -1,17 +1,51 @@
 from copy import deepcopy
 from attrdict import AttrDict
-from typing import Dict
+from typing import Dict, List
 import torch
 from torch import nn
-from warnings import warn
 
-from .weat.weat_images_union import run_test as weat_union
-from .weat.weat_images_targ_specific import run_test as weat_specific
-from .weat.weat_images_intra_targ import run_test as weat_intra
-from .weat.general_vals import get_general_vals
+from .experiments import WEATExperiments
 from .dataloaders.bias_dataloader import BiasDataLoader
 
-class BiasTest:
+def plan_encodings(sets: Dict):
+    ''' Collect the unique (caption, image) pairs across sets of (captions, images),
+        each as in the test files: captions maps ids to text and images maps
+        image paths to the ids of their captions.
+    Returns (captions, images) of the unique pairs, in the same format, and for each
+    set the index of each of its pairs among the encodings of the unique pairs.
+    '''
+    caption_ids = {} # caption text -> id in the merged captions
+    images = {}
+    for captions, set_images in sets.values():
+        for image_fp, corresponding_caps in set_images.items():
+            image_caps = images.setdefault(image_fp, [])
+            for c in corresponding_caps:
+                cid = caption_ids.setdefault(captions[str(c)], len(caption_ids))
+                if cid not in image_caps:
+                    image_caps.append(cid)
+
+    # datasets encode pairs image by image, in the order of images
+    index = {}
+    for image_fp, image_caps in images.items():
+        for cid in image_caps:
+            index[(image_fp, cid)] = len(index)
+    plan = {}
+    for name, (captions, set_images) in sets.items():
+        plan[name] = [index[(image_fp, caption_ids[captions[str(c)]])]
+                      for image_fp, corresponding_caps in set_images.items()
+                      for c in corresponding_caps]
+    captions = {str(cid) : caption for caption, cid in caption_ids.items()}
+    return captions, images, plan
+
+
+def scatter_encodings(enc: Dict, idx: List[int]):
+    ''' Pick the encodings of one set out of the encodings of the unique pairs.
+    '''
+    return {key : {i : encs[j] for i, j in enumerate(idx) if j in encs}
+            for key, encs in enc.items()}
+
+
+class BiasTest(WEATExperiments):
     def __init__(
         self,
         params: AttrDict,
@@ -31,6 +65,8 @@ class BiasTest:
             self.test_types = list(
                 set(self.test_types).difference(skip_test_types)
             )
+
+        self.init_weat_options(params)
         
         if preextracted_features:
             image_features_path_or_dir = preextracted_features[self.dataset_name][self.test_name]
@@ -46,36 +82,8 @@ class BiasTest:
         self.category_A = test_data['attr1']['category']
         self.category_B = test_data['attr2']['category']
 
-        self.dataloader_targ_X = BiasDataLoader(
-            params=params,
-            captions=test_data['targ1']['captions'],
-            images=test_data['targ1']['images'],
-            dataset_dir=test_data['dataset_dir'],
-            image_features_path_or_dir=image_features_path_or_dir,
-            contextual_words=test_data['contextual_words'],
-            pad_token=pad_token,
-            mask_token=mask_token,
-            batch_size=params.batch_size,
-            num_gpus=params.num_gpus,
-            **kwargs
-            )
-        self.dataloader_targ_Y = BiasDataLoader(
-            params=params,
-            captions=test_data['targ2']['captions'],
-            images=test_data['targ2']['images'],
-            dataset_dir=test_data['dataset_dir'],
-            image_features_path_or_dir=image_features_path_or_dir,
-            contextual_words=test_data['contextual_words'],
-            pad_token=pad_token,
-            mask_token=mask_token,
-            batch_size=params.batch_size,
-            num_gpus=params.num_gpus,
-            **kwargs
-            )
-        self.dataloader_attr_AX = BiasDataLoader(
+        self.loader_kwargs = dict(
             params=params,
-            captions=test_data['attr1']['captions'],
-            images=test_data['attr1'][self.category_X+'_Images'],
             dataset_dir=test_data['dataset_dir'],
             image_features_path_or_dir=image_features_path_or_dir,
             contextual_words=test_data['contextual_words'],
@@ -85,198 +93,95 @@ class BiasTest:
             num_gpus=params.num_gpus,
             **kwargs
             )
-        self.dataloader_attr_AY = BiasDataLoader(
-            params=params,
-            captions=test_data['attr1']['captions'],
-            images=test_data['attr1'][self.category_Y+'_Images'],
-            dataset_dir=test_data['dataset_dir'],
-            image_features_path_or_dir=image_features_path_or_dir,
-            contextual_words=test_data['contextual_words'],
-            pad_token=pad_token,
-            mask_token=mask_token,
-            batch_size=params.batch_size,
-            num_gpus=params.num_gpus,
-            **kwargs
-            )
-        self.dataloader_attr_BX = BiasDataLoader(
-            params=params,
-            captions=test_data['attr2']['captions'],
-            images=test_data['attr2'][self.category_X+'_Images'],
-            dataset_dir=test_data['dataset_dir'],
-            image_features_path_or_dir=image_features_path_or_dir,
-            contextual_words=test_data['contextual_words'],
-            pad_token=pad_token,
-            mask_token=mask_token,
-            batch_size=params.batch_size,
-            num_gpus=params.num_gpus,
-            **kwargs
-            )
-        self.dataloader_attr_BY = BiasDataLoader(
-            params=params,
-            captions=test_data['attr2']['captions'],
-            images=test_data['attr2'][self.category_Y+'_Images'],
-            dataset_dir=test_data['dataset_dir'],
-            image_features_path_or_dir=image_features_path_or_dir,
-            contextual_words=test_data['contextual_words'],
-            pad_token=pad_token,
-            mask_token=mask_token,
-            batch_size=params.batch_size,
-            num_gpus=params.num_gpus,
-            **kwargs
-            )
-        self.dataloaders = [
-            self.dataloader_targ_X,
-            self.dataloader_targ_Y,
-            self.dataloader_attr_AX,
-            self.dataloader_attr_AY,
-            self.dataloader_attr_BX,
-            self.dataloader_attr_BY
-            ]
-        
+        # (captions, images) for each set, in the order of the encodings
+        self.encoding_sets = {
+            'targ_X' : (test_data['targ1']['captions'], test_data['targ1']['images']),
+            'targ_Y' : (test_data['targ2']['captions'], test_data['targ2']['images']),
+            'attr_AX' : (test_data['attr1']['captions'], test_data['attr1'][self.category_X+'_Images']),
+            'attr_AY' : (test_data['attr1']['captions'], test_data['attr1'][self.category_Y+'_Images']),
+            'attr_BX' : (test_data['attr2']['captions'], test_data['attr2'][self.category_X+'_Images']),
+            'attr_BY' : (test_data['attr2']['captions'], test_data['attr2'][self.category_Y+'_Images'])
+        }
+
+        # the same (caption, image) pairs recur across sets, e.g. an attribute
+        # image paired with the same caption in AX and BX, so by default every
+        # unique pair is encoded once and the encodings are shared
+        self.dedup_encodings = params.get('dedup_encodings', True)
+        if self.dedup_encodings:
+            captions, images, self.encoding_plan = plan_encodings(self.encoding_sets)
+            num_items = sum(len(idx) for idx in self.encoding_plan.values())
+            print(f'Encoding {sum(len(c) for c in images.values())} unique of {num_items} (caption, image) pairs')
+            self.dataloader_unique = self.make_dataloader(captions, images)
+        else:
+            self.dataloader_targ_X = self.make_dataloader(*self.encoding_sets['targ_X'])
+            self.dataloader_targ_Y = self.make_dataloader(*self.encoding_sets['targ_Y'])
+            self.dataloader_attr_AX = self.make_dataloader(*self.encoding_sets['attr_AX'])
+            self.dataloader_attr_AY = self.make_dataloader(*self.encoding_sets['attr_AY'])
+            self.dataloader_attr_BX = self.make_dataloader(*self.encoding_sets['attr_BX'])
+            self.dataloader_attr_BY = self.make_dataloader(*self.encoding_sets['attr_BY'])
+            self.dataloaders = [
+                self.dataloader_targ_X,
+                self.dataloader_targ_Y,
+                self.dataloader_attr_AX,
+                self.dataloader_attr_AY,
+                self.dataloader_attr_BX,
+                self.dataloader_attr_BY
+                ]
+
+    def make_dataloader(self, captions: Dict, images: Dict):
+        return BiasDataLoader(captions=captions, images=images, **self.loader_kwargs)
+
     def dataloaders(self):
         for dataloader in self.dataloaders:
             yield dataloader
         
     @torch.no_grad()
     def encode_data(self, model: nn.Module):
+        ''' Returns {layer : encodings} for each of the hidden layers model encodes.
+        '''
+        encoded = {} # {layer : {name : (enc, enc_mask_t, enc_mask_v)}}
+        if self.dedup_encodings:
+            for layer, (enc, enc_mask_t, enc_mask_v) in model.encode_cached(self.dataloader_unique).items():
+                encoded[layer] = {name : (scatter_encodings(enc, idx),
+                                          scatter_encodings(enc_mask_t, idx),
+                                          scatter_encodings(enc_mask_v, idx))
+                                  for name, idx in self.encoding_plan.items()}
+        else:
+            # targets w/ corresponding images
+            encoded_sets = {
+                'targ_X' : model.encode_cached(self.dataloader_targ_X),
+                'targ_Y' : model.encode_cached(self.dataloader_targ_Y),
+
+                # attribute A with images corresponding to targets X and Y
+                'attr_AX' : model.encode_cached(self.dataloader_attr_AX),
+                'attr_AY' : model.encode_cached(self.dataloader_attr_AY),
+
+                # attribute B with images corresponding to targets X and Y
+                'attr_BX' : model.encode_cached(self.dataloader_attr_BX),
+                'attr_BY' : model.encode_cached(self.dataloader_attr_BY)
+            }
+            for name, encoded_layers in encoded_sets.items():
+                for layer, encs in encoded_layers.items():
+                    encoded.setdefault(layer, {})[name] = encs
+
         encodings = {}
-        
-        # targets w/ corresponding images
-        encoded_X, encoded_X_mask_t, encoded_X_mask_v = model.encode(self.dataloader_targ_X)
-        encoded_Y, encoded_Y_mask_t, encoded_Y_mask_v = model.encode(self.dataloader_targ_Y)
-        
-        # attribute A with images corresponding to targets X and Y
-        encoded_AX, encoded_AX_mask_t, encoded_AX_mask_v = model.encode(self.dataloader_attr_AX)
-        encoded_AY, encoded_AY_mask_t, encoded_AY_mask_v = model.encode(self.dataloader_attr_AY)
-        
-        # attribute B with images corresponding to targets X and Y
-        encoded_BX, encoded_BX_mask_t, encoded_BX_mask_v = model.encode(self.dataloader_attr_BX)
-        encoded_BY, encoded_BY_mask_t, encoded_BY_mask_v = model.encode(self.dataloader_attr_BY)
-            
-        encodings = {
-            'targ_X' : encoded_X['full_seq'],
-            'targ_Y' : encoded_Y['full_seq'],
-            'attr_AX' : encoded_AX['full_seq'],
-            'attr_AY' : encoded_AY['full_seq'],
-            'attr_BX' : encoded_BX['full_seq'],
-            'attr_BY' : encoded_BY['full_seq'],
-            'targ_X_mask_t' : encoded_X_mask_t['full_seq'],
-            'targ_Y_mask_t' : encoded_Y_mask_t['full_seq'],
-            'attr_AX_mask_t' : encoded_AX_mask_t['full_seq'],
-            'attr_AY_mask_t' : encoded_AY_mask_t['full_seq'],
-            'attr_BX_mask_t' : encoded_BX_mask_t['full_seq'],
-            'attr_BY_mask_t' : encoded_BY_mask_t['full_seq'],
-            'targ_X_mask_v' : encoded_X_mask_v['full_seq'],
-            'targ_Y_mask_v' : encoded_Y_mask_v['full_seq'],
-            'attr_AX_mask_v' : encoded_AX_mask_v['full_seq'],
-            'attr_AY_mask_v' : encoded_AY_mask_v['full_seq'],
-            'attr_BX_mask_v' : encoded_BX_mask_v['full_seq'],
-            'attr_BY_mask_v' : encoded_BY_mask_v['full_seq'],
-            'contextual_targ_X' : encoded_X['contextual'],
-            'contextual_targ_Y' : encoded_Y['contextual'],
-            'contextual_attr_AX' : encoded_AX['contextual'],
-            'contextual_attr_AY' : encoded_AY['contextual'],
-            'contextual_attr_BX' : encoded_BX['contextual'],
-            'contextual_attr_BY' : encoded_BY['contextual']
-        }
+        for layer, encoded_layer in encoded.items():
+            encodings[layer] = {}
+            for name, (enc, enc_mask_t, enc_mask_v) in encoded_layer.items():
+                encodings[layer][name] = enc['full_seq']
+                encodings[layer][name + '_mask_t'] = enc_mask_t['full_seq']
+                encodings[layer][name + '_mask_v'] = enc_mask_v['full_seq']
+                encodings[layer]['contextual_' + name] = enc['contextual']
         return encodings
 
     @torch.no_grad()
     def predict_words(self, model: nn.Module):
         print("attr AX")
-        model.predict_words(self.dataloader_attr_AX)
+        model.predict_words(self.make_dataloader(*self.encoding_sets['attr_AX']))
         print("\n\nattr AY")
-        model.predict_words(self.dataloader_attr_AY)
+        model.predict_words(self.make_dataloader(*self.encoding_sets['attr_AY']))
         print("attr BX")
-        model.predict_words(self.dataloader_attr_BX)
+        model.predict_words(self.make_dataloader(*self.encoding_sets['attr_BX']))
         print("\n\nattr BY")
-        model.predict_words(self.dataloader_attr_BY)
+        model.predict_words(self.make_dataloader(*self.encoding_sets['attr_BY']))
         exit()
-        
-    
-    def _get_revelant_encodings(self, test_type: str, encodings: Dict):
-        if test_type == 'word' or test_type == 'sentence':
-            X =  encodings['targ_X']
-            Y =  encodings['targ_Y']
-            AX = encodings['attr_AX']
-            AY = encodings['attr_AY']
-            BX = encodings['attr_BX']
-            BY = encodings['attr_BY']
-        elif test_type == 'contextual':
-            X =  encodings['contextual_targ_X']
-            Y =  encodings['contextual_targ_Y']
-            AX = encodings['contextual_attr_AX']
-            AY = encodings['contextual_attr_AY']
-            BX = encodings['contextual_attr_BX']
-            BY = encodings['contextual_attr_BY']
-        elif test_type == 'mask_t':
-            X =  encodings['targ_X_mask_t']
-            Y =  encodings['targ_Y_mask_t']
-            AX = encodings['attr_AX_mask_t']
-            AY = encodings['attr_AY_mask_t']
-            BX = encodings['attr_BX_mask_t']
-            BY = encodings['attr_BY_mask_t']
-        elif test_type == 'mask_v':
-            X =  encodings['targ_X_mask_v']
-            Y =  encodings['targ_Y_mask_v']
-            AX = encodings['attr_AX_mask_v']
-            AY = encodings['attr_AY_mask_v']
-            BX = encodings['attr_BX_mask_v']
-            BY = encodings['attr_BY_mask_v']
-        else:
-            raise Exception(f'Unknown test type: {test_type}')
-        return X, Y, AX, AY, BX, BY
-    
-    
-    def run_weat_union(self, encodings: Dict, num_samples: int):
-        results = {}
-        for test_type in self.test_types:
-            X, Y, AX, AY, BX, BY = self._get_revelant_encodings(test_type, encodings)
-            esize, pval = weat_union(X, Y, AX, AY, BX, BY, num_samples,
-                                     self.category_X, self.category_Y,
-                                     self.category_A, self.category_B)
-            results[test_type] = (esize, pval)
-        return results
-
-    def run_weat_specific(self, encodings: Dict, num_samples: int):
-        results = {}
-        for test_type in self.test_types:
-            X, Y, AX, AY, BX, BY = self._get_revelant_encodings(test_type, encodings)
-            esize, pval = weat_specific(X, Y, AX, AY, BX, BY, num_samples,
-                                        self.category_X, self.category_Y,
-                                        self.category_A, self.category_B)
-            results[test_type] = (esize, pval)
-        return results
-        
-    def run_weat_intra(self, encodings: Dict, num_samples: int):
-        results = {}
-        for test_type in self.test_types:
-            X, Y, AX, AY, BX, BY = self._get_revelant_encodings(test_type, encodings)
-            esize_x, pval_x, esize_y, pval_y =\
-                        weat_intra(X, Y, AX, AY, BX, BY, num_samples,
-                                   self.category_X, self.category_Y,
-                                   self.category_A, self.category_B)
-            results[test_type] = (esize_x, pval_x, esize_y, pval_y)
-        return results
-
-    def run_weat_mask(self, encodings: Dict, num_samples: int):
-        results = {}
-        for mask_type in ['mask_t', 'mask_v']:
-            X, Y, AX, AY, BX, BY = self._get_revelant_encodings(mask_type, encodings)
-            if len(X) == 0:
-                warn(f'Length is zero for X for {mask_type}')
-                continue
-            test_type = 'word' if 'word' in self.test_types else 'sent'
-            esize, pval = weat_union(X, Y, AX, AY, BX, BY, num_samples,
-                                     self.category_X, self.category_Y,
-                                     self.category_A, self.category_B)
-            results[mask_type] = (esize, pval, test_type)
-        return results
-    
-    def get_general_vals(self, encodings: Dict, num_samples: int): # TODO rename
-        results = {}
-        for test_type in self.test_types:
-            X, Y, AX, AY, BX, BY = self._get_revelant_encodings(test_type, encodings)
-            vals = get_general_vals(X, Y, AX, AY, BX, BY, n_samples=num_samples)
-            results[test_type] = vals
-        return results
@@ -1,10 +1,17 @@
 from attrdict import AttrDict
-from copy import deepcopy
-import re
+from copy import copy, deepcopy
 from typing import Any, Dict, List
 import torch
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 from .dataset_wrappers import create_dataset
+from .region_masking import mask_regions, region_lookup
+
+class _Subset(Subset):
+    # the model wrappers read dataset attributes such as tokenizer and data_names
+    def __getattr__(self, name: str):
+        if name == 'dataset':
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
 
 class BiasDataLoader(DataLoader):
     def __init__(
@@ -41,6 +48,11 @@ class BiasDataLoader(DataLoader):
             pin_memory=False
         )
         
+        # (caption, image) of every example, in the order the datasets load them
+        self.pairs = [(captions[str(c)], image_fp)
+                      for image_fp, corresponding_caps in images.items()
+                      for c in corresponding_caps]
+        self.image_features_source = image_features_path_or_dir # identifies the features in embedding cache keys
         self.tokenizer = self.dataset.tokenizer
         self.contextual_words = contextual_words
         self.contextual_words_with_people = contextual_words + ['people', 'person', 'woman', 'women', 'man', 'men']
@@ -52,39 +64,110 @@ class BiasDataLoader(DataLoader):
 
         self.contextual_word_ids = [self.convert_tokens_to_ids(self.dataset.tokenizer.tokenize(word)) for word in self.contextual_words]
         
-        # we'll find the longest matching tokenized spans first when we replace with masked id
-        self.contextual_word_ids_as_strings = []
-        for cwids in self.contextual_word_ids:
-            cwids = ' '.join([str(c) for c in cwids])
-            self.contextual_word_ids_as_strings.append(cwids)
-        self.contextual_word_ids_as_strings.sort(key=lambda x: len(x), reverse=True)
+        # we'll find the longest matching tokenized spans first when we replace with masked id;
+        # patterns are rows of word-piece ids, right-padded with -1
+        contextual_word_ids = sorted(dict.fromkeys(tuple(cwids) for cwids in self.contextual_word_ids if cwids),
+                                     key=lambda cwids: (len(cwids), len(' '.join(str(c) for c in cwids))),
+                                     reverse=True)
+        max_pattern_len = max(len(cwids) for cwids in contextual_word_ids)
+        self.contextual_patterns = torch.tensor([list(cwids) + [-1] * (max_pattern_len - len(cwids))
+                                                 for cwids in contextual_word_ids])
+        self.contextual_pattern_lengths = torch.tensor([len(cwids) for cwids in contextual_word_ids])
+
+        # image regions of people, by object class, for the models with object labels
+        obj_list = getattr(self.dataset_wrapper, 'obj_list', None)
+        self.person_regions = region_lookup(obj_list, self.contextual_words_with_people) if obj_list else None
+        self.num_masked_regions = None # per example, in the last batch masked by mask_image_regions or mask_input_features
+
+    def subset(self, indices: List[int]):
+        ''' A copy of this dataloader over only the examples at indices.
+        '''
+        loader = copy(self)
+        loader._DataLoader__initialized = False # DataLoader forbids resetting its dataset otherwise
+        DataLoader.__init__(
+            loader,
+            dataset=_Subset(self.dataset, indices),
+            batch_size=self.batch_size,
+            shuffle=False,
+            num_workers=self.num_workers,
+            collate_fn=self.collate_fn,
+            drop_last=False,
+            pin_memory=False
+        )
+        loader.pairs = [self.pairs[i] for i in indices]
+        return loader
 
     def mask_contextual_words_in_batch(self, batch: Dict, input_id_key: str):
-        # find matching spans of contextual word ids in input ids
-        # then replace with mask_id
-        # and possibly add padding tokens for multi-token id contextual words
-        batch = deepcopy(batch)
-        max_len = batch[input_id_key].shape[1]
-        for idx, input_ids in enumerate(batch[input_id_key]):
-            # convert to string and replace matching spans
-            input_tokens = None
-            input_ids_as_str = ' '.join([str(i) for i in input_ids.tolist()])
-            for cws in self.contextual_word_ids_as_strings:
-                if cws in input_ids_as_str:
-                    input_ids_as_str = re.sub(cws, str(self.mask_token_id), input_ids_as_str)
-                    break
+        ''' Replace the contextual word in every row of batch[input_id_key] with a single
+            mask id: the first contextual word (longest first) that occurs in the row as
+            a whole span of word-piece ids, at each of its occurrences. Multi-token words
+            shrink to one id, so rows are shifted left and re-padded with the pad id.
+        Returns a shallow copy of batch with a new input id tensor.
+        '''
+        input_ids = batch[input_id_key]
+        num_rows, max_len = input_ids.shape
+        patterns = self.contextual_patterns.to(input_ids.device)
+        lengths = self.contextual_pattern_lengths.to(input_ids.device)
+        width = patterns.shape[1]
+
+        # matches[b, t, p]: pattern p starts at position t of row b
+        windows = torch.nn.functional.pad(input_ids, (0, width - 1), value=-1).unfold(1, width, 1)
+        matches = ((windows.unsqueeze(2) == patterns) | (patterns < 0)).all(-1)
+        found = matches.any(1)
+        unmatched = ~found.any(1)
+        assert not unmatched.any(), \
+            f'Nothing masked!\nInput tokens: {input_ids[unmatched]} \n {self.contextual_word_ids}'
+        pattern = found.int().argmax(1) # first pattern, in order, that occurs in each row
+        rows = torch.arange(num_rows, device=input_ids.device)
+        starts = matches[rows, :, pattern]
+        length = lengths[pattern].unsqueeze(1)
+
+        # like re.sub, take occurrences left to right without overlaps
+        positions = torch.arange(max_len, device=input_ids.device)
+        last_start = torch.where(starts, positions, -max_len).cummax(1).values
+        previous_start = torch.nn.functional.pad(last_start[:, :-1], (1, 0), value=-max_len)
+        if (starts & (positions - previous_start < length)).any():
+            starts = self._drop_overlapping_starts(starts, length)
+            last_start = torch.where(starts, positions, -max_len).cummax(1).values
+
+        # drop the word pieces after each start and put the mask id at the start
+        span_offset = positions - last_start
+        keep = (span_offset == 0) | (span_offset >= length)
+        masked_ids = torch.where(starts, torch.full_like(input_ids, self.mask_token_id), input_ids)
+        new_positions = keep.long().cumsum(1) - 1
+        out = torch.full_like(input_ids, self.pad_token_id)
+        out[rows.unsqueeze(1).expand_as(keep)[keep], new_positions[keep]] = masked_ids[keep]
+
+        batch = copy(batch)
+        batch[input_id_key] = out
+        return batch
+
+    def mask_input_ids(self, input_ids: torch.Tensor):
+        return self.mask_contextual_words_in_batch({'input_ids' : input_ids}, 'input_ids')['input_ids']
 
-            assert str(self.mask_token_id) in input_ids_as_str, \
-                f'Nothing masked!\nInput tokens: {input_ids} {input_ids_as_str} {input_tokens} \n {self.contextual_word_ids_as_strings}'
-            
-            # convert back to list
-            input_ids = [int(t) for t in input_ids_as_str.split(' ')]
+    def mask_image_regions(self, batch: Dict, obj_indices: torch.Tensor, feat_key: str='visual_feats'):
+        ''' Returns a shallow copy of batch whose batch[feat_key] has the regions of people
+            zeroed; every other tensor is shared with batch, which is left unchanged.
+        '''
+        self.person_regions = self.person_regions.to(obj_indices.device)
+        feats, self.num_masked_regions = mask_regions(batch[feat_key], self.person_regions, obj_indices)
+        return {**batch, feat_key : feats}
 
-            # check if we need to add padding
-            if len(input_ids) != max_len:
-                input_ids += [self.pad_token_id] * (max_len - len(input_ids))
-            input_tokens = self.tokenizer.convert_ids_to_tokens(input_ids)
+    def mask_input_features(self, boxes: torch.Tensor, object_labels: torch.Tensor):
+        ''' Returns a copy of boxes with the boxes of people zeroed.
+        '''
+        self.person_regions = self.person_regions.to(object_labels.device)
+        boxes, self.num_masked_regions = mask_regions(boxes, self.person_regions, object_labels[:len(boxes)])
+        return boxes
 
-            # update batch
-            batch[input_id_key][idx] = torch.tensor(input_ids, device=batch[input_id_key].device)
-        return batch
\ No newline at end of file
+    @staticmethod
+    def _drop_overlapping_starts(starts: torch.Tensor, length: torch.Tensor):
+        # a start within length - 1 of an earlier kept start is not an occurrence;
+        # only needed for self-overlapping multi-token words, e.g. 'a b a' in 'a b a b a'
+        starts = starts.clone()
+        max_len = starts.shape[1]
+        positions = torch.arange(max_len, device=starts.device)
+        for t in range(1, max_len):
+            earlier = (positions > t - length) & (positions < t)
+            starts[:, t] &= ~(starts & earlier).any(1)
+        return starts
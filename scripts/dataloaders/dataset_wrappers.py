@@ -4,8 +4,10 @@ import os
 from os import path
 import re
 import torch
-from typing import Any, Callable, Dict, List
+from typing import Any, Callable, Dict, List, Set
 from torch.utils.data import Dataset
+from .feature_pack import FeaturePack, is_feature_pack
+from .feature_store import load_features
 
 class VisualBERTDatasetWrapper:
     def __init__(
@@ -19,7 +21,7 @@ class VisualBERTDatasetWrapper:
         from .visualbert.bias_dataset import BiasDataset
         kwargs.pop("dataset_dir")
         assert len(kwargs) == 0, "No kwargs should be passed for VisualBERT"
-        image_features = torch.load(image_features_path_or_dir)
+        image_features = load_features(image_features_path_or_dir, torch.load)
         self.dataset = BiasDataset(
             images=images,
             captions=captions,
@@ -42,7 +44,7 @@ class ViLBERTDatasetWrapper:
         
     ):
         from .vilbert.bias_dataset import BiasDataset
-        from .vilbert._image_features_reader import ImageFeaturesH5ReaderWithObjClasses
+        from .vilbert._image_features_reader import ImageFeaturesH5ReaderWithObjClasses, ImageFeaturesPackReader
         kwargs.pop("dataset_dir")
         assert len(kwargs) == 0, "No kwargs should be passed for ViLBERT"
 
@@ -50,7 +52,12 @@ class ViLBERTDatasetWrapper:
         with open(params.path_to_obj_list) as f:
             [obj_list.append(line.strip()) for line in f]
 
-        image_features = ImageFeaturesH5ReaderWithObjClasses(image_features_path_or_dir)
+        if is_feature_pack(image_features_path_or_dir):
+            image_features = ImageFeaturesPackReader(image_features_path_or_dir)
+        else:
+            # captions share images, so keep recently decoded ones
+            image_features = ImageFeaturesH5ReaderWithObjClasses(image_features_path_or_dir, in_memory=True,
+                                                                 cache_size=1024)
         self.dataset = BiasDataset(
             bert_model_name=params.bert_model_name,
             captions=captions,
@@ -81,38 +88,39 @@ class LXMERTDatasetWrapper:
         with open(params.path_to_obj_list) as f:
             [self.obj_list.append(line.strip()) for line in f]
         
-        image_features = self.load_image_features(image_features_path_or_dir)
+        dataset = LXMERTBiasDataset(images=images, captions=captions)
+        # only the images of the test, under either of the ids LXMERTBiasTorchDataset looks up
+        image_ids = {datum['image_id'] for datum in dataset.data}
+        image_ids |= {img_id + '.jpg' for img_id in image_ids}
+        image_features = load_features(image_features_path_or_dir, self.load_image_features, image_ids)
 
         self.dataset = LXMERTBiasTorchDataset(
             bert_model_name=params.bert_model_name,
-            dataset=LXMERTBiasDataset(
-                        images=images,
-                        captions=captions,
-                    ),
-            img_data=image_features
+            dataset=dataset,
+            img_data=list(image_features.values())
             )
 
     @staticmethod
-    def load_image_features(image_features_path_or_dir: str):
-        from .lxmert.utils import load_obj_tsv
+    def load_image_features(image_features_path_or_dir: str, image_ids: Set[str]=None):
+        # {image id : features} of the images in image_ids, or of all images
+        from .lxmert.utils import load_obj_tsv, load_obj_tsv_parallel
+        if is_feature_pack(image_features_path_or_dir):
+            pack = FeaturePack(image_features_path_or_dir)
+            return {img_id : pack[img_id] for img_id in pack.keys() if image_ids is None or img_id in image_ids}
+
         if path.exists(image_features_path_or_dir):
-            return load_obj_tsv(image_features_path_or_dir)
+            fnames = [image_features_path_or_dir]
         else:
-            img_data = []
             basedir = path.dirname(image_features_path_or_dir)
-            for f in os.listdir(basedir):
-                if re.match(f'{image_features_path_or_dir}.*', path.join(basedir,f)):
-                    img_data.extend(load_obj_tsv(path.join(basedir, f)))
-            return img_data
-
-    def mask_image_regions(self, batch: Dict, obj_indices: torch.Tensor):
-        num_examples, _ = obj_indices.shape
-        feat_dim = batch['visual_feats'].shape[-1]
-        for example_idx in range(num_examples):
-            for i,obj_idx in enumerate(obj_indices[example_idx].tolist()):
-                if self.obj_list[obj_idx] in self.contextual_words_with_people:
-                    batch['visual_feats'][example_idx][i] = torch.zeros(feat_dim)
-        return batch
+            fnames = [path.join(basedir, f) for f in os.listdir(basedir)
+                      if re.match(f'{image_features_path_or_dir}.*', path.join(basedir,f))]
+        if any('lmdb' in fname for fname in fnames):
+            img_data = [img_datum for fname in fnames for img_datum in load_obj_tsv(fname)]
+        else:
+            img_data = load_obj_tsv_parallel(fnames, image_ids)
+        # the last row of an image wins, as in LXMERTBiasTorchDataset
+        return {img_datum['img_id'] : img_datum for img_datum in img_data
+                if image_ids is None or img_datum['img_id'] in image_ids}
 
 class VLBERTDatasetWrapper:
     def __init__(
@@ -132,7 +140,7 @@ class VLBERTDatasetWrapper:
         with open(params.path_to_obj_list) as f:
             [self.obj_list.append(line.strip()) for line in f]
 
-        image_features = self.load_image_features(image_features_path_or_dir)
+        image_features = load_features(image_features_path_or_dir, self.load_image_features, set(images))
         self.transform = lambda img, shape: resize(img, shape)
         self.dataset = VLBERTBiasDataset(
             #**params.model_config,
@@ -143,10 +151,10 @@ class VLBERTDatasetWrapper:
             )
     
     @staticmethod
-    def load_image_features(feature_dir: str):
+    def load_image_features(feature_dir: str, image_ids: Set[str]=None):
         from dataloaders.vlbert import BiasDataset
         #tsv_names = ['image_id', 'image_h', 'image_w', 'num_boxes', 'boxes', 'features', 'cls_prob', 'classes']
-        imgid2features = {}
+        rows = {}
         for fp in os.listdir(feature_dir):
             full_path = os.path.join(feature_dir, fp)
             if not re.match(full_path, '.*tsv') and not os.path.isfile(full_path):
@@ -154,25 +162,16 @@ class VLBERTDatasetWrapper:
             
             with open(os.path.join(feature_dir, fp)) as f:
                 for line in f:
-                    feature_dict = {k:v for k,v in zip(BiasDataset.tsv_names, line.strip().split('\t'))}
-                    img_id = feature_dict['image_id']
-                    imgid2features[img_id] = feature_dict
+                    img_id = line[:line.find('\t')]
+                    if image_ids is None or img_id in image_ids:
+                        rows[img_id] = line
+        # decoded once here rather than on every access of the dataset; the last row of an image wins
+        imgid2features = {}
+        for img_id, line in rows.items():
+            feature_dict = {k:v for k,v in zip(BiasDataset.tsv_names, line.strip().split('\t'))}
+            imgid2features[img_id] = BiasDataset.decode_image_features(feature_dict)
         return imgid2features
 
-
-    def mask_input_ids(self, input_ids: torch.Tensor):
-        batch_out = self.mask_contextual_words_in_batch({'input_ids' : input_ids}, 'input_ids')
-        return batch_out['input_ids']
-
-    def mask_input_features(self, boxes: torch.Tensor, object_labels: torch.Tensor):
-        for example_idx, labels in enumerate(object_labels[:len(boxes)]):
-            for label_idx, label in enumerate(labels):
-                if self.obj_list[label] in self.contextual_words_with_people:
-                    if label_idx >= len(boxes[example_idx]):
-                        continue
-                    boxes[example_idx][label_idx] = torch.zeros_like(boxes[example_idx][label_idx])
-        return boxes
-
 class CustomModelDatasetWrapper(Dataset):
     def __init__(
         self,
@@ -0,0 +1,197 @@
+''' Image features in a binary, columnar format that is read without decoding.
+
+    The TSV and LMDB feature files store every array base64 encoded, which is a
+    third larger and has to be decoded on every read. A feature pack is a directory
+    holding one array per column, with the boxes of all images concatenated:
+        features.npy : (total boxes, dim) float32 or float16 region features
+        boxes.npy    : (total boxes, 4) float32 boxes (x1, y1, x2, y2) in pixels
+        classes.npy  : (total boxes,) int32 object class ids, if the source has them
+        index.npz    : ids, heights and widths of the images, and offsets: the boxes
+                       of the i-th image are rows offsets[i]:offsets[i + 1]
+    The columns are memory-mapped, so an image's features are slices of the mapped
+    files, and its pages are shared by all processes that read the same pack.
+
+    Convert feature files with:
+        python -m scripts.dataloaders.feature_pack --format tsv --out <pack dir> <tsv files>
+'''
+
+from argparse import ArgumentParser
+import base64
+import csv
+import logging as log
+import os
+from os import path
+import pickle
+import sys
+from typing import List
+import numpy as np
+
+# column names of the TSV files, as read by lxmert.utils.load_obj_tsv
+FIELDNAMES_COCO = ["img_id", "img_h", "img_w", "objects_id", "objects_conf",
+                   "attrs_id", "attrs_conf", "num_boxes", "boxes", "features"]
+FIELDNAMES_GOOGLE = ['img_id', 'img_w','img_h','num_boxes', 'boxes', 'features', 'cls_prob']
+
+
+def is_feature_pack(features_path: str):
+    return path.isfile(path.join(features_path, 'index.npz'))
+
+
+class FeaturePack:
+    ''' Read-only, memory-mapped access to the images of a feature pack by id.
+    '''
+    def __init__(self, pack_dir: str):
+        self.pack_dir = pack_dir
+        with np.load(path.join(pack_dir, 'index.npz')) as index:
+            self.ids = index['ids'].tolist()
+            self.offsets = index['offsets']
+            self.img_h = index['img_h']
+            self.img_w = index['img_w']
+        self.id2row = {img_id : row for row, img_id in enumerate(self.ids)}
+        self.features = np.load(path.join(pack_dir, 'features.npy'), mmap_mode='r')
+        self.boxes = np.load(path.join(pack_dir, 'boxes.npy'), mmap_mode='r')
+        classes_fp = path.join(pack_dir, 'classes.npy')
+        self.classes = np.load(classes_fp, mmap_mode='r') if path.exists(classes_fp) else None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, img_id: str):
+        return img_id in self.id2row
+
+    def keys(self):
+        return list(self.ids)
+
+    def __getitem__(self, img_id: str):
+        ''' The image as a dict in the format of lxmert.utils.load_obj_tsv, whose
+            arrays are read-only views of the pack.
+        '''
+        row = self.id2row[img_id]
+        start, stop = self.offsets[row], self.offsets[row + 1]
+        return {
+            'img_id' : img_id,
+            'img_h' : int(self.img_h[row]),
+            'img_w' : int(self.img_w[row]),
+            'num_boxes' : int(stop - start),
+            'features' : self.features[start:stop],
+            'boxes' : self.boxes[start:stop],
+            'objects_id' : self.classes[start:stop] if self.classes is not None else None
+        }
+
+
+def _decode(data: str, dtype, shape):
+    return np.frombuffer(base64.b64decode(data), dtype=dtype).reshape(shape)
+
+
+def read_tsv(fname: str):
+    ''' Records of a TSV feature file: dicts with img_id, img_h, img_w and num_boxes,
+        and functions that decode the features, boxes and classes of the image.
+    '''
+    csv.field_size_limit(sys.maxsize)
+    fieldnames = FIELDNAMES_COCO if 'coco' in fname else FIELDNAMES_GOOGLE
+    with open(fname) as f:
+        for item in csv.DictReader(f, fieldnames, delimiter='\t'):
+            num_boxes = int(item['num_boxes'])
+            yield {
+                'img_id' : item['img_id'],
+                'img_h' : int(item['img_h']),
+                'img_w' : int(item['img_w']),
+                'num_boxes' : num_boxes,
+                'features' : lambda item=item, n=num_boxes: _decode(item['features'], np.float32, (n, -1)),
+                'boxes' : lambda item=item, n=num_boxes: _decode(item['boxes'], np.float32, (n, 4)),
+                'classes' : (lambda item=item, n=num_boxes: _decode(item['objects_id'], np.int64, (n,)))
+                            if item.get('objects_id') else None
+            }
+
+
+def read_lmdb(fname: str):
+    ''' Records of an LMDB feature file, as in read_tsv.
+    '''
+    import lmdb
+    env = lmdb.open(fname, max_readers=1, readonly=True, lock=False, readahead=False, meminit=False)
+    with env.begin(write=False) as txn:
+        for key in pickle.loads(txn.get('keys'.encode())):
+            item = pickle.loads(txn.get(key))
+            num_boxes = int(item['num_boxes'])
+            yield {
+                'img_id' : str(item['image_id']),
+                'img_h' : int(item['image_h']),
+                'img_w' : int(item['image_w']),
+                'num_boxes' : num_boxes,
+                'features' : lambda item=item, n=num_boxes: _decode(item['features'], np.float32, (n, -1)),
+                'boxes' : lambda item=item, n=num_boxes: _decode(item['boxes'], np.float32, (n, 4)),
+                # classes are stored as float64
+                'classes' : (lambda item=item, n=num_boxes: _decode(item['classes'], np.float64, (n,)))
+                            if 'classes' in item else None
+            }
+
+
+READERS = {'tsv' : read_tsv, 'lmdb' : read_lmdb}
+
+
+def convert(sources: List[str], source_format: str, out_dir: str, float16: bool=False):
+    ''' Write the images of the source feature files to a feature pack in out_dir; an
+        image id that occurs more than once is taken from its first occurrence.
+    '''
+    read = READERS[source_format]
+
+    def records():
+        seen = set()
+        for fname in sources:
+            for record in read(fname):
+                if record['img_id'] not in seen:
+                    seen.add(record['img_id'])
+                    yield record
+
+    # 1. sizes only, without decoding any features
+    ids, img_h, img_w, num_boxes = [], [], [], []
+    feat_dim, has_classes = None, None
+    for record in records():
+        if feat_dim is None:
+            feat_dim = record['features']().shape[1]
+            has_classes = record['classes'] is not None
+        ids.append(record['img_id'])
+        img_h.append(record['img_h'])
+        img_w.append(record['img_w'])
+        num_boxes.append(record['num_boxes'])
+    offsets = np.concatenate(([0], np.cumsum(num_boxes))).astype(np.int64)
+    total = int(offsets[-1])
+    log.info(f'Converting {len(ids)} images with {total} boxes to {out_dir}')
+
+    # 2. decode each image straight into the memory-mapped columns
+    os.makedirs(out_dir, exist_ok=True)
+    if is_feature_pack(out_dir):
+        os.remove(path.join(out_dir, 'index.npz'))
+    open_memmap = np.lib.format.open_memmap
+    features = open_memmap(path.join(out_dir, 'features.npy'), mode='w+',
+                           dtype=np.float16 if float16 else np.float32, shape=(total, feat_dim or 0))
+    boxes = open_memmap(path.join(out_dir, 'boxes.npy'), mode='w+', dtype=np.float32, shape=(total, 4))
+    classes = open_memmap(path.join(out_dir, 'classes.npy'), mode='w+', dtype=np.int32, shape=(total,)) \
+              if has_classes else None
+    for row, record in enumerate(records()):
+        start, stop = offsets[row], offsets[row + 1]
+        features[start:stop] = record['features']()
+        boxes[start:stop] = record['boxes']()
+        if classes is not None:
+            classes[start:stop] = record['classes']()
+    for column in (features, boxes, classes):
+        if column is not None:
+            column.flush()
+
+    # the index last, so that an interrupted conversion is not taken for a pack
+    np.savez(path.join(out_dir, 'index.npz'), ids=np.array(ids), offsets=offsets,
+             img_h=np.array(img_h, dtype=np.int32), img_w=np.array(img_w, dtype=np.int32))
+
+
+def main(args=None):
+    parser = ArgumentParser(description='Convert TSV or LMDB image features to a feature pack')
+    parser.add_argument('sources', nargs='+', help='feature files to convert')
+    parser.add_argument('--format', dest='source_format', choices=sorted(READERS), default='tsv')
+    parser.add_argument('--out', required=True, help='directory to write the feature pack to')
+    parser.add_argument('--float16', action='store_true', help='store the region features as float16')
+    args = parser.parse_args(args)
+    log.basicConfig(level=log.INFO)
+    convert(args.sources, args.source_format, args.out, args.float16)
+
+
+if __name__ == '__main__':
+    main()
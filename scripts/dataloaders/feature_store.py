@@ -0,0 +1,149 @@
+''' Process-wide store of loaded image features.
+
+    Every BiasDataLoader loads the image features of its dataset, six dataloaders per
+    test, and many tests share a feature file. The store loads each feature source
+    once per process, keyed by its loader, path and modification time, and hands
+    every dataset wrapper a read-only view of the same object. Given a memory budget,
+    it evicts the least recently used sources once their total size exceeds it.
+
+    Loaders that can load only some images (e.g. of the TSV features of LXMERT) return
+    them by image id. The store keeps, per source, every image loaded so far and the
+    ids already looked up, and only asks the loader for ids it has not looked up yet,
+    so tests share the images they have in common. The tradeoff: a test with new ids
+    rescans the source for them (skipping, not decoding, the rows of other images),
+    rather than the store decoding every image of the source once up front.
+'''
+
+from collections import OrderedDict
+import logging as log
+import os
+from os import path
+from types import MappingProxyType
+from typing import Any, Callable, Iterable, Set
+import numpy as np
+import torch
+
+
+def source_mtime(source: str):
+    ''' Modification time of a feature file, or the latest one of the files in a
+        directory or starting with a path prefix.
+    '''
+    if path.isfile(source):
+        return os.stat(source).st_mtime_ns
+    if path.isdir(source):
+        files = [path.join(source, f) for f in os.listdir(source)]
+    else:
+        basedir = path.dirname(source) or '.'
+        files = [path.join(basedir, f) for f in os.listdir(basedir)] if path.isdir(basedir) else []
+        files = [f for f in files if f.startswith(source)]
+    return max((os.stat(f).st_mtime_ns for f in files), default=None)
+
+
+def nbytes(features: Any):
+    ''' Approximate size of the arrays, tensors and strings in features.
+    '''
+    if isinstance(features, np.memmap):
+        return 0 # mapped from a file (e.g. a feature pack), not held in memory
+    if isinstance(features, np.ndarray):
+        return features.nbytes
+    if isinstance(features, torch.Tensor):
+        return features.element_size() * features.nelement()
+    if isinstance(features, (str, bytes)):
+        return len(features)
+    if isinstance(features, (dict, MappingProxyType)):
+        return sum(nbytes(v) for v in features.values())
+    if isinstance(features, (list, tuple)):
+        return sum(nbytes(v) for v in features)
+    return 0
+
+
+def read_only(features: Any):
+    if isinstance(features, dict):
+        return MappingProxyType(features)
+    if isinstance(features, list):
+        return tuple(features)
+    return features
+
+
+class FeatureStore:
+    def __init__(self, max_bytes: int=None):
+        self.max_bytes = max_bytes
+        # (loader, path, mtime) -> [features, nbytes, ids looked up or None if all loaded],
+        # least recently used first
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def total_bytes(self):
+        return sum(size for _, size, _ in self.entries.values())
+
+    def load(self, source: str, loader: Callable, image_ids: Iterable[str]=None):
+        ''' Features loaded by loader(source), or by loader(source, image_ids) to load only
+            some images, loaded only once while source is unchanged. The latter returns
+            {image id : features}, and so does this, for the images in image_ids it found.
+        '''
+        loader_name = f'{loader.__module__}.{loader.__qualname__}'
+        key = (loader_name, path.realpath(source), source_mtime(source))
+        entry = self.entries.get(key)
+        image_ids = set(image_ids) if image_ids is not None else None
+        if image_ids is None:
+            new_ids = None
+        elif entry is None or entry[2] is None:
+            new_ids = image_ids
+        else:
+            new_ids = image_ids - entry[2] # looked up before, whether or not found
+        if entry is not None and (entry[2] is None or (image_ids is not None and not new_ids)):
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[0] if image_ids is None else self._select(entry[0], image_ids)
+
+        self.misses += 1
+        if entry is not None and image_ids is not None:
+            # add the images not looked up yet to those loaded by earlier tests
+            features = loader(source, new_ids)
+            entry[0].update(features)
+            entry[1] += nbytes(features)
+            entry[2] |= new_ids
+            self.entries.move_to_end(key)
+            features = entry[0]
+        else:
+            # drop what was loaded from an older version of the source
+            for stale in [k for k in self.entries if k[:2] == key[:2]]:
+                del self.entries[stale]
+            if image_ids is None:
+                features = read_only(loader(source))
+                self.entries[key] = [features, nbytes(features), None]
+            else:
+                features = dict(loader(source, image_ids))
+                self.entries[key] = [features, nbytes(features), set(image_ids)]
+        self._evict()
+        return features if image_ids is None else self._select(features, image_ids)
+
+    @staticmethod
+    def _select(features: dict, image_ids: Set[str]):
+        return MappingProxyType({img_id : features[img_id] for img_id in image_ids if img_id in features})
+
+    def _evict(self):
+        # keep at least the newest source, even if it alone exceeds the budget
+        while self.max_bytes is not None and len(self.entries) > 1 and self.total_bytes > self.max_bytes:
+            (_, source, _), _ = self.entries.popitem(last=False)
+            self.evictions += 1
+            log.info(f'Evicted image features of {source} from the feature store')
+
+    def stats(self):
+        return {
+            'hits' : self.hits,
+            'misses' : self.misses,
+            'evictions' : self.evictions,
+            'sources' : len(self.entries),
+            'bytes' : self.total_bytes
+        }
+
+
+FEATURE_STORE = FeatureStore()
+
+
+def load_features(source: str, loader: Callable, image_ids: Iterable[str]=None):
+    return FEATURE_STORE.load(source, loader, image_ids)
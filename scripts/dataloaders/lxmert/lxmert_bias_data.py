@@ -132,7 +132,7 @@ class LXMERTBiasTorchDataset(Dataset):
         # Get image info
         img_info = self.imgid2img[img_id]
         obj_num = img_info['num_boxes']
-        feats = img_info['features'].copy()
+        feats = img_info['features'].astype(np.float32) # a copy, also of float16 feature packs
         boxes = img_info['boxes'].copy()
         obj_labels = img_info['objects_id'].copy()
         obj_confs = None # img_info['objects_conf'].copy() if 'objects_conf' in img_info is not None else None
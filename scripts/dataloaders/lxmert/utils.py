@@ -4,6 +4,8 @@
 import sys
 import csv
 import base64
+import multiprocessing
+import os
 import time
 import numpy as np
 import lmdb
@@ -40,27 +42,7 @@ def load_obj_tsv(fname, topk=None):
     with open(fname) as f:
         reader = csv.DictReader(f, fieldnames, delimiter="\t")
         for i, item in enumerate(reader):
-            for key in ['img_h', 'img_w', 'num_boxes']:
-                item[key] = int(item[key])
-            
-            boxes = item['num_boxes']
-            decode_config = [
-                ('objects_id', (boxes, ), np.int64),
-                ('objects_conf', (boxes, ), np.float32),
-                ('attrs_id', (boxes, ), np.int64),
-                ('attrs_conf', (boxes, ), np.float32),
-                ('boxes', (boxes, 4), np.float32),
-                ('features', (boxes, -1), np.float32),
-            ]
-            for key, shape, dtype in decode_config:
-                if not key in item:
-                    item[key] = None
-                    continue
-                item[key] = np.frombuffer(base64.b64decode(item[key]), dtype=dtype)
-                item[key] = item[key].reshape(shape)
-                item[key].setflags(write=False)
-
-            data.append(item)
+            data.append(decode_obj_item(item))
             if topk is not None and len(data) == topk:
                 break
     elapsed_time = time.time() - start_time
@@ -68,6 +50,110 @@ def load_obj_tsv(fname, topk=None):
     return data
 
 
+def decode_obj_item(item, keys=None):
+    """Decode the numeric fields of a row of an obj tsv file, in place.
+
+    :param item: The row as a dict of strings, keyed by FIELDNAMES.
+    :param keys: The array fields to decode, all of them if None. The other
+        array fields, and the class probabilities, are dropped.
+    """
+    for key in ['img_h', 'img_w', 'num_boxes']:
+        item[key] = int(item[key])
+
+    boxes = item['num_boxes']
+    decode_config = [
+        ('objects_id', (boxes, ), np.int64),
+        ('objects_conf', (boxes, ), np.float32),
+        ('attrs_id', (boxes, ), np.int64),
+        ('attrs_conf', (boxes, ), np.float32),
+        ('boxes', (boxes, 4), np.float32),
+        ('features', (boxes, -1), np.float32),
+    ]
+    for key, shape, dtype in decode_config:
+        if not key in item:
+            item[key] = None
+            continue
+        if keys is not None and key not in keys:
+            del item[key]
+            continue
+        item[key] = np.frombuffer(base64.b64decode(item[key]), dtype=dtype)
+        item[key] = item[key].reshape(shape)
+        item[key].setflags(write=False)
+    if keys is not None:
+        item.pop('cls_prob', None)
+    return item
+
+
+# the fields read by LXMERTBiasTorchDataset
+LXMERT_KEYS = ('objects_id', 'boxes', 'features')
+
+
+def _tsv_chunks(fname, chunk_bytes):
+    size = os.path.getsize(fname)
+    starts = list(range(0, size, chunk_bytes)) or [0]
+    return [(fname, start, min(start + chunk_bytes, size)) for start in starts]
+
+
+def _load_tsv_chunk(args):
+    """Decode the rows of the images in img_ids that start in bytes [start, stop) of
+    a tsv file. Rows of other images are skipped by their id, before any decoding.
+    """
+    fname, start, stop, img_ids, keys = args
+    fieldnames = FIELDNAMES_COCO if 'coco' in fname else FIELDNAMES_GOOGLE
+    data = []
+    with open(fname, 'rb') as f:
+        if start > 0:
+            # skip the rest of the row that started in the previous chunk
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < stop:
+            line = f.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue # blank lines, which csv.DictReader skips as well
+            img_id = line[:line.find(b'\t')].decode()
+            if img_ids is not None and img_id not in img_ids:
+                continue
+            item = dict(zip(fieldnames, line.rstrip(b'\r\n').decode().split('\t')))
+            data.append(decode_obj_item(item, keys))
+    return data
+
+
+def load_obj_tsv_parallel(fnames, img_ids=None, keys=LXMERT_KEYS, num_workers=None, chunk_mb=64):
+    """Load the object features of some images from tsv files, on a process pool.
+
+    Each file is split into chunks of about chunk_mb, which the workers read
+    in parallel. They skip the rows of images that are not in img_ids without
+    decoding them.
+
+    :param fnames: The paths to the tsv files.
+    :param img_ids: The ids of the images to load, or None to load all images.
+    :param keys: The array fields to decode, as in decode_obj_item.
+    :param num_workers: The number of processes, by default one per CPU.
+    :return: A list of image object features, as in load_obj_tsv. An image in
+        several rows is loaded from the last one, in the order of fnames.
+    """
+    img_ids = frozenset(img_ids) if img_ids is not None else None
+    chunks = [chunk + (img_ids, keys) for fname in fnames
+              for chunk in _tsv_chunks(fname, int(chunk_mb * 2**20))]
+    num_workers = min(num_workers or os.cpu_count() or 1, len(chunks))
+
+    start_time = time.time()
+    if num_workers <= 1:
+        chunk_data = map(_load_tsv_chunk, chunks)
+    else:
+        with multiprocessing.Pool(num_workers) as pool:
+            chunk_data = pool.map(_load_tsv_chunk, chunks)
+
+    # chunks are in file order, so later rows of an image replace earlier ones
+    data = {item['img_id'] : item for items in chunk_data for item in items}
+    data = list(data.values())
+    elapsed_time = time.time() - start_time
+    print("Loaded %d images from %d files in %d seconds." % (len(data), len(fnames), elapsed_time))
+    return data
+
+
 """ additionally returns object class
 """
 def format_lmdb(env, image_ids):
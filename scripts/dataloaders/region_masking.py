@@ -0,0 +1,36 @@
+''' Masking of image regions by the class of their detected object.
+
+    Whether a class is masked is looked up once per object vocabulary, as a boolean
+    tensor indexed by class, so masking a batch is a gather with the batch's class
+    indices followed by a single masked fill.
+'''
+
+from typing import List
+import torch
+
+
+def region_lookup(obj_list: List[str], words: List[str]):
+    ''' Boolean tensor over obj_list, true for the classes whose label is one of words.
+    '''
+    words = set(words)
+    return torch.tensor([obj in words for obj in obj_list], dtype=torch.bool)
+
+
+def regions_to_mask(lookup: torch.Tensor, obj_indices, num_regions: int):
+    ''' Boolean mask of the regions whose class is true in lookup. The last dimension
+        of obj_indices is cut or padded (with unmasked regions) to num_regions.
+    '''
+    obj_indices = torch.as_tensor(obj_indices)[..., :num_regions].long()
+    mask = lookup.to(obj_indices.device)[obj_indices]
+    if mask.shape[-1] < num_regions:
+        padding = mask.new_zeros(mask.shape[:-1] + (num_regions - mask.shape[-1],))
+        mask = torch.cat((mask, padding), dim=-1)
+    return mask
+
+
+def mask_regions(features: torch.Tensor, lookup: torch.Tensor, obj_indices):
+    ''' Returns a copy of features (..., num_regions, dim) with the regions whose class
+        is true in lookup zeroed, and the number of masked regions per example.
+    '''
+    mask = regions_to_mask(lookup, obj_indices, features.shape[-2])
+    return features.masked_fill(mask.unsqueeze(-1), 0), mask.sum(-1)
@@ -1,5 +1,7 @@
+from collections import OrderedDict
 from typing import List
 import csv
+import os
 import h5py
 import numpy as np
 import copy
@@ -8,6 +10,23 @@ import lmdb # install lmdb by "pip install lmdb"
 import base64
 import pdb
 
+# LMDB environments, with their image ids and id -> index maps, opened once per path
+# and process and shared by all readers of the path
+_LMDB_ENVS = {}
+
+
+def open_lmdb(features_path: str):
+    key = (os.getpid(), os.path.realpath(features_path))
+    if key not in _LMDB_ENVS:
+        env = lmdb.open(features_path, max_readers=1, readonly=True,
+                        lock=False, readahead=False, meminit=False)
+        with env.begin(write=False) as txn:
+            image_ids = pickle.loads(txn.get('keys'.encode()))
+        image_id2index = {image_id : index for index, image_id in enumerate(image_ids)}
+        _LMDB_ENVS[key] = (env, image_ids, image_id2index)
+    return _LMDB_ENVS[key]
+
+
 class ImageFeaturesH5Reader(object):
     """
     A reader for H5 files containing pre-extracted image features. A typical
@@ -28,110 +47,74 @@ class ImageFeaturesH5Reader(object):
     features_h5path : str
         Path to an H5 file containing COCO train / val image features.
     in_memory : bool
-        Whether to load the whole H5 file in memory. Beware, these files are
+        Whether to keep decoded images in memory. Beware, these files are
         sometimes tens of GBs in size. Set this to true if you have sufficient
         RAM - trade-off between speed and memory.
+    cache_size : int
+        With in_memory, the number of decoded images kept, least recently used
+        first out; None keeps all of them.
     """
-    def __init__(self, features_path: str, in_memory: bool = False):
+    def __init__(self, features_path: str, in_memory: bool = False, cache_size: int = None):
         self.features_path = features_path
         self._in_memory = in_memory
+        self._cache_size = cache_size
 
         # with h5py.File(self.features_h5path, "r", libver='latest', swmr=True) as features_h5:
             # self._image_ids = list(features_h5["image_ids"])
-            # If not loaded in memory, then list of None.
-        self.env = lmdb.open(self.features_path, max_readers=1, readonly=True,
-                            lock=False, readahead=False, meminit=False)
+        self.env, self._image_ids, self._image_id2index = open_lmdb(self.features_path)
 
-        with self.env.begin(write=False) as txn:
-            self._image_ids = pickle.loads(txn.get('keys'.encode()))
+        self._cache = OrderedDict() # image id -> decoded image, least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
-        self.features = [None] * len(self._image_ids)
-        self.num_boxes = [None] * len(self._image_ids)
-        self.boxes = [None] * len(self._image_ids)
-        self.boxes_ori = [None] * len(self._image_ids)
-    
     def __len__(self):
         return len(self._image_ids)
 
     def __getitem__(self, image_id):
-        image_id = str(image_id).encode()  
-        index = self._image_ids.index(image_id)
-        if self._in_memory:
-            # Load features during first epoch, all not loaded together as it
-            # has a slow start.
-            if self.features[index] is not None:
-                features = self.features[index]
-                num_boxes = self.num_boxes[index]
-                image_location = self.boxes[index]
-                image_location_ori = self.boxes_ori[index]
-            else:
-                with self.env.begin(write=False) as txn:
-                    item = pickle.loads(txn.get(image_id))
-                    image_id = item['image_id']
-                    image_h = int(item['image_h'])
-                    image_w = int(item['image_w'])
-                    num_boxes = int(item['num_boxes'])
-
-                    features = np.frombuffer(base64.b64decode(item["features"]), dtype=np.float32).reshape(num_boxes, 2048)
-                    boxes = np.frombuffer(base64.b64decode(item['boxes']), dtype=np.float32).reshape(num_boxes, 4)
-                    
-                    g_feat = np.sum(features, axis=0) / num_boxes
-                    num_boxes = num_boxes + 1
-
-                    features = np.concatenate([np.expand_dims(g_feat, axis=0), features], axis=0)
-                    self.features[index] = features
-
-                    image_location = np.zeros((boxes.shape[0], 5), dtype=np.float32)
-                    image_location[:,:4] = boxes
-                    image_location[:,4] = (image_location[:,3] - image_location[:,1]) * (image_location[:,2] - image_location[:,0]) / (float(image_w) * float(image_h))
-
-                    image_location_ori = copy.deepcopy(image_location)
-
-                    image_location[:,0] = image_location[:,0] / float(image_w)
-                    image_location[:,1] = image_location[:,1] / float(image_h)
-                    image_location[:,2] = image_location[:,2] / float(image_w)
-                    image_location[:,3] = image_location[:,3] / float(image_h)
-
-                    g_location = np.array([0,0,1,1,1])
-                    image_location = np.concatenate([np.expand_dims(g_location, axis=0), image_location], axis=0)
-                    self.boxes[index] = image_location
-
-                    g_location_ori = np.array([0,0,image_w,image_h,image_w*image_h])
-                    image_location_ori = np.concatenate([np.expand_dims(g_location_ori, axis=0), image_location_ori], axis=0)
-                    self.boxes_ori[index] = image_location_ori
-                    self.num_boxes[index] = num_boxes               
-        else:
-            # Read chunk from file everytime if not loaded in memory.    
-            with self.env.begin(write=False) as txn:
-                item = pickle.loads(txn.get(image_id))
-                image_id = item['image_id']
-                image_h = int(item['image_h'])
-                image_w = int(item['image_w'])
-                num_boxes = int(item['num_boxes'])
-
-                features = np.frombuffer(base64.b64decode(item["features"]), dtype=np.float32).reshape(num_boxes, 2048)
-                boxes = np.frombuffer(base64.b64decode(item['boxes']), dtype=np.float32).reshape(num_boxes, 4)
-                g_feat = np.sum(features, axis=0) / num_boxes
-                num_boxes = num_boxes + 1
-                features = np.concatenate([np.expand_dims(g_feat, axis=0), features], axis=0)
-                
-                image_location = np.zeros((boxes.shape[0], 5), dtype=np.float32)
-                image_location[:,:4] = boxes
-                image_location[:,4] = (image_location[:,3] - image_location[:,1]) * (image_location[:,2] - image_location[:,0]) / (float(image_w) * float(image_h))
-
-                image_location_ori = copy.deepcopy(image_location)
-                image_location[:,0] = image_location[:,0] / float(image_w)
-                image_location[:,1] = image_location[:,1] / float(image_h)
-                image_location[:,2] = image_location[:,2] / float(image_w)
-                image_location[:,3] = image_location[:,3] / float(image_h)
-
-                g_location = np.array([0,0,1,1,1])
-                image_location = np.concatenate([np.expand_dims(g_location, axis=0), image_location], axis=0)
-
-                g_location_ori = np.array([0,0,image_w,image_h,image_w*image_h])
-                image_location_ori = np.concatenate([np.expand_dims(g_location_ori, axis=0), image_location_ori], axis=0)
-
-        return features, num_boxes, image_location, image_location_ori
+        image_id = str(image_id).encode()
+        if image_id not in self._image_id2index:
+            raise KeyError(f'No features of image {image_id} in {self.features_path}')
+        if not self._in_memory:
+            # Read chunk from file everytime if not loaded in memory.
+            return self._read(image_id)
+
+        # Load features during first epoch, all not loaded together as it
+        # has a slow start.
+        if image_id in self._cache:
+            self.hits += 1
+            self._cache.move_to_end(image_id)
+            return self._cache[image_id]
+        self.misses += 1
+        self._cache[image_id] = self._read(image_id)
+        if self._cache_size is not None and len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+            self.evictions += 1
+        return self._cache[image_id]
+
+    def _read(self, image_id: bytes):
+        with self.env.begin(write=False) as txn:
+            item = pickle.loads(txn.get(image_id))
+        return self._decode(item)
+
+    def _decode(self, item):
+        image_h = int(item['image_h'])
+        image_w = int(item['image_w'])
+        num_boxes = int(item['num_boxes'])
+
+        features = np.frombuffer(base64.b64decode(item["features"]), dtype=np.float32).reshape(num_boxes, 2048)
+        boxes = np.frombuffer(base64.b64decode(item['boxes']), dtype=np.float32).reshape(num_boxes, 4)
+        return add_global_region(features, boxes, image_h, image_w)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits' : self.hits,
+            'misses' : self.misses,
+            'evictions' : self.evictions,
+            'cached' : len(self._cache),
+            'hit_rate' : self.hits / lookups if lookups else 0.
+        }
 
     def keys(self) -> List[int]:
         return self._image_ids
@@ -141,91 +124,61 @@ class ImageFeaturesH5Reader(object):
 class ImageFeaturesH5ReaderWithObjClasses(ImageFeaturesH5Reader):
     """ additionally returns object class
     """
-    def __getitem__(self, image_id):
-        image_id = str(image_id).encode()
-        index = self._image_ids.index(image_id)
-        if self._in_memory:
-            raise Exception('not yet implemented')
-            # Load features during first epoch, all not loaded together as it
-            # has a slow start.
-            if self.features[index] is not None:
-                features = self.features[index]
-                num_boxes = self.num_boxes[index]
-                image_location = self.boxes[index]
-                image_location_ori = self.boxes_ori[index]
-            else:
-                with self.env.begin(write=False) as txn:
-                    item = pickle.loads(txn.get(image_id))
-                    image_id = item['image_id']
-                    image_h = int(item['image_h'])
-                    image_w = int(item['image_w'])
-                    num_boxes = int(item['num_boxes'])
-
-                    features = np.frombuffer(base64.b64decode(item["features"]), dtype=np.float32).reshape(num_boxes, 2048)
-                    boxes = np.frombuffer(base64.b64decode(item['boxes']), dtype=np.float32).reshape(num_boxes, 4)
-                    
-                    g_feat = np.sum(features, axis=0) / num_boxes
-                    num_boxes = num_boxes + 1
-
-                    features = np.concatenate([np.expand_dims(g_feat, axis=0), features], axis=0)
-                    self.features[index] = features
-
-                    image_location = np.zeros((boxes.shape[0], 5), dtype=np.float32)
-                    image_location[:,:4] = boxes
-                    image_location[:,4] = (image_location[:,3] - image_location[:,1]) * (image_location[:,2] - image_location[:,0]) / (float(image_w) * float(image_h))
-
-                    image_location_ori = copy.deepcopy(image_location)
-
-                    image_location[:,0] = image_location[:,0] / float(image_w)
-                    image_location[:,1] = image_location[:,1] / float(image_h)
-                    image_location[:,2] = image_location[:,2] / float(image_w)
-                    image_location[:,3] = image_location[:,3] / float(image_h)
-
-                    g_location = np.array([0,0,1,1,1])
-                    image_location = np.concatenate([np.expand_dims(g_location, axis=0), image_location], axis=0)
-                    self.boxes[index] = image_location
-
-                    g_location_ori = np.array([0,0,image_w,image_h,image_w*image_h])
-                    image_location_ori = np.concatenate([np.expand_dims(g_location_ori, axis=0), image_location_ori], axis=0)
-                    self.boxes_ori[index] = image_location_ori
-                    self.num_boxes[index] = num_boxes               
-        else:
-            # Read chunk from file everytime if not loaded in memory.    
-            with self.env.begin(write=False) as txn:
-                item = pickle.loads(txn.get(image_id))
-                image_id = item['image_id']
-                image_h = int(item['image_h'])
-                image_w = int(item['image_w'])
-                num_boxes = int(item['num_boxes'])
-
-                features = np.frombuffer(base64.b64decode(item["features"]), dtype=np.float32)\
-                             .reshape(num_boxes, 2048)
-                boxes = np.frombuffer(base64.b64decode(item['boxes']), dtype=np.float32)\
-                          .reshape(num_boxes, 4)
-                cls_indices = np.frombuffer(base64.b64decode(item['classes'])).astype(np.int32)
-                    
-                g_feat = np.sum(features, axis=0) / num_boxes
-                num_boxes = num_boxes + 1
-                features = np.concatenate([np.expand_dims(g_feat, axis=0), features], axis=0)
-                
-                image_location = np.zeros((boxes.shape[0], 5), dtype=np.float32)
-                image_location[:,:4] = boxes
-                image_location[:,4] = (image_location[:,3] - image_location[:,1]) * (image_location[:,2] - image_location[:,0]) / (float(image_w) * float(image_h))
-
-                image_location_ori = copy.deepcopy(image_location)
-                image_location[:,0] = image_location[:,0] / float(image_w)
-                image_location[:,1] = image_location[:,1] / float(image_h)
-                image_location[:,2] = image_location[:,2] / float(image_w)
-                image_location[:,3] = image_location[:,3] / float(image_h)
-
-                g_location = np.array([0,0,1,1,1])
-                image_location = np.concatenate([np.expand_dims(g_location, axis=0), image_location], axis=0)
-
-                g_location_ori = np.array([0,0,image_w,image_h,image_w*image_h])
-                image_location_ori = np.concatenate([np.expand_dims(g_location_ori, axis=0), image_location_ori], axis=0)
-
+    def _decode(self, item):
+        features, num_boxes, image_location, image_location_ori = super()._decode(item)
+        cls_indices = np.frombuffer(base64.b64decode(item['classes'])).astype(np.int32)
         return features, num_boxes, image_location, image_location_ori, cls_indices
 
-    def keys(self) -> List[int]:
-        return self._image_ids
 
+def add_global_region(features, boxes, image_h: int, image_w: int):
+    """
+    Prepend the mean of the region features and the whole-image box to the regions
+    of an image. Returns (features, num_boxes,
+    image_location, image_location_ori).
+    """
+    num_boxes = len(features)
+    g_feat = np.sum(features, axis=0, dtype=np.float32) / num_boxes
+    features = np.concatenate([np.expand_dims(g_feat, axis=0), features], axis=0).astype(np.float32, copy=False)
+
+    image_location = np.zeros((boxes.shape[0], 5), dtype=np.float32)
+    image_location[:,:4] = boxes
+    image_location[:,4] = (image_location[:,3] - image_location[:,1]) * (image_location[:,2] - image_location[:,0]) / (float(image_w) * float(image_h))
+
+    image_location_ori = copy.deepcopy(image_location)
+    image_location[:,0] = image_location[:,0] / float(image_w)
+    image_location[:,1] = image_location[:,1] / float(image_h)
+    image_location[:,2] = image_location[:,2] / float(image_w)
+    image_location[:,3] = image_location[:,3] / float(image_h)
+
+    g_location = np.array([0,0,1,1,1])
+    image_location = np.concatenate([np.expand_dims(g_location, axis=0), image_location], axis=0)
+
+    g_location_ori = np.array([0,0,image_w,image_h,image_w*image_h])
+    image_location_ori = np.concatenate([np.expand_dims(g_location_ori, axis=0), image_location_ori], axis=0)
+    return features, num_boxes + 1, image_location, image_location_ori
+
+
+class ImageFeaturesPackReader(object):
+    """
+    Same outputs as ImageFeaturesH5ReaderWithObjClasses, read from a feature pack
+    (see dataloaders/feature_pack.py) without any decoding.
+    """
+    def __init__(self, features_path: str):
+        from ..feature_pack import FeaturePack
+        self.features_path = features_path
+        self.pack = FeaturePack(features_path)
+        # region masking needs the object class of every box
+        if self.pack.classes is None:
+            raise ValueError(f'Feature pack {features_path} has no classes.npy; ViLBERT needs the object class ids')
+
+    def __len__(self):
+        return len(self.pack)
+
+    def __getitem__(self, image_id):
+        item = self.pack[str(image_id)]
+        features, num_boxes, image_location, image_location_ori = add_global_region(
+            item['features'], item['boxes'], item['img_h'], item['img_w'])
+        return features, num_boxes, image_location, image_location_ori, item['objects_id'].astype(np.int32)
+
+    def keys(self) -> List[int]:
+        return [str(image_id).encode() for image_id in self.pack.keys()]
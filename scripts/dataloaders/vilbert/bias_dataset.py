@@ -2,9 +2,13 @@ import tensorpack.dataflow as td
 import torch
 from torch.utils.data import Dataset
 
+from ..region_masking import region_lookup, regions_to_mask
 from ..tokenization import BertTokenizer
 import re
 
+# object classes of the image regions that are masked
+PERSON_CLASSES = ['man', 'woman', 'person']
+
 def iou(anchors, gt_boxes):
     """
     anchors: (N, 4) ndarray of float
@@ -205,6 +209,7 @@ class BertPreprocessBatch(object):
         self.image_features = image_features
         self.imageid2filepath = imageid2filepath
         self.predict_feature = predict_feature
+        self.person_regions = region_lookup(obj_list, PERSON_CLASSES)
 
     def __call__(self, data):
         caption = data['caption']
@@ -379,20 +384,11 @@ class BertPreprocessBatch(object):
                 )
         return output_label
 
-    def mask_region(self, image_feat, num_boxes, cls_indices, obj_list):        
+    def mask_region(self, image_feat, num_boxes, cls_indices, obj_list):
         """
+        Returns a copy of image_feat with the regions of people zeroed, and a label per
+        box: 1 if masked, -1 otherwise (ignored by the loss function later).
         """
-        output_label = []
-        for i in range(num_boxes):
-            cls_idx = cls_indices[i]
-            cls = obj_list[cls_idx]
-            
-            if cls == 'man' or cls == 'woman' or cls == 'person':
-                i1 = image_feat[i].sum().item()
-                image_feat[i] = 0
-                output_label.append(1)
-            else:
-                # no masking token (will be ignored by loss function later)
-                output_label.append(-1)
-
-        return image_feat, output_label
\ No newline at end of file
+        mask = regions_to_mask(self.person_regions, cls_indices[:num_boxes], len(image_feat))
+        masked_image_feat = torch.as_tensor(image_feat).masked_fill(mask.unsqueeze(-1), 0)
+        return masked_image_feat.numpy(), (mask[:num_boxes].long() * 2 - 1).tolist()
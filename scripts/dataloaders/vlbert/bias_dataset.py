@@ -103,34 +103,17 @@ class BiasDataset(Dataset):
             ]
 
     def __getitem__(self, index):
-        # image data
+        # image data, decoded by decode_image_features
         example = self.examples[index]
         frcnn_data = self.image_features[example['image_id']]
-        boxes = np.frombuffer(base64.b64decode(frcnn_data['boxes']),
-                              dtype=np.float32).reshape((int(frcnn_data['num_boxes']), -1))
-        boxes_cls_scores = np.frombuffer(base64.b64decode(frcnn_data['classes']),
-                                         dtype=np.float32).reshape((int(frcnn_data['num_boxes']), -1))
-        
-        boxes_max_conf = boxes_cls_scores.max(axis=1)
-        inds = np.argsort(boxes_max_conf)[::-1]
-        boxes = boxes[inds]
-        boxes_cls_scores = boxes_cls_scores[inds]
-        boxes = torch.as_tensor(boxes)
+        regions = frcnn_data['regions']
+        boxes_cls_zeros = frcnn_data['cls_zeros']
 
         #
         image = None
-        w0, h0 = float(frcnn_data['image_w']), float(frcnn_data['image_h'])
-        boxes_features = np.frombuffer(self.b64_decode(frcnn_data['features']),
-                                    dtype=np.float32).reshape((int(frcnn_data['num_boxes']), -1))
-        boxes_features = boxes_features[inds]
-        boxes_features = torch.as_tensor(boxes_features)
-
+        w0, h0 = frcnn_data['image_w'], frcnn_data['image_h']
         if self.add_image_as_a_box:
-            image_box = torch.as_tensor([[0.0, 0.0, w0 - 1.0, h0 - 1.0]])
-            boxes = torch.cat((image_box, boxes), dim=0)
-            if self.with_precomputed_visual_feat:
-                image_box_feat = boxes_features.mean(dim=0, keepdim=True)
-                boxes_features = torch.cat((image_box_feat, boxes_features), dim=0)
+            regions = torch.cat((frcnn_data['image_region'], regions), dim=0)
 
         # no transform because we're loading features directly
         im_info = torch.tensor([w0, h0, 1.0, 1.0, index])
@@ -140,25 +123,19 @@ class BiasDataset(Dataset):
             h = int(im_info[1].item())
             image = im_info.new_zeros((3, h, w), dtype=torch.float)
 
-        # clamp boxes
-        w = im_info[0].item()
-        h = im_info[1].item()
-        boxes[:, [0, 2]] = boxes[:, [0, 2]].clamp(min=0, max=w-1)
-        boxes[:, [1, 3]] = boxes[:, [1, 3]].clamp(min=0, max=h-1)
-
         caption_tokens = self.tokenizer.tokenize(example['caption'])
         text_tokens = ['[CLS]'] + caption_tokens + ['[SEP]']
         text_ids = self.tokenizer.convert_tokens_to_ids(text_tokens)
         mlm_labels = [1] * len(text_ids)
 
-        if self.with_precomputed_visual_feat:
-            boxes = torch.cat((boxes, boxes_features), dim=1)
+        # boxes, followed by their features
+        boxes = regions if self.with_precomputed_visual_feat else regions[:, :4]
 
         # set defaults for no-image
         relationship_label = 1
         mvrc_ops = [0] * boxes.shape[0]
-        mvrc_labels = [np.zeros_like(boxes_cls_scores[0])] * boxes.shape[0]
-        object_labels = torch.tensor(np.frombuffer(base64.b64decode(frcnn_data['classes'])).astype(np.int32))
+        mvrc_labels = [boxes_cls_zeros] * boxes.shape[0]
+        object_labels = frcnn_data['object_labels']
 
         # truncate seq to max len
         if len(text_ids) + len(boxes) > self.seq_len:
@@ -216,6 +193,48 @@ class BiasDataset(Dataset):
     def b64_decode(string):
         return base64.decodebytes(string.encode())
 
+    @staticmethod
+    def decode_image_features(frcnn_data):
+        """
+        Decode the boxes, features and classes of an image once: the boxes sorted by
+        their highest class score and clamped to the image, each followed by its
+        features, and the image as a box with the mean of the features.
+
+        :param frcnn_data: the fields of a row of a feature tsv, named by tsv_names
+        :return: a dict of image_w, image_h, regions, image_region, cls_zeros (a
+            zero row of class scores) and object_labels
+        """
+        num_boxes = int(frcnn_data['num_boxes'])
+        boxes = np.frombuffer(base64.b64decode(frcnn_data['boxes']),
+                              dtype=np.float32).reshape((num_boxes, -1))
+        boxes_cls_scores = np.frombuffer(base64.b64decode(frcnn_data['classes']),
+                                         dtype=np.float32).reshape((num_boxes, -1))
+
+        boxes_max_conf = boxes_cls_scores.max(axis=1)
+        inds = np.argsort(boxes_max_conf)[::-1]
+        boxes = torch.as_tensor(boxes[inds])
+
+        w0, h0 = float(frcnn_data['image_w']), float(frcnn_data['image_h'])
+        boxes_features = np.frombuffer(BiasDataset.b64_decode(frcnn_data['features']),
+                                       dtype=np.float32).reshape((num_boxes, -1))
+        boxes_features = torch.as_tensor(boxes_features[inds])
+
+        # clamp boxes, to the sizes as they are stored in im_info
+        w, h = torch.tensor([w0, h0]).tolist()
+        boxes[:, [0, 2]] = boxes[:, [0, 2]].clamp(min=0, max=w-1)
+        boxes[:, [1, 3]] = boxes[:, [1, 3]].clamp(min=0, max=h-1)
+
+        image_box = torch.as_tensor([[0.0, 0.0, w0 - 1.0, h0 - 1.0]])
+        image_box_feat = boxes_features.mean(dim=0, keepdim=True)
+        return {
+            'image_w' : w0,
+            'image_h' : h0,
+            'regions' : torch.cat((boxes, boxes_features), dim=1),
+            'image_region' : torch.cat((image_box, image_box_feat), dim=1),
+            'cls_zeros' : np.zeros_like(boxes_cls_scores[0]),
+            'object_labels' : torch.tensor(np.frombuffer(base64.b64decode(frcnn_data['classes'])).astype(np.int32))
+        }
+
     @staticmethod
     def group_aspect(database):
         print('grouping aspect...')
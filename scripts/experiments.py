@@ -0,0 +1,291 @@
+''' The WEAT experiments on a bias test's encodings.
+
+    Everything here only needs numpy and scipy (torch is used if present), so the
+    statistics can be rerun on exported encodings without loading any models:
+    BiasTest subclasses WEATExperiments for main.py, and EncodedTest does the same
+    for encodings loaded by scripts.stats.
+'''
+
+import json
+import logging as log
+from typing import Dict
+from warnings import warn
+import numpy as np
+
+from .weat.weat_images_union import run_test as weat_union
+from .weat.weat_images_union import run_test_shared as weat_union_shared
+from .weat.weat_images_targ_specific import run_test as weat_specific
+from .weat.weat_images_targ_specific import run_test_shared as weat_specific_shared
+from .weat.weat_images_intra_targ import run_test as weat_intra
+from .weat.general_vals import get_general_vals
+from .weat.permutation import DEFAULT_CHUNK_SIZE, DEFAULT_MAX_EXACT_PARTITIONS, partition_pvalues
+from .weat.backend import BACKENDS, DEFAULT_BACKEND
+
+# encodings BiasTest.encode_data returns for each test (and hidden layer)
+ENCODING_SETS = ['targ_X', 'targ_Y', 'attr_AX', 'attr_AY', 'attr_BX', 'attr_BY']
+ENCODING_KEYS = (list(ENCODING_SETS) +
+                 [name + '_mask_t' for name in ENCODING_SETS] +
+                 [name + '_mask_v' for name in ENCODING_SETS] +
+                 ['contextual_' + name for name in ENCODING_SETS])
+
+
+def add_stats_args(parser, default_backend: str=DEFAULT_BACKEND):
+    ''' Options of the statistics, shared by main.py and scripts.stats.
+    '''
+    parser.add_argument('--num_samples', type=int, default=100000, help='num/samples for p-val permutation test')
+    parser.add_argument('--permutation_chunk_size', type=int, default=10000, help='num/partitions drawn per batch in permutation test; bounds memory')
+    parser.add_argument('--seed', type=int, default=None, help='master seed for permutation sampling; results do not depend on --sampling_workers')
+    parser.add_argument('--sampling_workers', type=int, default=1, help='num/processes for permutation sampling')
+    parser.add_argument('--shared_draws', action='store_true', help='one shared set of permutation draws for experiments 1, 2 and 4 of each test')
+    parser.add_argument('--stop_alpha', type=float, default=None, help='stop sampling once the p-value interval is entirely above or below this alpha')
+    parser.add_argument('--stop_precision', type=float, default=None, help='stop sampling once the p-value interval has at most this half-width')
+    parser.add_argument('--parametric', action='store_true', help='closed-form normal approximation to the permutation test, for fast screening')
+    parser.add_argument('--edgeworth', action='store_true', help='with --parametric, correct for skewness and kurtosis of the null')
+    parser.add_argument('--max_exact_partitions', type=int, default=10**9, help='use the exact permutation test if there are at most this many partitions')
+    parser.add_argument('--exact_workers', type=int, default=1, help='num/processes for the exact permutation test')
+    parser.add_argument('--dp_resolution', type=float, default=None, help='if set, exact p-values by dynamic programming over s(w,A,B) rounded to this resolution')
+    parser.add_argument('--backend', type=str, default=default_backend, choices=BACKENDS, help='array backend for WEAT statistics')
+    parser.add_argument('--cossim_tile_size', type=int, default=None, help='num/attribute vectors per cosine similarity tile; default is a single matmul')
+    parser.add_argument('--centroid', action='store_true', help='score targets against attribute centroids; never builds the full cossim matrix')
+    parser.add_argument('--stats_threads', type=int, default=None, help='num/threads for the CPU statistics backends')
+
+
+class WEATExperiments:
+    ''' Runs experiments 1-4 on the encodings of one bias test; subclasses set
+        test_name, test_types and category_X, category_Y, category_A, category_B.
+    '''
+    def init_weat_options(self, params: Dict):
+        # options forwarded to every WEAT run
+        self.weat_kwargs = {
+            'chunk_size' : params.get('permutation_chunk_size', DEFAULT_CHUNK_SIZE),
+            'backend' : params.get('backend', DEFAULT_BACKEND),
+            'tile_size' : params.get('cossim_tile_size'),
+            'centroid' : params.get('centroid', False),
+            'alpha' : params.get('stop_alpha'),
+            'precision' : params.get('stop_precision'),
+            'seed' : params.get('seed'),
+            'sampling_workers' : params.get('sampling_workers', 1)
+        }
+        # options for the tests that partition the targets X u Y (not intra-target)
+        self.partition_kwargs = {
+            'parametric' : params.get('parametric', False),
+            'edgeworth' : params.get('edgeworth', False),
+            'max_exact_partitions' : params.get('max_exact_partitions', DEFAULT_MAX_EXACT_PARTITIONS),
+            'exact_workers' : params.get('exact_workers', 1),
+            'dp_resolution' : params.get('dp_resolution')
+        }
+
+    def _get_revelant_encodings(self, test_type: str, encodings: Dict):
+        if test_type == 'word' or test_type == 'sentence':
+            X =  encodings['targ_X']
+            Y =  encodings['targ_Y']
+            AX = encodings['attr_AX']
+            AY = encodings['attr_AY']
+            BX = encodings['attr_BX']
+            BY = encodings['attr_BY']
+        elif test_type == 'contextual':
+            X =  encodings['contextual_targ_X']
+            Y =  encodings['contextual_targ_Y']
+            AX = encodings['contextual_attr_AX']
+            AY = encodings['contextual_attr_AY']
+            BX = encodings['contextual_attr_BX']
+            BY = encodings['contextual_attr_BY']
+        elif test_type == 'mask_t':
+            X =  encodings['targ_X_mask_t']
+            Y =  encodings['targ_Y_mask_t']
+            AX = encodings['attr_AX_mask_t']
+            AY = encodings['attr_AY_mask_t']
+            BX = encodings['attr_BX_mask_t']
+            BY = encodings['attr_BY_mask_t']
+        elif test_type == 'mask_v':
+            X =  encodings['targ_X_mask_v']
+            Y =  encodings['targ_Y_mask_v']
+            AX = encodings['attr_AX_mask_v']
+            AY = encodings['attr_AY_mask_v']
+            BX = encodings['attr_BX_mask_v']
+            BY = encodings['attr_BY_mask_v']
+        else:
+            raise Exception(f'Unknown test type: {test_type}')
+        return X, Y, AX, AY, BX, BY
+    
+    
+    def run_weat_union(self, encodings: Dict, num_samples: int):
+        results = {}
+        for test_type in self.test_types:
+            X, Y, AX, AY, BX, BY = self._get_revelant_encodings(test_type, encodings)
+            esize, pval = weat_union(X, Y, AX, AY, BX, BY, num_samples,
+                                     self.category_X, self.category_Y,
+                                     self.category_A, self.category_B,
+                                     **self.weat_kwargs, **self.partition_kwargs)
+            results[test_type] = (esize, pval)
+        return results
+
+    def run_weat_specific(self, encodings: Dict, num_samples: int):
+        results = {}
+        for test_type in self.test_types:
+            X, Y, AX, AY, BX, BY = self._get_revelant_encodings(test_type, encodings)
+            esize, pval = weat_specific(X, Y, AX, AY, BX, BY, num_samples,
+                                        self.category_X, self.category_Y,
+                                        self.category_A, self.category_B,
+                                        **self.weat_kwargs, **self.partition_kwargs)
+            results[test_type] = (esize, pval)
+        return results
+        
+    def run_weat_intra(self, encodings: Dict, num_samples: int):
+        results = {}
+        for test_type in self.test_types:
+            X, Y, AX, AY, BX, BY = self._get_revelant_encodings(test_type, encodings)
+            esize_x, pval_x, esize_y, pval_y =\
+                        weat_intra(X, Y, AX, AY, BX, BY, num_samples,
+                                   self.category_X, self.category_Y,
+                                   self.category_A, self.category_B,
+                                   **self.weat_kwargs)
+            results[test_type] = (esize_x, pval_x, esize_y, pval_y)
+        return results
+
+    def run_weat_mask(self, encodings: Dict, num_samples: int):
+        results = {}
+        for mask_type in ['mask_t', 'mask_v']:
+            X, Y, AX, AY, BX, BY = self._get_revelant_encodings(mask_type, encodings)
+            if len(X) == 0:
+                warn(f'Length is zero for X for {mask_type}')
+                continue
+            test_type = 'word' if 'word' in self.test_types else 'sent'
+            esize, pval = weat_union(X, Y, AX, AY, BX, BY, num_samples,
+                                     self.category_X, self.category_Y,
+                                     self.category_A, self.category_B,
+                                     **self.weat_kwargs, **self.partition_kwargs)
+            results[mask_type] = (esize, pval, test_type)
+        return results
+    
+    def run_weat_shared(self, encodings: Dict, num_samples: int, include_mask: bool=False):
+        ''' Experiments 1, 2 and (with include_mask) 4 with one shared set of
+            permutation draws for every (experiment, test type) pair, instead of
+            sampling separately for each. Returns the results of run_weat_union,
+            run_weat_specific and run_weat_mask (empty if not include_mask).
+        '''
+        lookup_kwargs = {k : self.weat_kwargs[k] for k in ('backend', 'tile_size', 'centroid')}
+        categories = (self.category_X, self.category_Y, self.category_A, self.category_B)
+        keys, esizes, tests = [], [], []
+        for test_type in self.test_types:
+            X, Y, AX, AY, BX, BY = self._get_revelant_encodings(test_type, encodings)
+            for experiment, run_test in (('union', weat_union_shared), ('specific', weat_specific_shared)):
+                esize, test = run_test(X, Y, AX, AY, BX, BY, *categories, **lookup_kwargs)
+                keys.append((experiment, test_type))
+                esizes.append(esize)
+                tests.append(test)
+        if include_mask:
+            for mask_type in ['mask_t', 'mask_v']:
+                X, Y, AX, AY, BX, BY = self._get_revelant_encodings(mask_type, encodings)
+                if len(X) == 0:
+                    warn(f'Length is zero for X for {mask_type}')
+                    continue
+                esize, test = weat_union_shared(X, Y, AX, AY, BX, BY, *categories, **lookup_kwargs)
+                keys.append(('mask', mask_type))
+                esizes.append(esize)
+                tests.append(test)
+
+        pvals = partition_pvalues(tests, num_samples,
+                                  chunk_size=self.weat_kwargs['chunk_size'],
+                                  alpha=self.weat_kwargs['alpha'],
+                                  precision=self.weat_kwargs['precision'],
+                                  seed=self.weat_kwargs['seed'],
+                                  sampling_workers=self.weat_kwargs['sampling_workers'],
+                                  **self.partition_kwargs)
+        results = {'union' : {}, 'specific' : {}, 'mask' : {}}
+        mask_test_type = 'word' if 'word' in self.test_types else 'sent'
+        for (experiment, test_type), esize, pval in zip(keys, esizes, pvals):
+            if experiment == 'mask':
+                results[experiment][test_type] = (esize, pval, mask_test_type)
+            else:
+                results[experiment][test_type] = (esize, pval)
+        return results['union'], results['specific'], results['mask']
+
+    def get_general_vals(self, encodings: Dict, num_samples: int): # TODO rename
+        results = {}
+        for test_type in self.test_types:
+            X, Y, AX, AY, BX, BY = self._get_revelant_encodings(test_type, encodings)
+            vals = get_general_vals(X, Y, AX, AY, BX, BY, n_samples=num_samples)
+            results[test_type] = vals
+        return results
+
+
+class EncodedTest(WEATExperiments):
+    ''' A bias test whose encodings were exported by main.py --export_encodings.
+    '''
+    def __init__(self, params: Dict, meta: Dict):
+        self.test_name = meta['test_name']
+        self.test_types = meta['test_types']
+        self.category_X = meta['category_X']
+        self.category_Y = meta['category_Y']
+        self.category_A = meta['category_A']
+        self.category_B = meta['category_B']
+        self.init_weat_options(params)
+
+
+def save_encodings(path: str, test: WEATExperiments, encodings: Dict):
+    ''' Save the encodings of a test to an .npz file, one (n, d) array per
+        encoding set (rows in key order) and the test's metadata as JSON.
+    '''
+    meta = {
+        'test_name' : test.test_name,
+        'test_types' : test.test_types,
+        'category_X' : test.category_X,
+        'category_Y' : test.category_Y,
+        'category_A' : test.category_A,
+        'category_B' : test.category_B
+    }
+    arrays = {}
+    for key in ENCODING_KEYS:
+        encs = encodings[key]
+        arrays[key] = np.stack([np.asarray(encs[i], dtype=np.float32) for i in sorted(encs)]) \
+                      if encs else np.zeros((0, 0), dtype=np.float32)
+    np.savez(path, __meta__=np.array(json.dumps(meta)), **arrays)
+
+
+def load_encodings(path: str):
+    ''' Inverse of save_encodings. Returns (meta, encodings).
+    '''
+    with np.load(path) as data:
+        meta = json.loads(str(data['__meta__']))
+        encodings = {key : {i : row for i, row in enumerate(data[key])} for key in ENCODING_KEYS}
+    return meta, encodings
+
+
+def run_experiments(test: WEATExperiments, encodings: Dict, params: Dict, writer):
+    ''' Run all four experiments on a test's encodings and add the results to writer.
+    '''
+    num_samples = params.get('num_samples')
+    shared_draws = params.get('shared_draws')
+    include_mask = 'sentence' in test.test_types or 'sent' in test.test_types # TODO all sentence or all sent
+    if shared_draws:
+        log.info('Running experiments 1, 2 and 4 on shared permutation draws')
+        union_results, specific_results, mask_results = test.run_weat_shared(
+            encodings, num_samples, include_mask)
+
+    log.info('Running experiment 1: union across attribute A_{X} and A_{Y}')
+    results = union_results if shared_draws else test.run_weat_union(encodings, num_samples)
+    for test_type, (esize, pval) in results.items():
+        writer.add_results_exp1(test.test_name, test_type, esize, pval)
+
+    log.info('\n\n')
+    log.info('Running experiment 2: corresponding attributes s(X, A_{X}, B_{X}) and s(Y, A_{Y}, B_{Y})')
+    results = specific_results if shared_draws else test.run_weat_specific(encodings, num_samples)
+    for test_type, (esize, pval) in results.items():
+        writer.add_results_exp2(test.test_name, test_type, esize, pval)
+
+    log.info('\n\n')
+    log.info('Running experiment 3: intra-target across target-specific attributes')
+    results = test.run_weat_intra(encodings, num_samples)
+    for test_type, (esize_x, pval_x, esize_y, pval_y) in results.items():
+        writer.add_results_exp3(test.test_name, test_type, esize_x, pval_x, esize_y, pval_y)
+    
+    if include_mask:
+        log.info('Running experiment 4a: masked language and 4b: masked vision')
+        results = mask_results if shared_draws else test.run_weat_mask(encodings, num_samples)
+        mask_t_esize, mask_t_pval, test_type = results['mask_t']
+        writer.add_results_exp4_mask_t(test.test_name, test_type, mask_t_esize, mask_t_pval)
+        
+        if 'mask_v' in results:
+            mask_v_esize,mask_v_pval,test_type = results['mask_v']
+            writer.add_results_exp4_mask_v(test.test_name, test_type, mask_v_esize, mask_v_pval)
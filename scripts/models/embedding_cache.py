@@ -0,0 +1,200 @@
+''' On-disk cache of encodings, so that reruns only encode new (caption, image) pairs.
+
+    Layout under <cache_dir>/<model_type>/<checkpoint id>/:
+        <variant>_<kind>.f32 : append-only float32 rows, one encoding per row
+        <variant>_<kind>.idx : append-only 16-byte keys, the i-th key for the i-th row
+        <variant>_<kind>.dim : encoding dimension
+        <variant>_<kind>.lock : held while appending, so that concurrent runs can share a store
+        written.* : per key, which of the stores above it was written to, appended last
+    where variant is full, mask_t or mask_v (as returned by ModelWrapper.encode) and
+    kind is full_seq or contextual. A key hashes (layer, caption token ids, image id,
+    masked words, image feature source, encoding options), so each store only ever
+    grows and rows are never rewritten.
+    Cached rows are returned as tensors over a copy-on-write memmap, without copying.
+'''
+
+import fcntl
+import hashlib
+import json
+import os
+from os import path
+from typing import Any, Dict, List
+import numpy as np
+import torch
+from ..dataloaders.feature_store import source_mtime
+
+VARIANTS = ['full', 'mask_t', 'mask_v'] # order of the outputs of ModelWrapper.encode
+KINDS = ['full_seq', 'contextual']
+KEY_BYTES = 16
+# params besides the checkpoint that change what the model wrappers encode
+ENCODING_PARAMS = ['max_seq_length', 'bert_model_name', 'do_lower_case', 'dataset_type',
+                   'model_config', 'model_config_path', 'coco_ontology', 'path_to_obj_list']
+
+
+def checkpoint_id(checkpoint: str):
+    ''' Short id of a checkpoint: a local file or directory is identified by its
+        path, size and modification time (cheap to compute for multi-GB archives),
+        anything else (e.g. a hub model name) by its name.
+    '''
+    if path.exists(checkpoint):
+        stat = os.stat(checkpoint)
+        checkpoint = f'{path.realpath(checkpoint)}:{stat.st_size}:{stat.st_mtime_ns}'
+    return hashlib.sha1(checkpoint.encode()).hexdigest()[:16]
+
+
+def file_id(value: Any):
+    ''' A param as it goes into the cache keys: a path to a file by its path, size and
+        modification time, since the file (e.g. a model config) may change in place.
+    '''
+    if isinstance(value, str) and path.isfile(value):
+        stat = os.stat(value)
+        return (path.realpath(value), stat.st_size, stat.st_mtime_ns)
+    return value
+
+
+def encoding_options(params: Dict[str, Any]):
+    return {name : file_id(params.get(name)) for name in ENCODING_PARAMS}
+
+
+def feature_source_id(source: str):
+    ''' Image feature file, directory or path prefix, by its path and latest modification time.
+    '''
+    if source is None:
+        return None
+    return (path.realpath(source), source_mtime(source))
+
+
+class EmbeddingStore:
+    ''' One append-only, memory-mapped array of encodings with its key index.
+    '''
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self._vectors = None
+        self._load()
+
+    def _load(self):
+        self.dim = None
+        if path.exists(self.prefix + '.dim'):
+            with open(self.prefix + '.dim') as f:
+                self.dim = int(f.read())
+        keys = []
+        if path.exists(self.prefix + '.idx'):
+            with open(self.prefix + '.idx', 'rb') as f:
+                data = f.read()
+            keys = [data[i:i + KEY_BYTES] for i in range(0, len(data) - KEY_BYTES + 1, KEY_BYTES)]
+        # a run interrupted between the two appends leaves extra keys or rows; ignore them
+        self.num_rows = min(len(keys), self._rows_on_disk())
+        self.key2row = {key : row for row, key in enumerate(keys[:self.num_rows])}
+
+    def _rows_on_disk(self):
+        if self.dim is None or not path.exists(self.prefix + '.f32'):
+            return 0
+        return path.getsize(self.prefix + '.f32') // (4 * self.dim)
+
+    def __contains__(self, key: bytes):
+        return key in self.key2row
+
+    def vectors(self):
+        if self._vectors is None or len(self._vectors) < self.num_rows:
+            self._vectors = np.memmap(self.prefix + '.f32', dtype=np.float32, mode='c',
+                                      shape=(self.num_rows, self.dim))
+        return self._vectors
+
+    def get(self, key: bytes):
+        return torch.from_numpy(self.vectors()[self.key2row[key]])
+
+    def add(self, keys: List[bytes], vectors: List[torch.Tensor]):
+        if all(k in self.key2row for k in keys):
+            return
+        # other runs may append to the same store: append under an exclusive lock, after
+        # re-reading what is on disk, so that truncating only ever drops incomplete rows
+        with open(self.prefix + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._load()
+            new = {k : v for k, v in zip(keys, vectors) if k not in self.key2row}
+            if not new:
+                return
+            vectors = torch.stack([v.detach().cpu().float() for v in new.values()]).numpy()
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                with open(self.prefix + '.dim', 'w') as f:
+                    f.write(str(self.dim))
+            # drop anything past the last complete (key, row) pair before appending
+            for suffix, row_bytes in (('.f32', 4 * self.dim), ('.idx', KEY_BYTES)):
+                if path.exists(self.prefix + suffix):
+                    os.truncate(self.prefix + suffix, self.num_rows * row_bytes)
+            with open(self.prefix + '.f32', 'ab') as f:
+                f.write(np.ascontiguousarray(vectors).tobytes())
+            with open(self.prefix + '.idx', 'ab') as f:
+                f.write(b''.join(new))
+            for key in new:
+                self.key2row[key] = self.num_rows
+                self.num_rows += 1
+
+
+class EmbeddingCache:
+    def __init__(self, cache_dir: str, model_type: str, checkpoint: str, options: Dict[str, Any]=None):
+        self.cache_dir = path.join(cache_dir, model_type, checkpoint_id(checkpoint))
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(path.join(self.cache_dir, 'checkpoint.json'), 'w') as f:
+            json.dump({'model_type' : model_type, 'checkpoint' : checkpoint}, f)
+        self.options = sorted((options or {}).items())
+        self.stores = {}
+        self.written = EmbeddingStore(path.join(self.cache_dir, 'written'))
+
+    def store(self, variant: str, kind: str):
+        name = f'{variant}_{kind}'
+        if name not in self.stores:
+            self.stores[name] = EmbeddingStore(path.join(self.cache_dir, name))
+        return self.stores[name]
+
+    def item_keys(self, dataloader, layer: int=-1):
+        ''' Keys of the encodings at a hidden layer of the (caption, image) pairs of a
+            BiasDataLoader, in order.
+            The masked encodings depend on which words get masked, and all of them on
+            the image features and the options of the model wrapper, so these are part
+            of every key as well.
+        '''
+        masked_words = ' '.join(sorted(dataloader.contextual_words_with_people))
+        features = feature_source_id(getattr(dataloader, 'image_features_source', None))
+        keys = []
+        for caption, image_id in dataloader.pairs:
+            token_ids = dataloader.convert_tokens_to_ids(dataloader.tokenizer.tokenize(caption))
+            key = repr((layer, list(token_ids), image_id, masked_words, features, self.options))
+            keys.append(hashlib.blake2b(key.encode(), digest_size=KEY_BYTES).digest())
+        return keys
+
+    def missing(self, keys: List[bytes]):
+        ''' Indices of the keys whose encodings are not all cached: never completely
+            added, or missing from any of the stores they were written to.
+        '''
+        stores = [self.store(variant, kind) for variant in VARIANTS for kind in KINDS]
+        return [i for i, key in enumerate(keys)
+                if key not in self.written or
+                any(flag and key not in store for flag, store in zip(self.written.get(key).tolist(), stores))]
+
+    def add(self, keys: List[bytes], encoded):
+        ''' Store the outputs of ModelWrapper.encode for the pairs with these keys.
+        '''
+        written = torch.zeros(len(keys), len(VARIANTS) * len(KINDS))
+        for v, (variant, enc) in enumerate(zip(VARIANTS, encoded)):
+            for k, kind in enumerate(KINDS):
+                encs = enc[kind]
+                if encs:
+                    idx = sorted(encs)
+                    self.store(variant, kind).add([keys[i] for i in idx], [encs[i] for i in idx])
+                    written[idx, v * len(KINDS) + k] = 1
+        # last, so that a key is only complete once all of its encodings are on disk
+        self.written.add(keys, list(written))
+
+    def get(self, keys: List[bytes]):
+        ''' Cached encodings in the format of ModelWrapper.encode.
+        '''
+        encoded = []
+        for variant in VARIANTS:
+            enc = {}
+            for kind in KINDS:
+                store = self.store(variant, kind)
+                enc[kind] = {i : store.get(key) for i, key in enumerate(keys) if key in store}
+            encoded.append(enc)
+        return tuple(encoded)
@@ -1,12 +1,108 @@
 from attrdict import AttrDict
-from copy import deepcopy
 import re
-from typing import Iterable, Dict, List, Set, Union
+from typing import Callable, Iterable, Dict, List, Set, Union
 import torch
 import torch.nn as nn
 from warnings import warn
 
 class ModelWrapper:
+    # whether encode can return hidden layers other than the output layer
+    supports_layers = False
+
+    def _init_outputs(self, params: AttrDict, num_layers: int=None):
+        # hidden layers to encode, indexed as the model returns them (-1 is the output layer);
+        # the model is only asked for all hidden states when encoding other layers.
+        # Given num_layers, only the last num_layers can be encoded (-num_layers to -1)
+        self.layers = params.get('layers') or [-1]
+        if self.layers != [-1] and not self.supports_layers:
+            raise ValueError(f'{type(self).__name__} only encodes the output layer (--layers -1)')
+        if num_layers is not None and any(not -num_layers <= layer < 0 for layer in self.layers):
+            raise ValueError(f'{type(self).__name__} only encodes layers -{num_layers} to -1, '
+                             f'not {[layer for layer in self.layers if not -num_layers <= layer < 0]}')
+        # attention probabilities are only computed on request; encode then collects them in
+        # self.attentions, {'full' | 'mask_v' | 'mask_t' : [attentions of each batch, on the CPU]}
+        # (with an embedding cache, those of the encoded pairs that were not cached yet)
+        self.output_attentions = params.get('output_attentions', False)
+        self.attentions = None
+
+    def _reset_attentions(self):
+        self.attentions = {'full' : [], 'mask_v' : [], 'mask_t' : []} if self.output_attentions else None
+
+    def _append_attentions(self, outputs: tuple, attentions):
+        # with output_attentions, _forward returns the attention tensors after its outputs,
+        # so that they are split per variant like the outputs in fused forwards
+        if not self.output_attentions:
+            return outputs
+        flat, self._attention_spec = _flatten(attentions)
+        return tuple(outputs) + tuple(flat)
+
+    def _collect_attentions(self, variant: str, output: tuple, num_outputs: int):
+        # the outputs of a _forward, without the attention tensors, which are collected for variant
+        if self.output_attentions:
+            self.attentions[variant].append(
+                _unflatten([tensor.detach().cpu() for tensor in output[num_outputs:]], self._attention_spec))
+        return output[:num_outputs]
+
+    def _init_cache(self, params: AttrDict, checkpoint: str):
+        # encodings are cached on disk if a cache dir is given
+        self.embedding_cache = None
+        if params.get('embedding_cache_dir'):
+            from .embedding_cache import EmbeddingCache, encoding_options
+            self.embedding_cache = EmbeddingCache(params.embedding_cache_dir, params.model_type, checkpoint,
+                                                  encoding_options(params))
+
+    def encode_cached(self, dataloader: Iterable):
+        ''' Same as encode, but only encodes the (caption, image) pairs that are not in
+            the embedding cache yet (for any of self.layers), and adds them to it.
+        '''
+        if getattr(self, 'embedding_cache', None) is None:
+            return self.encode(dataloader)
+        keys = {layer : self.embedding_cache.item_keys(dataloader, layer) for layer in self.layers}
+        missing = sorted(set().union(*(self.embedding_cache.missing(k) for k in keys.values())))
+        num_items = len(dataloader.pairs)
+        print(f'Found {num_items - len(missing)}/{num_items} encodings in cache')
+        if missing:
+            loader = dataloader if len(missing) == num_items else dataloader.subset(missing)
+            encoded = self.encode(loader)
+            for layer in self.layers:
+                self.embedding_cache.add([keys[layer][i] for i in missing], encoded[layer])
+        return {layer : self.embedding_cache.get(keys[layer]) for layer in self.layers}
+
+    def _init_forward_options(self, params: AttrDict):
+        # stack the full, vision-masked and text-masked variants of each batch into one forward
+        self.fused_forward = params.get('fused_forward', False)
+        # most rows per forward in fused mode; halved on running out of GPU memory
+        self.max_forward_rows = params.get('max_forward_rows')
+
+    def _forward_stacked(self, forward: Callable, variants: List[List]):
+        ''' Run `forward` once over several variants of a batch stacked along the batch
+            dimension, in chunks of at most self.max_forward_rows rows.
+            variants: argument lists of the same structure; tensors are stacked, any
+                other argument is taken from the first variant
+            forward: called with a stacked argument list, returns a tuple of batch-first tensors
+        Returns, for each variant, the tuple of its outputs.
+        '''
+        batch_size = next(len(arg) for arg in variants[0] if isinstance(arg, torch.Tensor))
+        stacked = [torch.cat(args) if isinstance(args[0], torch.Tensor) else args[0]
+                   for args in zip(*variants)]
+        total = batch_size * len(variants)
+        while True:
+            rows = min(self.max_forward_rows or total, total)
+            try:
+                outputs = [forward([arg[start:start + rows] if isinstance(arg, torch.Tensor) else arg
+                                    for arg in stacked])
+                           for start in range(0, total, rows)]
+                break
+            except RuntimeError as e:
+                if 'out of memory' not in str(e) or rows == 1:
+                    raise
+                torch.cuda.empty_cache()
+                self.max_forward_rows = rows // 2
+                warn(f'Out of memory with {rows} rows per forward; retrying with {rows // 2}')
+        outputs = [_cat_rows(chunks) for chunks in zip(*outputs)]
+        return [tuple(output[i * batch_size:(i + 1) * batch_size] for output in outputs)
+                for i in range(len(variants))]
+
     def _format_output_single_stream(
         self,
         masked_t_input_ids: Union[List[int], torch.Tensor],
@@ -14,27 +110,26 @@ class ModelWrapper:
         sequence_output: torch.Tensor,
         masked_t_sequence_output: torch.Tensor,
         masked_v_sequence_output: torch.Tensor,
-        enc_full_seq: Dict[int, torch.Tensor],
-        enc_contextual: Dict[int, torch.Tensor],
-        enc_mask_v_full_seq: Dict[int, torch.Tensor],
-        enc_mask_t_full_seq: Dict[int, torch.Tensor]
+        enc_full_seq: '_Rows',
+        enc_contextual: '_Rows',
+        enc_mask_v_full_seq: '_Rows',
+        enc_mask_t_full_seq: '_Rows'
         ):
-        sequence_output = sequence_output.detach().cpu()
-        for idx in range(len(sequence_output)):
-            if self.bidirectional:
-                # take 0-th dim corresponding to CLS token (for words + sents)
-                enc_full_seq[len(enc_full_seq)] = sequence_output[idx][0,:]
-            else:
-                # take last dim corresponding to final token
-                enc_full_seq[len(enc_full_seq)] = sequence_output[idx][-1,:]
-
-            if masked_t_input_ids is not None:
-                index_of_contextual_id = (masked_t_input_ids[idx] == mask_token_id).nonzero()[0].item() # TODO add dim
-                enc_contextual[len(enc_contextual)] = sequence_output[idx][index_of_contextual_id,:]
-            if masked_t_sequence_output is not None:
-                enc_mask_t_full_seq[len(enc_mask_t_full_seq)] = masked_t_sequence_output[idx][0,:]
-            if masked_v_sequence_output is not None:
-                enc_mask_v_full_seq[len(enc_mask_t_full_seq)] = masked_v_sequence_output[idx][0,:]
+        rows = torch.arange(len(sequence_output), device=sequence_output.device)
+        if self.bidirectional:
+            # take 0-th dim corresponding to CLS token (for words + sents)
+            enc_full_seq.add(sequence_output[:, 0])
+        else:
+            # take last dim corresponding to final token
+            enc_full_seq.add(sequence_output[:, -1])
+
+        if masked_t_input_ids is not None:
+            index_of_contextual_id = _first_index(masked_t_input_ids, mask_token_id).to(rows.device)
+            enc_contextual.add(sequence_output[rows, index_of_contextual_id])
+        if masked_t_sequence_output is not None:
+            enc_mask_t_full_seq.add(masked_t_sequence_output[:, 0])
+        if masked_v_sequence_output is not None:
+            enc_mask_v_full_seq.add(masked_v_sequence_output[:, 0])
 
     def _format_output_two_stream(
         self,
@@ -46,42 +141,89 @@ class ModelWrapper:
         masked_v_sequence_output_v: torch.Tensor,
         masked_t_sequence_output_t: torch.Tensor,
         masked_t_sequence_output_v: torch.Tensor,
-        enc_full_seq: Dict[int, torch.Tensor],
-        enc_contextual: Dict[int, torch.Tensor],
-        enc_mask_v_full_seq: Dict[int, torch.Tensor],
-        enc_mask_t_full_seq: Dict[int, torch.Tensor]
+        enc_full_seq: '_Rows',
+        enc_contextual: '_Rows',
+        enc_mask_v_full_seq: '_Rows',
+        enc_mask_t_full_seq: '_Rows'
         ):
-        for idx in range(len(sequence_output_t)):
-            # full access to vision & lang
-            seq_out_t = sequence_output_t[idx]
-            seq_out_v = sequence_output_v[idx]
-            
-            # masked image regions
-            masked_v_seq_out_t = masked_v_sequence_output_t[idx]
-            masked_v_seq_out_v = masked_v_sequence_output_v[idx]
-
-            # masked text ids
-            masked_t_seq_out_t = masked_t_sequence_output_t[idx]
-            masked_t_seq_out_v = masked_t_sequence_output_v[idx]
-
-            # get index of relevant contextual ids; first index of MASK for sub-word tokenized contextual words
-            index_of_target_id = (masked_t_input_ids[idx] == mask_token_id).nonzero()[0].item()
-                    
-            # take 0-th dim corresponding to CLS token (for words + sents)
-            enc_idx = len(enc_full_seq)
-            cat_seq_out = torch.cat((seq_out_t[0,:], seq_out_v[0,:]), dim=0).detach().cpu()
-            cat_masked_v_seq_out = torch.cat((masked_v_seq_out_t[0,:],
-                                              masked_v_seq_out_v[0,:]), dim=0).detach().cpu()
-            cat_masked_t_seq_out = torch.cat((masked_t_seq_out_t[0,:],
-                                              masked_t_seq_out_v[0,:]), dim=0).detach().cpu()
-            
-            # TODO decide about contextual for image
-            enc_full_seq[enc_idx] = cat_seq_out
-            enc_contextual[enc_idx] = seq_out_t[index_of_target_id,:].detach().cpu()
-            enc_mask_v_full_seq[enc_idx] = cat_masked_v_seq_out
-            enc_mask_t_full_seq[enc_idx] = cat_masked_t_seq_out
+        # get index of relevant contextual ids; first index of MASK for sub-word tokenized contextual words
+        rows = torch.arange(len(sequence_output_t), device=sequence_output_t.device)
+        index_of_target_id = _first_index(masked_t_input_ids, mask_token_id).to(rows.device)
+
+        # take 0-th dim corresponding to CLS token (for words + sents) of vision & lang
+        enc_full_seq.add(torch.cat((sequence_output_t[:, 0], sequence_output_v[:, 0]), dim=1))
+        # TODO decide about contextual for image
+        enc_contextual.add(sequence_output_t[rows, index_of_target_id])
+        enc_mask_v_full_seq.add(torch.cat((masked_v_sequence_output_t[:, 0],
+                                           masked_v_sequence_output_v[:, 0]), dim=1))
+        enc_mask_t_full_seq.add(torch.cat((masked_t_sequence_output_t[:, 0],
+                                           masked_t_sequence_output_v[:, 0]), dim=1))
+
+class _Rows:
+    ''' Encodings of one type for a dataloader, written a batch at a time into a
+        preallocated (num_rows, dim) CPU tensor; only the selected rows leave the GPU.
+    '''
+    def __init__(self, num_rows: int):
+        self.num_rows = num_rows
+        self.data = None
+        self.size = 0
+
+    def add(self, rows: torch.Tensor):
+        if self.data is None:
+            self.data = torch.empty((self.num_rows, rows.shape[-1]), dtype=rows.dtype)
+        self.data[self.size:self.size + len(rows)] = rows.detach()
+        self.size += len(rows)
+
+    def as_dict(self):
+        # {index : encoding}, each a view into self.data
+        if self.data is None:
+            return {}
+        return dict(enumerate(self.data[:self.size]))
+
+def _first_index(input_ids: torch.Tensor, token_id: int):
+    # position of the first token_id in each row, which must have one
+    matches = input_ids == token_id
+    if not matches.any(1).all():
+        raise ValueError(f'No token {token_id} in rows {(~matches.any(1)).nonzero().flatten().tolist()} of the batch')
+    return matches.int().argmax(dim=1)
+
+def _empty_encodings(num_rows: int):
+    # (enc, enc_mask_t, enc_mask_v) of one layer, filled by the _format_output_* methods
+    return tuple({'full_seq' : _Rows(num_rows), 'contextual' : _Rows(num_rows)} for _ in range(3))
+
+def _as_dicts(encoded: Dict):
+    # {layer : (enc, enc_mask_t, enc_mask_v)} of _Rows in the format encode returns
+    return {layer : tuple({kind : rows.as_dict() for kind, rows in enc.items()} for enc in encodings)
+            for layer, encodings in encoded.items()}
+
+def _flatten(nested):
+    # the tensors of nested lists and tuples, depth first, and the nesting to rebuild them with
+    if isinstance(nested, (list, tuple)):
+        flat, specs = [], []
+        for item in nested:
+            item_flat, spec = _flatten(item)
+            flat.extend(item_flat)
+            specs.append(spec)
+        return flat, (type(nested), specs)
+    return [nested], None
+
+def _unflatten(flat: List, spec):
+    flat = iter(flat)
+    build = lambda spec: next(flat) if spec is None else spec[0](build(item) for item in spec[1])
+    return build(spec)
+
+def _cat_rows(chunks: List[torch.Tensor]):
+    # chunks of a forward can differ in sequence length (e.g. VL-BERT trims boxes
+    # per batch), so pad dim 1 to the longest; padded positions are never read
+    if chunks[0].dim() > 1:
+        length = max(chunk.shape[1] for chunk in chunks)
+        chunks = [torch.nn.functional.pad(chunk, (0, 0) * (chunk.dim() - 2) + (0, length - chunk.shape[1]))
+                  for chunk in chunks]
+    return torch.cat(chunks)
 
 class VisualBertWrapper(ModelWrapper):
+    supports_layers = True
+
     @staticmethod
     def add_model_args(argparser):
         parser = argparser.add_argument_group('VisualBERT Arguments')
@@ -97,40 +239,45 @@ class VisualBertWrapper(ModelWrapper):
         self.model = VisualBERTInferenceModelWrapper(params)
         self.model.restore_checkpoint_pretrained(params.model_archive)
         self.bidirectional = True
+        self._init_outputs(params)
+        self._init_cache(params, params.model_archive)
+
+    def _forward(self, batch: Dict):
+        ''' Returns the sequence outputs of self.layers.
+        '''
+        all_layers = self.layers != [-1]
+        sequence_output = self.model.step(batch, output_all_encoded_layers=all_layers)['sequence_output']
+        if isinstance(sequence_output, torch.Tensor):
+            return [sequence_output]
+        return [sequence_output[layer] for layer in self.layers]
 
     def encode(self, dataloader: Iterable):
-        enc_full_seq = {} # either word or sentence (depending on input)
-        enc_contextual = {} # word in context
-        enc_mask_t_full_seq = {} # relevant text indices masked
-        enc_mask_t_contextual = {}
+        # {layer : (enc, enc_mask_t, enc_mask_v)}; no visual masking for VisualBERT so enc_mask_v stays empty
+        encoded = {layer : _empty_encodings(len(dataloader.dataset)) for layer in self.layers}
 
         for batch_full_seq in dataloader:
             # 1. with full access to all tokens and all image regions
-            output = self.model.step(batch_full_seq, output_all_encoded_layers=True)
-            sequence_output = output['sequence_output'][-1].cpu().detach()
+            sequence_outputs = self._forward(batch_full_seq)
 
             # 2. with full access to all regions and masked language tokens
             batch_masked_t = dataloader.mask_contextual_words_in_batch(batch_full_seq, input_id_key='bert_input_ids')
-            output = self.model.step(batch_masked_t, output_all_encoded_layers=True)
-            masked_t_sequence_output = output['sequence_output'][-1].cpu()
-
-            self._format_output_single_stream(
-                masked_t_input_ids=batch_masked_t['bert_input_ids'].cpu().detach(),
-                mask_token_id=dataloader.mask_token_id,
-                sequence_output=sequence_output,
-                masked_t_sequence_output=masked_t_sequence_output,
-                masked_v_sequence_output=None,
-                enc_full_seq=enc_full_seq,
-                enc_contextual=enc_contextual,
-                enc_mask_t_full_seq=enc_mask_t_full_seq,
-                enc_mask_v_full_seq=False,
-                )
-
-        enc = {'full_seq' : enc_full_seq, 'contextual' : enc_contextual}
-        enc_mask_t = {'full_seq' : enc_mask_t_full_seq, 'contextual' : enc_mask_t_contextual}
-        # no visual masking for VisualBERT so set to empty dicts
-        enc_mask_v = {'full_seq' : {}, 'contextual' : {}}
-        return enc, enc_mask_t, enc_mask_v
+            masked_t_sequence_outputs = self._forward(batch_masked_t)
+
+            for layer, sequence_output, masked_t_sequence_output in zip(
+                    self.layers, sequence_outputs, masked_t_sequence_outputs):
+                enc, enc_mask_t, _ = encoded[layer]
+                self._format_output_single_stream(
+                    masked_t_input_ids=batch_masked_t['bert_input_ids'],
+                    mask_token_id=dataloader.mask_token_id,
+                    sequence_output=sequence_output,
+                    masked_t_sequence_output=masked_t_sequence_output,
+                    masked_v_sequence_output=None,
+                    enc_full_seq=enc['full_seq'],
+                    enc_contextual=enc['contextual'],
+                    enc_mask_t_full_seq=enc_mask_t['full_seq'],
+                    enc_mask_v_full_seq=None,
+                    )
+        return _as_dicts(encoded)
 
     def predict_words(self, dataloader: Iterable, k: int=3):
         for batch in dataloader:
@@ -169,6 +316,9 @@ class ViLBERTWrapper(ModelWrapper):
         self.model.cuda()
         self.model.eval()
         self.bidirectional = True
+        self._init_outputs(params)
+        self._init_forward_options(params)
+        self._init_cache(params, params.model_archive)
         
         self.BATCH_KEYS = [
             'input_ids', 'input_mask', 'segment_ids', 'lm_label_ids', 'image_feat', 'image_loc', \
@@ -176,49 +326,55 @@ class ViLBERTWrapper(ModelWrapper):
             'masked_image_feat', 'masked_image_label'
             ]
         
+    def _forward(self, args: List[torch.Tensor]):
+        ''' Returns the text and vision sequence outputs for (input_ids, image_feat, image_loc, segment_ids)
+            (and the attention tensors, see _append_attentions).
+        '''
+        output = self.model(
+            *args,
+            return_sequence_output=True,
+            output_all_attention_masks=self.output_attentions
+            )
+        return self._append_attentions(output[-2:], output[-3])
+
     def encode(self, dataloader: Iterable):
-        enc_full_seq = {} # either word or sentence (depending on input)
-        enc_contextual = {} # word in context
-        enc_mask_t_full_seq = {} # relevant text indices masked
-        enc_mask_t_contextual = {}
-        enc_mask_v_full_seq = {} # relevant image regions masked
-        enc_mask_v_contextual = {}
+        encoded = _empty_encodings(len(dataloader.dataset))
+        enc, enc_mask_t, enc_mask_v = encoded
+        enc_full_seq = enc['full_seq'] # either word or sentence (depending on input)
+        enc_contextual = enc['contextual'] # word in context
+        enc_mask_t_full_seq = enc_mask_t['full_seq'] # relevant text indices masked
+        enc_mask_v_full_seq = enc_mask_v['full_seq'] # relevant image regions masked
+        self._reset_attentions()
         
         for batch in dataloader:
             batch = {key:tensor.cuda(non_blocking=True) for key, tensor in zip(self.BATCH_KEYS, batch)}
 
-            # 1. with full access to all tokens and all image regions
-            output = self.model(
-                batch['input_ids'],
-                batch['image_feat'],
-                batch['image_loc'],
-                batch['segment_ids'],
-                return_sequence_output=True,
-                output_all_attention_masks=True
-                )
-            attention_mask, sequence_output_t, sequence_output_v = output[-3:]
-
-            # 2. with full access to all tokens and masked image regions)
-            #masked_v_batch = dataloader.mask_image_features_in_batch(deepcopy(batch), input_id_key='input_ids')
-            masked_v_output = self.model(
-                batch['input_ids'],
-                batch['masked_image_feat'],
-                batch['image_loc'],
-                batch['segment_ids'],
-                return_sequence_output=True
-                )
-            masked_v_sequence_output_t, masked_v_sequence_output_v = masked_v_output[-2:]
-
-            # 3. with full access to all regions and masked language tokens
-            masked_t_batch = dataloader.mask_contextual_words_in_batch(deepcopy(batch), input_id_key='input_ids')
-            masked_t_output = self.model(
-                masked_t_batch['input_ids'],
-                masked_t_batch['image_feat'],
-                masked_t_batch['image_loc'],
-                masked_t_batch['segment_ids'],
-                return_sequence_output=True
-                )
-            masked_t_sequence_output_t, masked_t_sequence_output_v = masked_t_output[-2:]
+            # a shallow copy sharing every tensor but input_ids with batch
+            masked_t_batch = dataloader.mask_contextual_words_in_batch(batch, input_id_key='input_ids')
+            args = ('input_ids', 'image_feat', 'image_loc', 'segment_ids')
+            masked_v_args = ('input_ids', 'masked_image_feat', 'image_loc', 'segment_ids')
+            if self.fused_forward:
+                # 1.-3. in one forward over [full; masked image regions; masked language tokens]
+                output, masked_v_output, masked_t_output = self._forward_stacked(
+                    self._forward,
+                    [[batch[key] for key in args],
+                     [batch[key] for key in masked_v_args],
+                     [masked_t_batch[key] for key in args]]
+                    )
+            else:
+                # 1. with full access to all tokens and all image regions
+                output = self._forward([batch[key] for key in args])
+
+                # 2. with full access to all tokens and masked image regions
+                masked_v_output = self._forward([batch[key] for key in masked_v_args])
+
+                # 3. with full access to all regions and masked language tokens
+                masked_t_output = self._forward([masked_t_batch[key] for key in args])
+            sequence_output_t, sequence_output_v = self._collect_attentions('full', output, 2)
+            masked_v_sequence_output_t, masked_v_sequence_output_v = \
+                self._collect_attentions('mask_v', masked_v_output, 2)
+            masked_t_sequence_output_t, masked_t_sequence_output_v = \
+                self._collect_attentions('mask_t', masked_t_output, 2)
             self._format_output_two_stream(
                 masked_t_batch['input_ids'],
                 dataloader.mask_token_id,
@@ -234,13 +390,11 @@ class ViLBERTWrapper(ModelWrapper):
                 enc_mask_t_full_seq
                 )
 
-        enc = {'full_seq' : enc_full_seq, 'contextual' : enc_contextual}
-        enc_mask_v = {'full_seq' : enc_mask_v_full_seq, 'contextual' : enc_mask_v_contextual}
-        enc_mask_t = {'full_seq' : enc_mask_t_full_seq, 'contextual' : enc_mask_t_contextual}
-
-        return enc, enc_mask_t, enc_mask_v
+        return _as_dicts({-1 : encoded})
 
 class LXMERTWrapper(ModelWrapper): # HuggingFace implementation
+    supports_layers = True
+
     @staticmethod
     def add_model_args(argparser):
         parser = argparser.add_argument_group('Lxmert Arguments')
@@ -253,69 +407,78 @@ class LXMERTWrapper(ModelWrapper): # HuggingFace implementation
         self.model.cuda()
         self.model.eval()
         self.bidirectional = True
+        # the language and vision streams have different depths (L-layers and R-layers)
+        # and only share their last layers, the cross-modality layers, by index from the end
+        self._init_outputs(params, num_layers=self.model.config.x_layers)
+        self._init_forward_options(params)
+        self._init_cache(params, params.bert_model_name)
+
+    def _forward(self, batch: Dict):
+        ''' Returns the language outputs of self.layers followed by their visual outputs
+            (and the attention tensors, see _append_attentions).
+        '''
+        output = self.model(
+            **batch,
+            output_attentions=self.output_attentions,
+            output_hidden_states=self.layers != [-1],
+            return_outputs=True,
+            return_sequence_output=True
+            )
+        if self.layers == [-1]:
+            outputs = (output.lang_output, output.visual_output)
+        else:
+            outputs = tuple(output.language_hidden_states[layer] for layer in self.layers) + \
+                      tuple(output.vision_hidden_states[layer] for layer in self.layers)
+        return self._append_attentions(outputs, (output.language_attentions, output.vision_attentions,
+                                                 output.cross_encoder_attentions) if self.output_attentions else None)
 
     def encode(self, dataloader: Iterable):
-        enc_full_seq = {} # either word or sentence (depending on input)
-        enc_contextual = {} # word in context
-        enc_mask_t_full_seq = {} # relevant text indices masked
-        enc_mask_t_contextual = {}
-        enc_mask_v_full_seq = {} # relevant image regions masked
-        enc_mask_v_contextual = {}
+        encoded = {layer : _empty_encodings(len(dataloader.dataset)) for layer in self.layers} # {layer : (enc, enc_mask_t, enc_mask_v)}
+        self._reset_attentions()
 
         for batch_full_access in dataloader:
-            # 1. with full access to all tokens and all image regions
             #batch_full_access = dataloader.format_batch(deepcopy(batch))
             obj_indices = batch_full_access.pop('obj_indices')
-            output = self.model(
-                **batch_full_access,
-                output_attentions=True,
-                output_hidden_states=True,
-                return_outputs=True,
-                return_sequence_output=True
-                )
-            sequence_output_t = output.lang_output.detach().cpu()
-            sequence_output_v = output.visual_output.detach().cpu()
-
-            # 2. with full access to all tokens and masked image regions
-            batch_masked_image_regions = dataloader.mask_image_regions(deepcopy(batch_full_access), obj_indices)
-            masked_image_output = self.model(
-                **batch_masked_image_regions,
-                output_attentions=True,
-                output_hidden_states=True,
-                return_outputs=True,
-                return_sequence_output=True
-            )
-            masked_v_sequence_output_t = masked_image_output.lang_output.detach().cpu()
-            masked_v_sequence_output_v = masked_image_output.visual_output.detach().cpu()
-            
-            # 3. with full access to all regions and masked language tokens
+            # shallow copies of batch_full_access; only the masked tensor is new
+            batch_masked_image_regions = dataloader.mask_image_regions(batch_full_access, obj_indices)
             #batch_masked_tokens = dataloader.format_batch(deepcopy(batch), mask_contextual_words=True)
-            batch_masked_tokens = dataloader.mask_contextual_words_in_batch(deepcopy(batch_full_access), 'input_ids')
+            batch_masked_tokens = dataloader.mask_contextual_words_in_batch(batch_full_access, 'input_ids')
             masked_t_input_ids = batch_masked_tokens['input_ids'] # we'll use this later to find the relevant contextual ids
-            masked_token_output = self.model(
-                **batch_masked_tokens,
-                output_attentions=True,
-                output_hidden_states=True,
-                return_outputs=True,
-                return_sequence_output=True
-            )
-            masked_t_sequence_output_t = masked_token_output.lang_output.detach().cpu()
-            masked_t_sequence_output_v = masked_token_output.visual_output.detach().cpu()
 
-            self._format_output_two_stream(
-                masked_t_input_ids,
-                dataloader.mask_token_id,
-                sequence_output_t, sequence_output_v,
-                masked_v_sequence_output_t, masked_v_sequence_output_v,
-                masked_t_sequence_output_t, masked_t_sequence_output_v,
-                enc_full_seq, enc_contextual,
-                enc_mask_v_full_seq, enc_mask_t_full_seq
-                )
-            
-        enc = {'full_seq' : enc_full_seq, 'contextual' : enc_contextual}
-        enc_mask_v = {'full_seq' : enc_mask_v_full_seq, 'contextual' : enc_mask_v_contextual}
-        enc_mask_t = {'full_seq' : enc_mask_t_full_seq, 'contextual' : enc_mask_t_contextual}
-        return enc, enc_mask_t, enc_mask_v
+            # each output holds the language outputs of self.layers, then their visual outputs
+            if self.fused_forward:
+                # 1.-3. in one forward over [full; masked image regions; masked language tokens]
+                keys = list(batch_full_access.keys())
+                output, masked_v_output, masked_t_output = self._forward_stacked(
+                    lambda args: self._forward(dict(zip(keys, args))),
+                    [[batch[key] for key in keys]
+                     for batch in (batch_full_access, batch_masked_image_regions, batch_masked_tokens)]
+                    )
+            else:
+                # 1. with full access to all tokens and all image regions
+                output = self._forward(batch_full_access)
+
+                # 2. with full access to all tokens and masked image regions
+                masked_v_output = self._forward(batch_masked_image_regions)
+
+                # 3. with full access to all regions and masked language tokens
+                masked_t_output = self._forward(batch_masked_tokens)
+            num_layers = len(self.layers)
+            output = self._collect_attentions('full', output, 2 * num_layers)
+            masked_v_output = self._collect_attentions('mask_v', masked_v_output, 2 * num_layers)
+            masked_t_output = self._collect_attentions('mask_t', masked_t_output, 2 * num_layers)
+            for i, layer in enumerate(self.layers):
+                enc, enc_mask_t, enc_mask_v = encoded[layer]
+                self._format_output_two_stream(
+                    masked_t_input_ids,
+                    dataloader.mask_token_id,
+                    output[i], output[num_layers + i],
+                    masked_v_output[i], masked_v_output[num_layers + i],
+                    masked_t_output[i], masked_t_output[num_layers + i],
+                    enc['full_seq'], enc['contextual'],
+                    enc_mask_v['full_seq'], enc_mask_t['full_seq']
+                    )
+        return _as_dicts(encoded)
 
 class VLBERTWrapper(ModelWrapper):
     @staticmethod
@@ -346,42 +509,50 @@ class VLBERTWrapper(ModelWrapper):
         self.model.cuda()
         self.model.eval()
         self.bidirectional = True
+        self._init_outputs(params)
+        self._init_forward_options(params)
+        self._init_cache(params, params.model_archive)
 
     def encode(self, dataloader: Iterable):
         self.model.eval()
-        enc_full_seq = {} # either word or sentence (depending on input)
-        enc_contextual = {} # word in context
-        enc_mask_t_full_seq = {} # relevant text indices masked
-        enc_mask_t_contextual = {}
-        enc_mask_v_full_seq = {} # relevant image regions masked
-        enc_mask_v_contextual = {}
+        encoded = _empty_encodings(len(dataloader.dataset))
+        enc, enc_mask_t, enc_mask_v = encoded
+        enc_full_seq = enc['full_seq'] # either word or sentence (depending on input)
+        enc_contextual = enc['contextual'] # word in context
+        enc_mask_t_full_seq = enc_mask_t['full_seq'] # relevant text indices masked
+        enc_mask_v_full_seq = enc_mask_v['full_seq'] # relevant image regions masked
         
         text_index = dataloader.dataset.data_names.index('text')
         boxes_index = dataloader.dataset.data_names.index('boxes')
         obj_labels_index = dataloader.dataset.data_names.index('object_labels')
         for batch in dataloader:
-            # 1. with full access to all tokens and all image regions
             batch = [v.cuda() if isinstance(v, torch.Tensor) else v for v in batch]
-            output = self.model(*batch[:-1]) # pass everything as input except object labels
-            sequence_output = output['sequence_output'].cpu().detach()
             input_ids = batch[text_index].detach().cpu().clone()
+            # shallow copies of batch; only the masked tensor is new
+            masked_v_batch = list(batch)
+            masked_v_batch[boxes_index] = dataloader.mask_input_features(batch[boxes_index], batch[obj_labels_index])
+            masked_t_batch = list(batch)
+            masked_input_ids = dataloader.mask_input_ids(batch[text_index])
+            masked_t_batch[text_index] = masked_input_ids
 
-            # 2. with full access to all tokens and masked image regions
-            masked_v_batch = deepcopy(batch)
-            boxes = dataloader.mask_input_features(masked_v_batch[boxes_index], masked_v_batch[obj_labels_index])
-            masked_v_batch[boxes_index] = boxes
-            output = self.model(*masked_v_batch[:-1]) # pass everything as input except object labels
-            masked_v_sequence_output = output['sequence_output'].cpu().detach()
+            # pass everything as input except object labels
+            if self.fused_forward:
+                # 1.-3. in one forward over [full; masked image regions; masked language tokens]
+                ((sequence_output,), (masked_v_sequence_output,), (masked_t_sequence_output,)) = self._forward_stacked(
+                    lambda args: (self.model(*args)['sequence_output'],),
+                    [batch[:-1], masked_v_batch[:-1], masked_t_batch[:-1]]
+                    )
+            else:
+                # 1. with full access to all tokens and all image regions
+                sequence_output = self.model(*batch[:-1])['sequence_output']
 
-            # 3. with full access to all regions and masked language tokens
-            masked_t_batch = deepcopy(batch)
-            masked_input_ids = dataloader.mask_input_ids(masked_t_batch[text_index])
-            masked_t_batch[text_index] = masked_input_ids
-            output = self.model(*masked_t_batch[:-1]) # pass everything as input except object labels
-            masked_t_sequence_output = output['sequence_output'].cpu().detach()
+                # 2. with full access to all tokens and masked image regions
+                masked_v_sequence_output = self.model(*masked_v_batch[:-1])['sequence_output']
 
+                # 3. with full access to all regions and masked language tokens
+                masked_t_sequence_output = self.model(*masked_t_batch[:-1])['sequence_output']
             self._format_output_single_stream(
-                masked_input_ids.detach().cpu(),
+                masked_input_ids,
                 mask_token_id=dataloader.mask_token_id,
                 sequence_output=sequence_output,
                 masked_t_sequence_output=masked_t_sequence_output,
@@ -392,10 +563,7 @@ class VLBERTWrapper(ModelWrapper):
                 enc_mask_v_full_seq=enc_mask_v_full_seq
 
             )
-        enc = {'full_seq' : enc_full_seq, 'contextual' : enc_contextual}
-        enc_mask_v = {'full_seq' : enc_mask_v_full_seq, 'contextual' : enc_mask_v_contextual}
-        enc_mask_t = {'full_seq' : enc_mask_t_full_seq, 'contextual' : enc_mask_t_contextual}
-        return enc, enc_mask_t, enc_mask_v
+        return _as_dicts({-1 : encoded})
 
 
 # define types
@@ -0,0 +1,44 @@
+''' Rerun the WEAT statistics on encodings exported by main.py --export_encodings,
+    without torch or any model code:
+
+        python -m scripts.stats --encodings results/lxmert/<run>/encodings/*.npz --out_dir stats
+
+    Takes the same statistics options as main.py and writes the same CSVs.
+'''
+
+from argparse import ArgumentParser
+import logging as log
+from os import makedirs
+
+from .experiments import EncodedTest, add_stats_args, load_encodings, run_experiments
+from .weat.backend import set_num_threads
+from .writer import Writer
+
+
+def load_stats_params(args=None):
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--encodings', nargs='+', required=True, help='.npz files of encodings, one per test')
+    parser.add_argument('--out_dir', type=str, default='results', help='path to save results')
+    add_stats_args(parser, default_backend='numpy')
+    return vars(parser.parse_args(args))
+
+
+def main(args=None):
+    params = load_stats_params(args)
+    log.basicConfig(level=log.INFO)
+    log.info(f'Params: {params}')
+    set_num_threads(params['backend'], params['stats_threads'])
+    makedirs(params['out_dir'], exist_ok=True)
+
+    writer = Writer(params['out_dir'])
+    for encodings_fp in params['encodings']:
+        log.info(f'Loading {encodings_fp}')
+        meta, encodings = load_encodings(encodings_fp)
+        test = EncodedTest(params, meta)
+        run_experiments(test, encodings, params, writer)
+        writer.flush()
+    writer.close()
+
+
+if __name__ == '__main__':
+    main()
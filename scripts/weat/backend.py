@@ -0,0 +1,133 @@
+''' Array backends for the WEAT statistics.
+
+    The cosine similarities, s(w, A, B), effect sizes and permutation tests
+    only need a few hundred vectors, so they can run on any of
+        - numpy      : multithreaded BLAS on the host
+        - torch-cpu  : torch tensors on the host
+        - torch-cuda : torch tensors on the GPU
+    'auto' picks torch-cuda when a GPU is visible and numpy otherwise.
+'''
+
+import logging as log
+import numpy as np
+
+BACKENDS = ['auto', 'numpy', 'torch-cpu', 'torch-cuda']
+DEFAULT_BACKEND = 'auto'
+EPS = 1e-8 # same guard against zero norms as torch's cosine_similarity
+
+
+def resolve_backend(backend=DEFAULT_BACKEND):
+    if backend not in BACKENDS:
+        raise Exception(f'Unknown backend: {backend}; choose from {BACKENDS}')
+    if backend != 'auto':
+        return backend
+    try:
+        import torch
+    except ImportError:
+        return 'numpy'
+    return 'torch-cuda' if torch.cuda.is_available() else 'numpy'
+
+
+def set_num_threads(backend, num_threads):
+    ''' Limit the number of threads used by the CPU backends.
+    '''
+    if num_threads is None:
+        return
+    backend = resolve_backend(backend)
+    if backend == 'torch-cpu':
+        import torch
+        torch.set_num_threads(num_threads)
+    elif backend == 'numpy':
+        try:
+            from threadpoolctl import threadpool_limits
+        except ImportError:
+            log.warning('threadpoolctl is not installed; set OMP_NUM_THREADS to limit BLAS threads')
+            return
+        threadpool_limits(limits=num_threads, user_api='blas')
+
+
+def is_torch(values):
+    return hasattr(values, 'detach')
+
+
+def to_numpy(values):
+    ''' Convert a torch tensor (on any device), list or array to a float64 numpy array.
+    '''
+    if is_torch(values):
+        values = values.detach().cpu().numpy()
+    return np.asarray(values, dtype=np.float64)
+
+
+def to_backend(values, backend=DEFAULT_BACKEND):
+    ''' Move a tensor or array to the given backend.
+    '''
+    backend = resolve_backend(backend)
+    if backend == 'numpy':
+        return to_numpy(values) if is_torch(values) else np.asarray(values)
+
+    import torch
+    device = 'cuda' if backend == 'torch-cuda' else 'cpu'
+    if not is_torch(values):
+        values = torch.as_tensor(np.asarray(values))
+    return values.to(device)
+
+
+def stack(vectors, backend=DEFAULT_BACKEND):
+    ''' Stack a sequence of 1-d vectors into a 2-d array on the given backend.
+    '''
+    backend = resolve_backend(backend)
+    vectors = list(vectors)
+    if backend == 'numpy':
+        return np.stack([to_numpy(v) for v in vectors])
+
+    import torch
+    return to_backend(torch.stack([torch.as_tensor(v).detach().cpu() for v in vectors]), backend)
+
+
+def zeros(shape, like):
+    ''' Zeros with the same backend, device and dtype as `like`.
+    '''
+    if is_torch(like):
+        return like.new_zeros(shape)
+    return np.zeros(shape, dtype=like.dtype)
+
+
+def concatenate(arrays):
+    if is_torch(arrays[0]):
+        import torch
+        return torch.cat(arrays)
+    return np.concatenate(arrays)
+
+
+def std(values):
+    ''' Sample standard deviation (ddof=1) on either backend.
+    '''
+    if is_torch(values):
+        return values.std()
+    return np.std(values, ddof=1)
+
+
+def normalize(M):
+    ''' L2-normalize the rows of M.
+    '''
+    if is_torch(M):
+        return M / M.norm(dim=1, keepdim=True).clamp_min(EPS)
+    return M / np.maximum(np.linalg.norm(M, axis=1, keepdims=True), EPS)
+
+
+def cossim_matrix(XY, AB, backend=DEFAULT_BACKEND, tile_size=None):
+    ''' Cosine similarities between two sequences of vectors as a (len(XY), len(AB)) matrix.
+        Each side is normalized once and the whole matrix is one matrix multiply.
+        With tile_size, AB is stacked, normalized and multiplied tile_size vectors
+        at a time, so only one tile of AB is held on the backend at once.
+    '''
+    XY = normalize(stack(XY, backend))
+    AB = list(AB)
+    if not tile_size or tile_size >= len(AB):
+        return XY @ normalize(stack(AB, backend)).T
+
+    cossims = zeros((len(XY), len(AB)), like=XY)
+    for start in range(0, len(AB), tile_size):
+        tile = normalize(stack(AB[start:start + tile_size], backend))
+        cossims[:, start:start + len(tile)] = XY @ tile.T
+    return cossims
@@ -0,0 +1,45 @@
+''' Centroid mode for the WEAT statistics.
+
+    Once vectors are unit-normalized,
+        s(w, A, B) = mean_{a in A} cos(w, a) - mean_{b in B} cos(w, b)
+                   = w/|w| . (c_A - c_B)
+    where c_A is the centroid of the normalized vectors in A. The functions here
+    build small stand-ins for the cosine similarity lookups from the centroids,
+    so the tests run in O((|XY| + |AB|) d) without the |XY| x |AB| matrix.
+'''
+
+from .backend import DEFAULT_BACKEND, concatenate, normalize, stack
+
+
+def unit_centroid(vectors, backend=DEFAULT_BACKEND, tile_size=None):
+    ''' Mean of the L2-normalized vectors, stacked tile_size vectors at a time if given.
+    '''
+    vectors = list(vectors)
+    tile_size = tile_size or len(vectors)
+    total = 0
+    for start in range(0, len(vectors), tile_size):
+        total = total + normalize(stack(vectors[start:start + tile_size], backend)).sum(0)
+    return total / len(vectors)
+
+
+def centroid_cossims(W, A, B, backend=DEFAULT_BACKEND, tile_size=None):
+    ''' Returns a (len(W), 2) array of w/|w| . c_A and w/|w| . c_B, a cossim lookup
+        in which the attribute index sets [0] and [1] stand in for A and B, so that
+        s_wAB([0], [1], cossims) = s(w, A, B).
+    '''
+    W = normalize(stack(W, backend))
+    centroids = stack([unit_centroid(A, backend, tile_size),
+                       unit_centroid(B, backend, tile_size)], backend)
+    return W @ centroids.T
+
+
+def summed_cossims(W, AB, backend=DEFAULT_BACKEND, tile_size=None):
+    ''' Returns a (1, len(AB)) array of sum_{w in W} cos(w, ab), a cossim lookup whose
+        single row gives sum_w s(w, A, B) for any split of AB into A and B.
+    '''
+    W_sum = unit_centroid(W, backend, tile_size) * len(W)
+    AB = list(AB)
+    tile_size = tile_size or len(AB)
+    tiles = [normalize(stack(AB[start:start + tile_size], backend)) @ W_sum
+             for start in range(0, len(AB), tile_size)]
+    return concatenate(tiles).reshape(1, -1)
@@ -5,13 +5,9 @@
 '''
 from copy import deepcopy
 import logging as log
-import math
-import itertools as it
 import numpy as np
-import scipy.special
-import scipy.stats
-import torch
-from torch.nn.functional import cosine_similarity as torch_cossim
+from .backend import cossim_matrix
+from .permutation import DEFAULT_CHUNK_SIZE, DEFAULT_MAX_EXACT_PARTITIONS, partition_pvalue
 
 # X and Y are two sets of target words of equal size.
 # A and B are two sets of attribute words.
@@ -25,14 +21,9 @@ def construct_cossim_lookup(XY, AB):
     between items in XY and items in AB.
     """
 
-    AB = torch.stack([AB[i] for i in range(len(AB))])
-    cossims = np.zeros((len(XY), len(AB)))
-    dims = torch.Size( (len(AB), len(XY[0])) )
-
-    for xy in XY:
-        cossims[xy, :] = torch_cossim(XY[xy].expand(dims),
-                                      AB)
-    return cossims
+    return cossim_matrix([XY[xy] for xy in range(len(XY))],
+                         [AB[i] for i in range(len(AB))],
+                         backend='numpy')
 
 
 def s_wAB(A, B, cossims):
@@ -82,92 +73,30 @@ def s_XYAB(X, Y, s_wAB_memo):
     return s_XAB(X, s_wAB_memo) - s_XAB(Y, s_wAB_memo)
 
 
-def p_val_permutation_test(X, Y, A, B, n_samples, cossims, parametric=False):
+def p_val_permutation_test(X, Y, A, B, n_samples, cossims, parametric=False,
+                           chunk_size=DEFAULT_CHUNK_SIZE, max_exact_partitions=DEFAULT_MAX_EXACT_PARTITIONS,
+                           exact_workers=1, dp_resolution=None,
+                           alpha=None, precision=None,
+                           seed=None, sampling_workers=1, edgeworth=False):
     ''' Compute the p-val for the permutation test, which is defined as
         the probability that a random even partition X_i, Y_i of X u Y
         satisfies P[s(X_i, Y_i, A, B) > s(X, Y, A, B)]
     '''
-    X = np.array(list(X), dtype=np.int)
-    Y = np.array(list(Y), dtype=np.int)
-    A = np.array(list(A), dtype=np.int)
-    B = np.array(list(B), dtype=np.int)
+    X = np.array(list(X), dtype=np.int64)
+    Y = np.array(list(Y), dtype=np.int64)
+    A = np.array(list(A), dtype=np.int64)
+    B = np.array(list(B), dtype=np.int64)
 
     assert len(X) == len(Y)
     size = len(X)
     s_wAB_memo = s_wAB(A, B, cossims=cossims)
     XY = np.concatenate((X, Y))
 
-    if parametric:
-        log.info('Using parametric test')
-        s = s_XYAB(X, Y, s_wAB_memo)
-
-        log.info('Drawing {} samples'.format(n_samples))
-        samples = []
-        for _ in range(n_samples):
-            np.random.shuffle(XY)
-            Xi = XY[:size]
-            Yi = XY[size:]
-            assert len(Xi) == len(Yi)
-            si = s_XYAB(Xi, Yi, s_wAB_memo)
-            samples.append(si)
-
-        # Compute sample standard deviation and compute p-value by
-        # assuming normality of null distribution
-        log.info('Inferring p-value based on normal distribution')
-        (shapiro_test_stat, shapiro_p_val) = scipy.stats.shapiro(samples)
-        log.info('Shapiro-Wilk normality test statistic: {:.2g}, p-value: {:.2g}'.format(
-            shapiro_test_stat, shapiro_p_val))
-        sample_mean = np.mean(samples)
-        sample_std = np.std(samples, ddof=1)
-        log.info('Sample mean: {:.2g}, sample standard deviation: {:.2g}'.format(
-            sample_mean, sample_std))
-        p_val = scipy.stats.norm.sf(s, loc=sample_mean, scale=sample_std)
-        return p_val
-
-    else:
-        log.info('Using non-parametric test')
-        s = s_XAB(X, s_wAB_memo)
-        total_true = 0
-        total_equal = 0
-        total = 0
-
-        run_sampling = len(X) > 20 # large to compute num partitions, so sample
-        if run_sampling:
-            # We only have as much precision as the number of samples drawn;
-            # bias the p-value (hallucinate a positive observation) to
-            # reflect that.
-            total_true += 1
-            total += 1
-            log.info('Drawing {} samples (and biasing by 1)'.format(n_samples - total))
-            for _ in range(n_samples - 1):
-                np.random.shuffle(XY)
-                Xi = XY[:size]
-                assert 2 * len(Xi) == len(XY)
-                si = s_XAB(Xi, s_wAB_memo)
-                if si > s:
-                    total_true += 1
-                elif si == s:  # use conservative test
-                    total_true += 1
-                    total_equal += 1
-                total += 1
-
-        else:
-            num_partitions = int(scipy.special.binom(2 * len(X), len(X)))
-            log.info('Using exact test ({} partitions)'.format(num_partitions))
-            for Xi in it.combinations(XY, len(X)):
-                Xi = np.array(Xi, dtype=np.int)
-                assert 2 * len(Xi) == len(XY)
-                si = s_XAB(Xi, s_wAB_memo)
-                if si > s:
-                    total_true += 1
-                elif si == s:  # use conservative test
-                    total_true += 1
-                    total_equal += 1
-                total += 1
-
-        if total_equal:
-            log.warning('Equalities contributed {}/{} to p-value'.format(total_equal, total))
-        return total_true / total
+    s = s_XAB(X, s_wAB_memo)
+    return partition_pvalue(s_wAB_memo[XY], size, s, n_samples, parametric=parametric, edgeworth=edgeworth,
+                            dp_resolution=dp_resolution, max_exact_partitions=max_exact_partitions,
+                            exact_workers=exact_workers, chunk_size=chunk_size,
+                            alpha=alpha, precision=precision, seed=seed, sampling_workers=sampling_workers)
 
 
 def mean_s_wAB(X, A, B, cossims):
@@ -244,13 +173,13 @@ def get_general_vals(X, Y, AX, AY, BX, BY, n_samples, parametric=False):
     BXY.update(BY)
 
     cossims_X = construct_cossim_lookup(X, AXY)
-    AX = np.array(list(AX), dtype=np.int)
-    AY = np.array(list(AY), dtype=np.int)
+    AX = np.array(list(AX), dtype=np.int64)
+    AY = np.array(list(AY), dtype=np.int64)
     X_AXonAY = s_wAB(AX, AY, cossims_X).sum()
 
     cossims_X = construct_cossim_lookup(X, BXY)
-    BX = np.array(list(BX), dtype=np.int)
-    BY = np.array(list(BY), dtype=np.int)
+    BX = np.array(list(BX), dtype=np.int64)
+    BY = np.array(list(BY), dtype=np.int64)
     X_BXonBY = s_wAB(BX, BY, cossims_X).sum()
 
     cossims_Y = construct_cossim_lookup(Y, AXY)
@@ -281,8 +210,8 @@ def get_general_vals(X, Y, AX, AY, BX, BY, n_samples, parametric=False):
     cossims_X = construct_cossim_lookup(X, AB)
     cossims_Y = construct_cossim_lookup(Y, AB)
 
-    A = np.array(list(A), dtype=np.int)
-    B = np.array(list(B), dtype=np.int)
+    A = np.array(list(A), dtype=np.int64)
+    B = np.array(list(B), dtype=np.int64)
     X_AonB = s_wAB(A, B, cossims_X).sum()
     Y_AonB = s_wAB(A, B, cossims_Y).sum()
     
@@ -307,8 +236,8 @@ def get_general_vals(X, Y, AX, AY, BX, BY, n_samples, parametric=False):
     cossims_X = construct_cossim_lookup(X, AB)
     cossims_Y = construct_cossim_lookup(Y, AB)
 
-    ABX = np.array(list(ABX), dtype=np.int)
-    ABY = np.array(list(ABY), dtype=np.int)
+    ABX = np.array(list(ABX), dtype=np.int64)
+    ABY = np.array(list(ABY), dtype=np.int64)
     X_ABXonABY = s_wAB(ABX, ABY, cossims_X).sum()
     Y_ABXonABY = s_wAB(ABX, ABY, cossims_Y).sum()
     
@@ -0,0 +1,453 @@
+''' Batched permutation engine shared by the WEAT modules.
+
+    Instead of shuffling X \cup Y and re-summing one partition at a time, random
+    partitions are drawn in chunks as an (n_chunk x 2n) index matrix and all of
+    the partition sums in a chunk are computed with a single gather-and-sum.
+    The exact test walks every partition in revolving-door order instead.
+'''
+
+from functools import lru_cache, partial
+import logging as log
+import multiprocessing
+import numpy as np
+import scipy.special
+from .backend import is_torch, to_numpy
+
+# number of partitions drawn per chunk; bounds memory at roughly
+# chunk_size * 2n * 8 bytes for the random keys
+DEFAULT_CHUNK_SIZE = 10000
+# adaptive sampling starts with chunks this small and doubles them up to chunk_size
+MIN_ADAPTIVE_CHUNK_SIZE = 1000
+# coverage of the interval reported for sampled p-values and used to stop early
+CONFIDENCE = 0.99
+
+
+class PValue(float):
+    ''' A p-value that remembers how precise it is. Behaves as a float everywhere
+        else (formatting, comparisons, writing results).
+        error_bound: largest possible distance to the exact permutation p-value,
+            None if unknown (approximations)
+        num_samples: number of partitions the p-value was computed from
+        ci: (low, high) interval on the exact permutation p-value
+    '''
+    def __new__(cls, value, error_bound=0., num_samples=None, ci=None):
+        p_val = super().__new__(cls, value)
+        p_val.error_bound = error_bound
+        p_val.num_samples = num_samples
+        if ci is None and error_bound is not None:
+            ci = (max(0., value - error_bound), min(1., value + error_bound))
+        p_val.ci = ci
+        return p_val
+
+
+def p_value_interval(total_true, total, confidence=CONFIDENCE):
+    ''' Clopper-Pearson interval on a p-value estimated as total_true / total.
+    '''
+    tail = (1 - confidence) / 2
+    # beta quantiles via scipy.special, which imports much faster than scipy.stats
+    low = scipy.special.betaincinv(total_true, total - total_true + 1, tail) if total_true > 0 else 0.
+    high = scipy.special.betaincinv(total_true + 1, total - total_true, 1 - tail) if total_true < total else 1.
+    return float(low), float(high)
+
+
+def sampled_pvalue(total_true, total):
+    ''' PValue of a Monte Carlo permutation test, with its interval.
+    '''
+    return PValue(total_true / total, num_samples=total, ci=p_value_interval(total_true, total))
+
+
+def chunk_sizes(n_samples, chunk_size, adaptive=False):
+    ''' Split n_samples draws into chunks of at most chunk_size; adaptive runs start
+        small so that clear-cut p-values can stop after a few thousand draws.
+    '''
+    chunk_size = max(1, int(chunk_size))
+    n_chunk = min(chunk_size, MIN_ADAPTIVE_CHUNK_SIZE) if adaptive else chunk_size
+    drawn = 0
+    while drawn < n_samples:
+        n_chunk = min(n_chunk, n_samples - drawn)
+        yield n_chunk
+        drawn += n_chunk
+        n_chunk = min(2 * n_chunk, chunk_size)
+
+
+def stop_sampling(total_true, total, alpha=None, precision=None):
+    ''' Sequential stopping rule: the interval on p lies entirely above or below
+        alpha, or its half-width is at most precision.
+    '''
+    if not total or (alpha is None and precision is None):
+        return False
+    low, high = p_value_interval(total_true, total)
+    if alpha is not None and (high < alpha or low > alpha):
+        return True
+    return precision is not None and (high - low) / 2 <= precision
+
+
+def make_rng(seed_seq, device=None):
+    ''' Random generator for one chunk of draws: a numpy Generator, or a seeded
+        torch.Generator on `device` if one is given.
+    '''
+    if device is None:
+        return np.random.default_rng(seed_seq)
+    import torch
+    rng = torch.Generator(device=device)
+    rng.manual_seed(int(seed_seq.generate_state(1, dtype=np.uint64)[0] >> 1))
+    return rng
+
+
+def sample_partitions(num_items, size, n_chunk, device=None, rng=None):
+    ''' Draw n_chunk uniformly random subsets of size `size` from range(num_items).
+        Returns an (n_chunk, size) index matrix, one subset per row; a torch
+        tensor on `device` if one is given and a numpy array otherwise.
+        rng: a generator from make_rng; a fresh unseeded one if not given
+    '''
+    if device is not None:
+        import torch
+        keys = torch.rand((n_chunk, num_items), device=device, generator=rng)
+        return keys.topk(size, dim=1, largest=False, sorted=False).indices
+
+    rng = rng if rng is not None else np.random.default_rng()
+    keys = rng.random((n_chunk, num_items))
+    if size == num_items:
+        return np.argsort(keys, axis=1)
+    # the `size` smallest random keys of each row index a uniform random subset
+    return np.argpartition(keys, size - 1, axis=1)[:, :size]
+
+
+def _run_chunk(count_chunk, args, device, task):
+    n_chunk, seed_seq = task
+    return count_chunk(*args, n_chunk, make_rng(seed_seq, device))
+
+
+def run_chunks(count_chunk, args, n_samples, chunk_size=DEFAULT_CHUNK_SIZE,
+               alpha=None, precision=None, seed=None, num_workers=1, device=None):
+    ''' Draw n_samples permutations in chunks and add up their counts.
+
+        count_chunk: module-level function called as count_chunk(*args, n_chunk, rng)
+            and returning (n_true, n_equal, n_drawn) for one chunk
+    Every chunk gets its own random stream, spawned from `seed` in a fixed
+    chunk schedule, so the counts only depend on the seed and not on
+    num_workers. With num_workers > 1 the chunks run on a process pool (host
+    sampling only) and are added up in schedule order, so stopping early on
+    alpha or precision is reproducible too. If count_chunk counts several tests
+    at once (arrays of n_true), sampling stops once all of them may stop.
+    '''
+    seed_seq = np.random.SeedSequence(seed)
+    if seed is None:
+        log.info(f'Sampling with seed {seed_seq.entropy}')
+    adaptive = alpha is not None or precision is not None
+    sizes = list(chunk_sizes(n_samples, chunk_size, adaptive))
+    tasks = list(zip(sizes, seed_seq.spawn(len(sizes))))
+    run = partial(_run_chunk, count_chunk, args, device)
+
+    pool = multiprocessing.Pool(num_workers) if num_workers > 1 and device is None else None
+    try:
+        results = pool.imap(run, tasks) if pool else map(run, tasks)
+        total_true, total_equal, total = 0, 0, 0
+        for n_true, n_equal, n_drawn in results:
+            total_true += n_true
+            total_equal += n_equal
+            total += n_drawn
+            if all(stop_sampling(n_true, total, alpha, precision) for n_true in np.atleast_1d(total_true)):
+                log.info(f'Stopping early after {total} samples')
+                break
+    finally:
+        if pool:
+            pool.terminate()
+    return total_true, total_equal, total
+
+
+def _count_chunk(values, size, s, n_chunk, rng):
+    device = values.device if is_torch(values) else None
+    sums = values[sample_partitions(len(values), size, n_chunk, device, rng)].sum(1)
+    return int((sums >= s).sum()), int((sums == s).sum()), n_chunk
+
+
+def count_partition_sums(values, size, s, n_samples, chunk_size=DEFAULT_CHUNK_SIZE,
+                         alpha=None, precision=None, seed=None, num_workers=1):
+    ''' Monte Carlo core of the permutation test.
+
+        values: s(w, A, B) for every w in X \cup Y
+        size: number of items in each sampled partition X_i
+        s: observed test statistic, sum_{x in X} s(x, A, B)
+    Returns (total_true, total_equal, total), where total_true counts the sampled
+    partitions with sum_{x in X_i} s(x, A, B) >= s (the conservative test)
+    and total_equal counts the ties among them.
+    Sampling runs on the backend (and device) that values live on.
+    If alpha or precision is given, stops before n_samples once stop_sampling holds.
+    seed and num_workers are as in run_chunks.
+    '''
+    if is_torch(values):
+        values = values.detach().double()
+        device = values.device
+    else:
+        values = to_numpy(values)
+        device = None
+    return run_chunks(_count_chunk, (values, size, float(s)), n_samples,
+                      chunk_size=chunk_size, alpha=alpha, precision=precision,
+                      seed=seed, num_workers=num_workers, device=device)
+
+
+# largest number of partitions that is enumerated exactly instead of sampled
+DEFAULT_MAX_EXACT_PARTITIONS = 10**9
+
+
+@lru_cache(maxsize=None)
+def revolving_door_moves(n, k):
+    ''' Element moves that walk all k-subsets of range(n) in revolving-door
+        (Gray-code) order, starting from range(k). Returns arrays (add, remove)
+        of length binom(n, k) - 1; step i adds add[i] and removes remove[i].
+        Uses the recursion
+            R(n, k) = R(n-1, k), then reversed R(n-1, k-1) with n-1 added.
+    '''
+    if k == 0 or k == n:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    add_rest, remove_rest = revolving_door_moves(n - 1, k)
+    add_last, remove_last = revolving_door_moves(n - 1, k - 1)
+    # last subset of R(n-1, k) is {0..k-2, n-2}; last of R(n-1, k-1) is {0..k-3, n-2}
+    removed = k - 2 if k >= 2 else n - 2
+    # walking R(n-1, k-1) backwards swaps the roles of added and removed items
+    add = np.concatenate((add_rest, [n - 1], remove_last[::-1]))
+    remove = np.concatenate((remove_rest, [removed], add_last[::-1]))
+    return add, remove
+
+
+def _split_partitions(values, size, chunk_size):
+    ''' Split the size-subsets of values into blocks of at most chunk_size subsets,
+        following the top of the revolving-door recursion. Each block is
+        (m, k, fixed): all k-subsets of values[:m] plus items summing to fixed.
+    '''
+    blocks = []
+    stack = [(len(values), size, 0.)]
+    while stack:
+        m, k, fixed = stack.pop()
+        if scipy.special.comb(m, k, exact=True) <= chunk_size or k == 0 or k == m:
+            blocks.append((m, k, fixed))
+        else:
+            stack.append((m - 1, k, fixed))
+            stack.append((m - 1, k - 1, fixed + values[m - 1]))
+    return blocks
+
+
+def _count_blocks(values, blocks, s, tol):
+    total_true, total_equal, total = 0, 0, 0
+    for m, k, fixed in blocks:
+        add, remove = revolving_door_moves(m, k)
+        # one add and one subtract per step; re-based on every block so
+        # rounding in the running sum stays within tol
+        sums = np.empty(len(add) + 1)
+        sums[0] = fixed + values[:k].sum()
+        np.cumsum(values[add] - values[remove], out=sums[1:])
+        sums[1:] += sums[0]
+        total_true += int(np.count_nonzero(sums >= s - tol))
+        total_equal += int(np.count_nonzero(np.abs(sums - s) <= tol))
+        total += len(sums)
+    return total_true, total_equal, total
+
+
+def count_exact_partition_sums(values, size, s, chunk_size=DEFAULT_CHUNK_SIZE, num_workers=1):
+    ''' Exact counterpart of count_partition_sums: visits every size-subset of values.
+        Subsets are walked in revolving-door order in vectorized blocks of up to
+        chunk_size subsets, so each step costs one add and one subtract; with
+        num_workers > 1 the blocks are spread over a process pool.
+        Sums within a few ulps of s count as ties (i.e. as >= s).
+    Returns (total_true, total_equal, total) with total = binom(len(values), size).
+    '''
+    values = to_numpy(values)
+    s = float(s)
+    tol = 1e-12 * (np.abs(values).sum() + abs(s))
+    blocks = _split_partitions(values, size, max(1, int(chunk_size)))
+    if num_workers <= 1 or len(blocks) == 1:
+        return _count_blocks(values, blocks, s, tol)
+
+    batches = [blocks[i::num_workers] for i in range(num_workers)]
+    with multiprocessing.Pool(num_workers) as pool:
+        counts = pool.starmap(_count_blocks, [(values, batch, s, tol) for batch in batches])
+    return tuple(sum(c) for c in zip(*counts))
+
+
+def dp_partition_pvalue(values, size, resolution):
+    ''' Exact null distribution of the permutation test by dynamic programming.
+
+        values: s(w, A, B) for every w in X \cup Y, with the observed X first
+        size: number of items in each partition X_i
+        resolution: values are rounded to multiples of this before counting
+    The number of size-subsets for every (count, quantized sum) state is built one
+    item at a time, in O(len(values) * size * size * range(values) / resolution).
+    Returns a PValue of P[sum_{x in X_i} s(x, A, B) >= sum_{x in X} s(x, A, B)]
+    for the quantized values; rounding moves every partition sum by at most
+    size * resolution / 2, which gives its error_bound.
+    '''
+    k = np.rint(to_numpy(values) / resolution).astype(np.int64)
+    k -= k.min()
+    k_obs = int(k[:size].sum())
+    width = size * int(k.max()) + 1
+
+    # counts[c, t]: number of c-subsets of the items so far with quantized sum t
+    counts = np.zeros((size + 1, width))
+    counts[0, 0] = 1.
+    reach = 0 # largest sum reachable so far
+    for i, ki in enumerate(k):
+        top = min(i + 1, size)
+        reach = min(reach + ki, width - 1)
+        # numpy buffers the overlapping rows, so each item is used at most once
+        counts[1:top + 1, ki:reach + 1] += counts[:top, :reach + 1 - ki]
+        if counts[top].max() > 1e250: # C(2n, n) overflows float64 past n ~ 500
+            counts *= 1e-250
+
+    null = counts[size]
+    tail = lambda t: null[max(t, 0):].sum() / null.sum()
+    p_val = tail(k_obs)
+    # quantized sums are within `size` units of the exact ones on both sides
+    error_bound = max(tail(k_obs - size) - p_val, p_val - tail(k_obs + size))
+    return PValue(p_val, error_bound=error_bound)
+
+
+def partition_sum_moments(values, size):
+    ''' Exact mean, variance, skewness and excess kurtosis of sum_{x in X_i} values[x]
+        over the size-subsets X_i of values, i.e. of a sample drawn without replacement.
+    '''
+    values = to_numpy(values)
+    N, n = len(values), size
+    c = values - values.mean()
+    S2, S3, S4 = (c ** 2).sum(), (c ** 3).sum(), (c ** 4).sum()
+    # P[i_1, ..., i_k all in X_i] for k distinct items
+    p1 = n / N
+    p2 = p1 * (n - 1) / (N - 1)
+    p3 = p2 * (n - 2) / max(N - 2, 1)
+    p4 = p3 * (n - 3) / max(N - 3, 1)
+
+    mean = n * values.mean()
+    var = (p1 - p2) * S2
+    m3 = (p1 - 3 * p2 + 2 * p3) * S3
+    m4 = (p1 * S4 - 4 * p2 * S4 + 3 * p2 * (S2 ** 2 - S4)
+          + 6 * p3 * (2 * S4 - S2 ** 2) + p4 * (3 * S2 ** 2 - 6 * S4))
+    if var <= 0:
+        return mean, 0., 0., 0.
+    return mean, var, m3 / var ** 1.5, m4 / var ** 2 - 3
+
+
+def normal_partition_pvalue(values, size, s, edgeworth=False):
+    ''' Closed-form approximation of the permutation test, with no sampling.
+
+        values: s(w, A, B) for every w in X \cup Y
+        size: number of items in each partition X_i
+        s: observed test statistic, sum_{x in X} s(x, A, B)
+    The null distribution of sum_{x in X_i} s(x, A, B) is taken to be normal with its
+    exact finite-population mean and variance; with edgeworth, the tail gets the
+    Edgeworth correction for its exact skewness and kurtosis as well.
+    Returns a PValue with num_samples=0 and no error bound.
+    '''
+    mean, var, skew, kurt = partition_sum_moments(values, size)
+    if var <= 0:
+        return PValue(float(s <= mean), error_bound=None, num_samples=0)
+    z = (float(s) - mean) / np.sqrt(var)
+    p_val = scipy.special.ndtr(-z)
+    if edgeworth:
+        p_val += np.exp(-z ** 2 / 2) / np.sqrt(2 * np.pi) * (skew / 6 * (z ** 2 - 1)
+                                                       + kurt / 24 * (z ** 3 - 3 * z)
+                                                       + skew ** 2 / 72 * (z ** 5 - 10 * z ** 3 + 15 * z))
+        p_val = min(max(p_val, 0.), 1.)
+    log.info('Null mean: {:.2g}, standard deviation: {:.2g}, skewness: {:.2g}, excess kurtosis: {:.2g}'.format(
+        mean, np.sqrt(var), skew, kurt))
+    return PValue(p_val, error_bound=None, num_samples=0)
+
+
+def needs_sampling(num_items, size, parametric=False, dp_resolution=None,
+                   max_exact_partitions=DEFAULT_MAX_EXACT_PARTITIONS):
+    ''' Whether partition_pvalue samples partitions of num_items into size-subsets,
+        rather than approximating the test or enumerating all of them.
+    '''
+    return not parametric and not dp_resolution and \
+        scipy.special.comb(num_items, size, exact=True) > max_exact_partitions
+
+
+def partition_pvalue(values, size, s, n_samples, parametric=False, edgeworth=False, dp_resolution=None,
+                     max_exact_partitions=DEFAULT_MAX_EXACT_PARTITIONS, exact_workers=1,
+                     chunk_size=DEFAULT_CHUNK_SIZE, alpha=None, precision=None,
+                     seed=None, sampling_workers=1):
+    ''' P-value of the permutation test of a test module, the probability that the
+        sum of values over a random size-subset is at least s:
+            - with parametric, normal_partition_pvalue (with edgeworth, corrected)
+            - with dp_resolution, dp_partition_pvalue
+            - otherwise the exact test, or n_samples draws (biased by 1, and with
+              alpha or precision stopping early) if there are more than
+              max_exact_partitions partitions
+    '''
+    if parametric:
+        log.info('Using parametric test')
+        return normal_partition_pvalue(values, size, s, edgeworth=edgeworth)
+
+    log.info('Using non-parametric test')
+    if dp_resolution:
+        log.info(f'Using exact test on s(w, A, B) quantized to {dp_resolution:g}')
+        p_val = dp_partition_pvalue(values, size, dp_resolution)
+        log.info('Quantization error bound on pval: {:.2g}'.format(p_val.error_bound))
+        return p_val
+
+    run_sampling = needs_sampling(len(values), size, max_exact_partitions=max_exact_partitions)
+    if run_sampling:
+        # We only have as much precision as the number of samples drawn;
+        # bias the p-value (hallucinate a positive observation) to
+        # reflect that.
+        log.info('Drawing {} samples (and biasing by 1)'.format(n_samples - 1))
+        sampled_true, total_equal, sampled = count_partition_sums(
+            values, size, s, n_samples - 1, chunk_size=chunk_size,
+            alpha=alpha, precision=precision, seed=seed, num_workers=sampling_workers)
+        total_true, total = sampled_true + 1, sampled + 1
+    else:
+        log.info('Using exact test ({} partitions)'.format(scipy.special.comb(len(values), size, exact=True)))
+        total_true, total_equal, total = count_exact_partition_sums(
+            values, size, s, chunk_size=chunk_size, num_workers=exact_workers)
+
+    if total_equal:
+        log.warning('Equalities contributed {}/{} to p-value'.format(total_equal, total))
+    if run_sampling:
+        return sampled_pvalue(total_true, total)
+    return PValue(total_true / total, num_samples=total)
+
+
+def _count_stacked_chunk(values, size, s, n_chunk, rng):
+    # one index matrix for every row of values, so all tests see the same partitions
+    sums = values[:, sample_partitions(values.shape[1], size, n_chunk, rng=rng)].sum(2)
+    return (sums >= s[:, None]).sum(1), (sums == s[:, None]).sum(1), n_chunk
+
+
+def partition_pvalues(tests, n_samples, parametric=False, edgeworth=False, dp_resolution=None,
+                      max_exact_partitions=DEFAULT_MAX_EXACT_PARTITIONS, exact_workers=1,
+                      chunk_size=DEFAULT_CHUNK_SIZE, alpha=None, precision=None,
+                      seed=None, sampling_workers=1):
+    ''' P-values for several permutation tests at once.
+
+        tests: list of (values, size, s) as taken by count_partition_sums
+    Sampled tests with the same len(values) and size share one set of draws:
+    each chunk of partitions is sampled once and summed for all of them,
+    so a batch of experiments costs about as much sampling as a single test.
+    The p-values are then correlated through the common draws, but each one is
+    still a valid (biased by 1) Monte Carlo p-value. With alpha or precision, the
+    shared draws stop once every test of the group may stop. Parametric, quantized and
+    exact tests are computed one at a time by partition_pvalue.
+    Returns a list of PValues in the order of tests.
+    '''
+    p_vals = [None] * len(tests)
+    groups = {}
+    for i, (values, size, s) in enumerate(tests):
+        if needs_sampling(len(values), size, parametric, dp_resolution, max_exact_partitions):
+            groups.setdefault((len(values), size), []).append(i)
+        else:
+            p_vals[i] = partition_pvalue(values, size, s, n_samples, parametric=parametric, edgeworth=edgeworth,
+                                         dp_resolution=dp_resolution, max_exact_partitions=max_exact_partitions,
+                                         exact_workers=exact_workers, chunk_size=chunk_size)
+
+    for (num_items, size), idx in groups.items():
+        log.info('Drawing {} shared samples (and biasing by 1) for {} tests'.format(n_samples - 1, len(idx)))
+        values = np.stack([to_numpy(tests[i][0]) for i in idx])
+        s = np.array([float(tests[i][2]) for i in idx])
+        sampled_true, sampled_equal, sampled = run_chunks(
+            _count_stacked_chunk, (values, size, s), n_samples - 1,
+            chunk_size=chunk_size, alpha=alpha, precision=precision,
+            seed=seed, num_workers=sampling_workers)
+        for i, n_true, n_equal in zip(idx, sampled_true, sampled_equal):
+            if n_equal:
+                log.warning('Equalities contributed {}/{} to p-value'.format(n_equal, sampled + 1))
+            p_vals[i] = sampled_pvalue(n_true + 1, sampled + 1)
+    return p_vals
@@ -4,109 +4,135 @@
     This script runs WEAT by evaluating bias over the full sets A (AX \cup AY) and B (BX \cup BY).
 '''
 
-from copy import copy
-import ctypes
-import itertools as it
 import logging as log
-import math
-from multiprocessing import Pool, Process, Value, Manager, Array
 import numpy as np
-from random import shuffle
-import scipy.special
-import scipy.stats
-from tqdm import tqdm
-import torch
-from torch.nn.functional import cosine_similarity as torch_cossim
-from warnings import warn
+from .backend import DEFAULT_BACKEND, cossim_matrix, to_numpy
+from .centroid import centroid_cossims, summed_cossims
+from .permutation import DEFAULT_CHUNK_SIZE, run_chunks, sample_partitions, sampled_pvalue
 
 # X and Y are two sets of target words of equal size.
 # A and B are two sets of attribute words.
 # A = AX \cup AY and B = BX \cup BY
 
-NUM_PARALLEL = 100
-NUM_SHUFFLES = 10
-
-def inner_p_test(args):# A, B, len_A_X, len_B_X, cossims_attrX, cossims_attrY, return_vals_list):
-    A, B, len_AX, len_BX, cossims_attrX, cossims_attrY, return_vals_list = args
-    A, B = copy(A), copy(B)
-
-    # shuffle
-    count = 0
-    while count < NUM_SHUFFLES:
-        count+=1
-        A = A[np.random.permutation(len(A))][:len_AX]
-        indices_Ax = np.array(np.where(A == 'X')).transpose()[:,0]
-        indices_Ay = np.array(np.where(A == 'Y')).transpose()[:,0]
-        Aix, Aiy = A[indices_Ax][:,1].astype('float'), A[indices_Ay][:,1].astype('float')
-        if len(Aix) > 0 and len(Aiy) > 0:
-            break 
-        if count == NUM_SHUFFLES:
-            warn('no suitable split found for A')
-            return
-
-    count = 0
-    while count < NUM_SHUFFLES:
-        count+=1
-        B = B[np.random.permutation(len(B))][:len_BX]
-        indices_Bx = np.array(np.where(B == 'X')).transpose()[:,0]
-        indices_By = np.array(np.where(B == 'Y')).transpose()[:,0]
-        Bix, Biy = B[indices_Bx][:,1].astype('float'), B[indices_By][:,1].astype('float')
-        if len(Bix) > 0 and len(Biy) > 0:
-            break
-        if count == NUM_SHUFFLES:
-            warn('no suitable split found for B')
-            return
-    
-    si = s_wAB(Aix, Bix, cossims=cossims_attrX).sum() + s_wAB(Aiy, Biy, cossims=cossims_attrY).sum()
-    return_vals_list.append(si)
-    return si
+def _split_means(values, sum_X, len_X):
+    # means of the first len_X attributes (with X-images) and of the rest (with Y-images)
+    return sum_X / len_X, (values.sum() - sum_X) / (len(values) - len_X)
+
+
+def attribute_split_statistic(values_A, len_AX, values_B, len_BX):
+    ''' Observed statistic of the attribute permutation test, for attribute pools
+        whose first len_AX (len_BX) items are the attributes with X-images:
+            sum_w s(w, A_X, B_X) - sum_w s(w, A_Y, B_Y).
+    '''
+    mean_Ax, mean_Ay = _split_means(values_A, values_A[:len_AX].sum(), len_AX)
+    mean_Bx, mean_By = _split_means(values_B, values_B[:len_BX].sum(), len_BX)
+    return (mean_Ax - mean_Bx) - (mean_Ay - mean_By)
+
+
+def _sample_attribute_splits(values, len_X, n_chunk, rng):
+    ''' Shuffle an attribute pool and split it into len_X attributes taken to be
+        with X-images and the rest, taken to be with Y-images. Returns the per-draw
+        mean of each split.
+    '''
+    indices = sample_partitions(len(values), len_X, n_chunk, rng=rng)
+    return _split_means(values, values[indices].sum(axis=1), len_X)
+
+
+def _count_attribute_chunk(values_A, len_AX, values_B, len_BX, s, n_chunk, rng):
+    mean_Ax, mean_Ay = _sample_attribute_splits(values_A, len_AX, n_chunk, rng)
+    mean_Bx, mean_By = _sample_attribute_splits(values_B, len_BX, n_chunk, rng)
+    sums = (mean_Ax - mean_Bx) - (mean_Ay - mean_By)
+    return int(np.count_nonzero(sums >= s)), int(np.count_nonzero(sums == s)), n_chunk
+
+
+def attribute_values(A_X, B_X, A_Y, B_Y, cossims_attrX, cossims_attrY):
+    ''' Pools of sum_w cos(w, a) over the attributes in A_X u A_Y and in B_X u B_Y,
+        each attribute with the images it was encoded with, X-images first.
+    '''
+    colsums_X = to_numpy(cossims_attrX.sum(0))
+    colsums_Y = to_numpy(cossims_attrY.sum(0))
+    values_A = np.concatenate((colsums_X[A_X], colsums_Y[A_Y]))
+    values_B = np.concatenate((colsums_X[B_X], colsums_Y[B_Y]))
+    return values_A, values_B
 
-def construct_cossim_lookup(XY, AB):
+
+def count_attribute_partition_sums(values_A, len_AX, values_B, len_BX, s, n_samples,
+                                   chunk_size=DEFAULT_CHUNK_SIZE, alpha=None, precision=None,
+                                   seed=None, num_workers=1):
+    ''' Batched attribute permutations. The pools of attribute_values are shuffled and
+        split into A_iX, A_iY and B_iX, B_iY of the sizes of A_X, A_Y and B_X, B_Y, and
+            s_i = sum_w s(w, A_iX, B_iX) - sum_w s(w, A_iY, B_iY),
+        which is attribute_split_statistic of the shuffled pools.
+    Returns (total_true, total_equal, total) as in permutation.count_partition_sums,
+    which also describes alpha, precision, seed and num_workers.
+    '''
+    return run_chunks(_count_attribute_chunk,
+                      (values_A, len_AX, values_B, len_BX, float(s)), n_samples,
+                      chunk_size=chunk_size, alpha=alpha, precision=precision,
+                      seed=seed, num_workers=num_workers)
+
+
+def construct_cossim_lookup(XY, AB, backend=DEFAULT_BACKEND, tile_size=None):
     """
     XY: mapping from target string to target vector (either in X or Y)
     AB: mapping from attribute string to attribute vectore (either in A or B)
     Returns an array of size (len(XY), len(AB)) containing cosine similarities
-    between items in XY and items in AB.
+    between items in XY and items in AB, on the given backend.
     """
-    AB = torch.stack([AB[i] for i in AB.keys()])
-    cossims = torch.zeros( (len(XY), len(AB)) )
-    dims = torch.Size( (len(AB), len(XY[0])) )
-    
-    for xy in XY:
-        cossims[xy, :] = torch_cossim(XY[xy].expand(dims),
-                                      AB)
-    return cossims
+    return cossim_matrix([XY[xy] for xy in range(len(XY))],
+                         [AB[i] for i in AB.keys()],
+                         backend=backend, tile_size=tile_size)
+
+
+def construct_centroid_lookups(XY, A, B, backend=DEFAULT_BACKEND, tile_size=None):
+    """
+    Centroid mode counterpart of construct_cossim_lookup for the attributes A u B
+    of one set of images. Returns
+        - a (1, len(A) + len(B)) array of sum_{xy} cos(xy, ab), which is all the
+          attribute permutation test needs, and
+        - a (len(XY), 2) array of similarities to the centroids of A and B
+          for the effect size.
+    """
+    XY = [XY[xy] for xy in range(len(XY))]
+    sums = summed_cossims(XY, list(A.values()) + list(B.values()),
+                          backend=backend, tile_size=tile_size)
+    cossims = centroid_cossims(XY, A.values(), B.values(),
+                               backend=backend, tile_size=tile_size)
+    return sums, cossims
 
 
 def p_val_permutation_test(X, A_X, B_X, A_Y, B_Y, n_samples,
                            cossims_attrX, cossims_attrY,
-                           parametric=False):
+                           parametric=False, chunk_size=DEFAULT_CHUNK_SIZE,
+                           alpha=None, precision=None,
+                           seed=None, sampling_workers=1):
     ''' Compute the p-val for the permutation test, which is defined as
-        the probability that a random even partition X_i, Y_i of X u Y
-        satisfies P[s(X_i, Y_i, A, B) > s(X, Y, A, B)]
+        the probability that a random split of A_X u A_Y and B_X u B_Y into
+        attributes with X-images and with Y-images satisfies s_i >= s, for the
+        statistic s of attribute_split_statistic
     '''
 
-    X = np.array(list(X), dtype=np.int)
-    A_X = np.array(list(A_X), dtype=np.int)
-    B_X = np.array(list(B_X), dtype=np.int)
-    A_Y = np.array(list(A_Y), dtype=np.int)
-    B_Y = np.array(list(B_Y), dtype=np.int)
+    X = np.array(list(X), dtype=np.int64)
+    A_X = np.array(list(A_X), dtype=np.int64)
+    B_X = np.array(list(B_X), dtype=np.int64)
+    A_Y = np.array(list(A_Y), dtype=np.int64)
+    B_Y = np.array(list(B_Y), dtype=np.int64)
     
     if parametric:
         raise Exception('not implemented')
 
     else:
         log.info('Using non-parametric test')
-        s =  s_wAB(A_X, B_X, cossims=cossims_attrX).sum()
+        if not (len(A_X) and len(A_Y) and len(B_X) and len(B_Y)):
+            raise ValueError('Both attribute sets need attributes with X-images and with Y-images')
+        # the same statistic as every permutation draw, so that it is one of them under the null
+        values_A, values_B = attribute_values(A_X, B_X, A_Y, B_Y, cossims_attrX, cossims_attrY)
+        s = attribute_split_statistic(values_A, len(A_X), values_B, len(B_X))
         total_true = 0
         total_equal = 0
         total = 0
         
         run_sampling = len(X) > 20 # large to compute num partitions, so sample
-        A = np.array([('X', a) for a in A_X] + [('Y', a) for a in A_Y])
-        B = np.array([('X', b) for b in B_X] + [('Y', b) for b in B_Y])
-        len_AX = max(2, len(A_X)) # need at least 2 samples so we can get an X and Y
-        len_BX = max(2, len(B_X)) # need at least 2 samples so we can get an X and Y
 
         if run_sampling:
             # We only have as much precision as the number of samples drawn;
@@ -115,51 +141,35 @@ def p_val_permutation_test(X, A_X, B_X, A_Y, B_Y, n_samples,
             total_true += 1
             total += 1
             log.info('Drawing {} samples (and biasing by 1)'.format(n_samples - total))
-
-            results = []
-            manager = Manager()
-            return_vals_list = manager.list()
-            for idx in tqdm(range(1, math.ceil(n_samples))):
-                # shuffle
-                A = A[np.random.permutation(len(A))]
-                B = B[np.random.permutation(len(B))]
-
-                # top chunk of list
-                A_slice, B_slice = A[:len_AX], B[:len_BX]
-                indices_Ax = np.array(np.where(A_slice == 'X')).transpose()[:,0]
-                indices_Ay = np.array(np.where(A_slice == 'Y')).transpose()[:,0]
-                indices_Bx = np.array(np.where(B_slice == 'X')).transpose()[:,0]
-                indices_By = np.array(np.where(B_slice == 'Y')).transpose()[:,0]
-
-                Aix, Aiy = A[indices_Ax][:,1].astype('float'), A[indices_Ay][:,1].astype('float')
-                Bix, Biy = B[indices_Bx][:,1].astype('float'), B[indices_By][:,1].astype('float')
-                if len(Aix) == 0 or len(Aiy) == 0 or len(Bix) == 0 or len(Biy) == 0:
-                    continue
+            sampled_true, sampled_equal, sampled = count_attribute_partition_sums(
+                values_A, len(A_X), values_B, len(B_X), s, n_samples - 1,
+                chunk_size=chunk_size, alpha=alpha, precision=precision,
+                seed=seed, num_workers=sampling_workers)
+            total_true += sampled_true
+            total_equal += sampled_equal
+            total += sampled
         else:
             raise Exception('Not implemented')
         
         if total_equal:
             log.warning('Equalities contributed {}/{} to p-value'.format(total_equal, total))
-        return total_true / total
+        return sampled_pvalue(total_true, total)
     
 def s_wAB(A, B, cossims):
     """
     Return vector of s(w, A, B) across w, where
         s(w, A, B) = mean_{a in A} cos(w, a) - mean_{b in B} cos(w, b).
     """
-    try:
-        return cossims[:, A].mean(axis=1) - cossims[:, B].mean(axis=1)
-    except:
-        return cossims[:, A].mean(dim=1) - cossims[:, B].mean(dim=1)
+    return cossims[:, A].mean(1) - cossims[:, B].mean(1)
     
 def mean_s_wAB(X, A, B, cossims):
     #return np.mean(s_wAB(A, B, cossims[X]))
-    return torch.mean(s_wAB(A,B,cossims[X]))
+    return s_wAB(A,B,cossims[X]).mean()
 
 # each attribute varies by target
 def stdev_s_wAB(X, A_X, B_X, A_Y, B_Y, cossims_X, cossims_Y):
-    valX = s_wAB(A_X, B_X, cossims_X[X]).cpu().numpy()
-    valY = s_wAB(A_Y, B_Y, cossims_Y[X]).cpu().numpy()
+    valX = to_numpy(s_wAB(A_X, B_X, cossims_X[X]))
+    valY = to_numpy(s_wAB(A_Y, B_Y, cossims_Y[X]))
     vals = np.concatenate((valX, valY))
     return np.std(vals, ddof=1)
 
@@ -194,7 +204,10 @@ def convert_keys_to_ints(X, Y=None):
             dict((i, v) for (i, (k, v)) in enumerate(X.items()))
         )
 
-def run_test(X, Y, AX, AY, BX, BY, n_samples, cat_X, cat_Y, cat_A, cat_B, parametric=False):
+def run_test(X, Y, AX, AY, BX, BY, n_samples, cat_X, cat_Y, cat_A, cat_B, parametric=False,
+             chunk_size=DEFAULT_CHUNK_SIZE, backend=DEFAULT_BACKEND, tile_size=None, centroid=False,
+             alpha=None, precision=None,
+             seed=None, sampling_workers=1):
     ''' Run a WEAT.
     args:
         - encs (Dict[str: Dict]): dictionary mapping targ1, targ2, attr1, attr2
@@ -202,6 +215,16 @@ def run_test(X, Y, AX, AY, BX, BY, n_samples, cat_X, cat_Y, cat_A, cat_B, parame
         - n_samples (int): number of samples to draw to estimate p-value
             (use exact test if number of permutations is less than or
             equal to n_samples)
+        - backend (str): one of backend.BACKENDS to compute the statistics on
+        - tile_size (int): if set, number of attribute vectors per cosine similarity tile
+        - centroid (bool): use per-attribute sums over targets and attribute centroids
+            instead of building the full cosine similarity matrices
+        - alpha (float): if set, stop sampling once the interval on the p-value
+            is entirely above or below alpha
+        - precision (float): if set, stop sampling once the interval on the p-value
+            has at most this half-width
+        - seed (int): master seed for the permutation samples; None draws a fresh one
+        - sampling_workers (int): number of processes to draw permutation samples on
     '''
 
     # First convert all keys to ints to facilitate array lookups
@@ -218,21 +241,36 @@ def run_test(X, Y, AX, AY, BX, BY, n_samples, cat_X, cat_Y, cat_A, cat_B, parame
     AB_Y.update(BY)
 
 
-    log.info("Computing cosine similarities...")
-    cossims_XonX = construct_cossim_lookup(X, AB_X).cuda()
-    cossims_XonY = construct_cossim_lookup(X, AB_Y).cuda()
+    if centroid:
+        log.info("Computing similarities to attribute centroids...")
+        sums_XonX, cossims_XonX = construct_centroid_lookups(X, AX, BX, backend=backend, tile_size=tile_size)
+        sums_XonY, cossims_XonY = construct_centroid_lookups(X, AY, BY, backend=backend, tile_size=tile_size)
+        sums_YonX, cossims_YonX = construct_centroid_lookups(Y, AX, BX, backend=backend, tile_size=tile_size)
+        sums_YonY, cossims_YonY = construct_centroid_lookups(Y, AY, BY, backend=backend, tile_size=tile_size)
+        esize_attrs = ({0 : None}, {1 : None}, {0 : None}, {1 : None}) # columns of cossims_*
+    else:
+        log.info("Computing cosine similarities...")
+        sums_XonX = cossims_XonX = construct_cossim_lookup(X, AB_X, backend=backend, tile_size=tile_size)
+        sums_XonY = cossims_XonY = construct_cossim_lookup(X, AB_Y, backend=backend, tile_size=tile_size)
+        sums_YonX = cossims_YonX = construct_cossim_lookup(Y, AB_X, backend=backend, tile_size=tile_size)
+        sums_YonY = cossims_YonY = construct_cossim_lookup(Y, AB_Y, backend=backend, tile_size=tile_size)
+        esize_attrs = (AX, BX, AY, BY)
+
     # first X on attrX attrY
     log.info(f"Null hypothesis: no difference between {cat_X} in association to attributes {cat_A} and {cat_B} across images")
 
     log.info("Computing pval...")
     pval_x = p_val_permutation_test(X, AX, BX, AY, BY, n_samples,
-                                   cossims_attrX=cossims_XonX,
-                                   cossims_attrY=cossims_XonY,
-                                   parametric=parametric)
+                                   cossims_attrX=sums_XonX,
+                                   cossims_attrY=sums_XonY,
+                                   parametric=parametric,
+                                   chunk_size=chunk_size,
+                                   alpha=alpha, precision=precision,
+                                   seed=seed, sampling_workers=sampling_workers)
     log.info("pval: %g", pval_x)
 
     log.info("computing effect size...")
-    esize_x = effect_size(X, AX, BX, AY, BY,
+    esize_x = effect_size(X, *esize_attrs,
                           cossims_XonX, cossims_XonY)
     log.info("esize: %g", esize_x)
 
@@ -241,16 +279,17 @@ def run_test(X, Y, AX, AY, BX, BY, n_samples, cat_X, cat_Y, cat_A, cat_B, parame
     log.info(f"Null hypothesis: no difference between {cat_Y} in association to attributes {cat_A} and {cat_B} across images")
     
     log.info("Computing pval...")
-    cossims_YonX = construct_cossim_lookup(Y, AB_X).cuda()
-    cossims_YonY = construct_cossim_lookup(Y, AB_Y).cuda()
     pval_y = p_val_permutation_test(Y, AX, BX, AY, BY, n_samples,
-                                  cossims_attrX=cossims_YonX,
-                                   cossims_attrY=cossims_YonY,
-                                   parametric=parametric)
+                                  cossims_attrX=sums_YonX,
+                                   cossims_attrY=sums_YonY,
+                                   parametric=parametric,
+                                   chunk_size=chunk_size,
+                                   alpha=alpha, precision=precision,
+                                   seed=seed, sampling_workers=sampling_workers)
     log.info("pval: %g", pval_y)
 
     log.info("computing effect size...")
-    esize_y = effect_size(Y, AX, BX, AY, BY,
+    esize_y = effect_size(Y, *esize_attrs,
                           cossims_YonX, cossims_YonY)
     log.info("esize: %g", esize_y)
     return esize_x.item(), pval_x, esize_y.item(), pval_y
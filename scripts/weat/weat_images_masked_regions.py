@@ -5,13 +5,10 @@
 '''
 
 import logging as log
-import math
-import itertools as it
 import numpy as np
-import scipy.special
-import scipy.stats
 import torch
 from torch.nn.functional import cosine_similarity as f_cossim
+from .permutation import DEFAULT_CHUNK_SIZE, DEFAULT_MAX_EXACT_PARTITIONS, partition_pvalue
 
 # X and Y are two sets of target words of equal size.
 # A and B are two sets of attribute words.
@@ -81,92 +78,30 @@ def s_XYAB(X, Y, s_wAB_memo):
     return s_XAB(X, s_wAB_memo) - s_XAB(Y, s_wAB_memo)
 
 
-def p_val_permutation_test(X, Y, A, B, n_samples, cossims, parametric=False):
+def p_val_permutation_test(X, Y, A, B, n_samples, cossims, parametric=False,
+                           chunk_size=DEFAULT_CHUNK_SIZE, max_exact_partitions=DEFAULT_MAX_EXACT_PARTITIONS,
+                           exact_workers=1, dp_resolution=None,
+                           alpha=None, precision=None,
+                           seed=None, sampling_workers=1, edgeworth=False):
     ''' Compute the p-val for the permutation test, which is defined as
         the probability that a random even partition X_i, Y_i of X u Y
         satisfies P[s(X_i, Y_i, A, B) > s(X, Y, A, B)]
     '''
-    X = np.array(list(X), dtype=np.int)
-    Y = np.array(list(Y), dtype=np.int)
-    A = np.array(list(A), dtype=np.int)
-    B = np.array(list(B), dtype=np.int)
+    X = np.array(list(X), dtype=np.int64)
+    Y = np.array(list(Y), dtype=np.int64)
+    A = np.array(list(A), dtype=np.int64)
+    B = np.array(list(B), dtype=np.int64)
 
     assert len(X) == len(Y), f'len X {len(X)}, len Y {len(Y)}'
     size = len(X)
     s_wAB_memo = s_wAB(A, B, cossims=cossims)
     XY = np.concatenate((X, Y))
 
-    if parametric:
-        log.info('Using parametric test')
-        s = s_XYAB(X, Y, s_wAB_memo)
-
-        log.info('Drawing {} samples'.format(n_samples))
-        samples = []
-        for _ in range(n_samples):
-            np.random.shuffle(XY)
-            Xi = XY[:size]
-            Yi = XY[size:]
-            assert len(Xi) == len(Yi)
-            si = s_XYAB(Xi, Yi, s_wAB_memo)
-            samples.append(si)
-
-        # Compute sample standard deviation and compute p-value by
-        # assuming normality of null distribution
-        log.info('Inferring p-value based on normal distribution')
-        (shapiro_test_stat, shapiro_p_val) = scipy.stats.shapiro(samples)
-        log.info('Shapiro-Wilk normality test statistic: {:.2g}, p-value: {:.2g}'.format(
-            shapiro_test_stat, shapiro_p_val))
-        sample_mean = np.mean(samples)
-        sample_std = np.std(samples, ddof=1)
-        log.info('Sample mean: {:.2g}, sample standard deviation: {:.2g}'.format(
-            sample_mean, sample_std))
-        p_val = scipy.stats.norm.sf(s, loc=sample_mean, scale=sample_std)
-        return p_val
-
-    else:
-        log.info('Using non-parametric test')
-        s = s_XAB(X, s_wAB_memo)
-        total_true = 0
-        total_equal = 0
-        total = 0
-
-        run_sampling = len(X) > 20 # large to compute num partitions, so sample
-        if run_sampling:
-            # We only have as much precision as the number of samples drawn;
-            # bias the p-value (hallucinate a positive observation) to
-            # reflect that.
-            total_true += 1
-            total += 1
-            log.info('Drawing {} samples (and biasing by 1)'.format(n_samples - total))
-            for _ in range(n_samples - 1):
-                np.random.shuffle(XY)
-                Xi = XY[:size]
-                assert 2 * len(Xi) == len(XY)
-                si = s_XAB(Xi, s_wAB_memo)
-                if si > s:
-                    total_true += 1
-                elif si == s:  # use conservative test
-                    total_true += 1
-                    total_equal += 1
-                total += 1
-
-        else:
-            num_partitions = int(scipy.special.binom(2 * len(X), len(X)))
-            log.info('Using exact test ({} partitions)'.format(num_partitions))
-            for Xi in it.combinations(XY, len(X)):
-                Xi = np.array(Xi, dtype=np.int)
-                assert 2 * len(Xi) == len(XY)
-                si = s_XAB(Xi, s_wAB_memo)
-                if si > s:
-                    total_true += 1
-                elif si == s:  # use conservative test
-                    total_true += 1
-                    total_equal += 1
-                total += 1
-
-        if total_equal:
-            log.warning('Equalities contributed {}/{} to p-value'.format(total_equal, total))
-        return total_true / total
+    s = s_XAB(X, s_wAB_memo)
+    return partition_pvalue(s_wAB_memo[XY], size, s, n_samples, parametric=parametric, edgeworth=edgeworth,
+                            dp_resolution=dp_resolution, max_exact_partitions=max_exact_partitions,
+                            exact_workers=exact_workers, chunk_size=chunk_size,
+                            alpha=alpha, precision=precision, seed=seed, sampling_workers=sampling_workers)
 
 
 def mean_s_wAB(X, A, B, cossims):
@@ -209,7 +144,10 @@ def convert_keys_to_ints_combine(X, Y):
 
 ''' "classifier case": WEAT where A=AX \cup AY and B=BX \cup BY
 '''
-def run_test(X, Y, AX, AY, BX, BY, n_samples, cat_X, cat_Y, cat_A, cat_B, parametric=False):
+def run_test(X, Y, AX, AY, BX, BY, n_samples, cat_X, cat_Y, cat_A, cat_B, parametric=False,
+             chunk_size=DEFAULT_CHUNK_SIZE, max_exact_partitions=DEFAULT_MAX_EXACT_PARTITIONS,
+             exact_workers=1, dp_resolution=None, alpha=None, precision=None,
+             seed=None, sampling_workers=1, edgeworth=False):
     ''' Run a WEAT.
     args:
         - encs (Dict[str: Dict]): dictionary mapping targ1, targ2, attr1, attr2
@@ -217,6 +155,19 @@ def run_test(X, Y, AX, AY, BX, BY, n_samples, cat_X, cat_Y, cat_A, cat_B, parame
         - n_samples (int): number of samples to draw to estimate p-value
             (use exact test if number of permutations is less than or
             equal to n_samples)
+        - max_exact_partitions (int): enumerate all partitions for the p-value if there
+            are at most this many, otherwise sample n_samples of them
+        - exact_workers (int): number of processes for the exact test
+        - dp_resolution (float): if set, compute the exact p-value by dynamic programming
+            over s(w, A, B) rounded to this resolution
+        - alpha (float): if set, stop sampling once the interval on the p-value
+            is entirely above or below alpha
+        - precision (float): if set, stop sampling once the interval on the p-value
+            has at most this half-width
+        - seed (int): master seed for the permutation samples; None draws a fresh one
+        - sampling_workers (int): number of processes to draw permutation samples on
+        - edgeworth (bool): with parametric, correct the normal tail for the skewness
+            and kurtosis of the null distribution
     '''
 
     
@@ -238,7 +189,14 @@ def run_test(X, Y, AX, AY, BX, BY, n_samples, cat_X, cat_Y, cat_A, cat_B, parame
 
     log.info(f"Null hypothesis: no difference between {cat_X} and {cat_Y} in association to attributes {cat_A} and {cat_B}")
     log.info("Computing pval...")
-    pval = p_val_permutation_test(X, Y, A, B, n_samples, cossims=cossims, parametric=parametric)
+    pval = p_val_permutation_test(X, Y, A, B, n_samples, cossims=cossims, parametric=parametric,
+                                  chunk_size=chunk_size,
+                                  max_exact_partitions=max_exact_partitions,
+                                  exact_workers=exact_workers,
+                                  dp_resolution=dp_resolution,
+                                  alpha=alpha, precision=precision,
+                                  seed=seed, sampling_workers=sampling_workers,
+                                  edgeworth=edgeworth)
     log.info("pval: %g", pval)
 
     log.info("computing effect size...")
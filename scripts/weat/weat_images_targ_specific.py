@@ -3,35 +3,44 @@
 '''
 
 import logging as log
-import math
-import itertools as it
-import numpy as np
-import scipy.special
-import scipy.stats
-import torch
-from torch.nn.functional import cosine_similarity as torch_cossim
+from .backend import DEFAULT_BACKEND, concatenate, cossim_matrix, std, zeros
+from .centroid import centroid_cossims
+from .permutation import DEFAULT_CHUNK_SIZE, DEFAULT_MAX_EXACT_PARTITIONS, partition_pvalue
 
 # X and Y are two sets of target words of equal size.
 # A and B are two sets of attribute words.
 # A = (A_{X}, A_{Y}) where A_{X}'s images correspond to category of X
 # and A_{Y}'s images correspond to category of Y
 
-def construct_cossim_lookup(XY, AB):
+def construct_cossim_lookup(XY, AB, backend=DEFAULT_BACKEND, tile_size=None):
     """
     XY: mapping from target string to target vector (either in X or Y)
     AB: mapping from attribute string to attribute vectore (either in A or B)
     Returns an array of size (len(XY), len(AB)) containing cosine similarities
-    between items in XY and items in AB.
+    between items in XY and items in AB, on the given backend.
     """
 
     num_attr = len(AB)
-    encoding_dim = len(next(iter(XY.values())))
-    dims = torch.Size( (num_attr, encoding_dim) ) # for expanding xy for efficient computation
-    cossims = torch.zeros((max(XY)+1, num_attr))
+    rows = list(XY)
+    cossims_XY = cossim_matrix([XY[xy] for xy in rows],
+                               [AB[i] for i in range(num_attr)],
+                               backend=backend, tile_size=tile_size)
+    # Y keys start at len(X), so rows are indexed by key
+    cossims = zeros((max(XY)+1, num_attr), like=cossims_XY)
+    cossims[rows] = cossims_XY
+    return cossims
+
 
-    AB = torch.stack([AB[i] for i in range(num_attr)])
-    for xy in XY:
-        cossims[xy, :] = torch_cossim(XY[xy].expand(dims), AB)
+def construct_centroid_lookup(XY, A, B, backend=DEFAULT_BACKEND, tile_size=None):
+    """
+    Centroid mode counterpart of construct_cossim_lookup: an array of size
+    (max(XY)+1, 2) whose columns are similarities to the centroids of A and B.
+    """
+    rows = list(XY)
+    cossims_XY = centroid_cossims([XY[xy] for xy in rows], A.values(), B.values(),
+                                  backend=backend, tile_size=tile_size)
+    cossims = zeros((max(XY)+1, 2), like=cossims_XY)
+    cossims[rows] = cossims_XY
     return cossims
 
 
@@ -40,7 +49,7 @@ def s_wAB(A, B, cossims):
     Return vector of s(w, A, B) across w, where
         s(w, A, B) = mean_{a in A} cos(w, a) - mean_{b in B} cos(w, b).
     """
-    return cossims[:, A].mean(dim=1) - cossims[:, B].mean(dim=1)
+    return cossims[:, A].mean(1) - cossims[:, B].mean(1)
 
 
 def s_XAB(X, s_wAB_memo):
@@ -82,18 +91,12 @@ def s_XYAB(X, Y, s_wAB_memo):
     return s_XAB(X, s_wAB_memo) - s_XAB(Y, s_wAB_memo)
 
 
-def p_val_permutation_test(X, Y, A_X, B_X, A_Y, B_Y, n_samples,
-                           cossims_X, cossims_Y, parametric=False):
-    ''' Compute the p-val for the permutation test, which is defined as
-        the probability that a random even partition X_i, Y_i of X u Y
-        satisfies P[s(X_i, Y_i, A, B) > s(X, Y, A, B)]
+def partition_values(X, Y, A_X, B_X, A_Y, B_Y, cossims_X, cossims_Y):
+    ''' The permutation test only needs s(w, A, B) for w in X u Y (X first, each
+        scored against its own attributes), the size of X and the observed
+        statistic s = sum_{x in X} s(x, A_X, B_X).
+    Returns (values, size, s).
     '''
-    #X = np.array(list(X), dtype=np.int)
-    #Y = np.array(list(Y), dtype=np.int)
-    #A_X = np.array(list(A_X), dtype=np.int)
-    #B_X = np.array(list(B_X), dtype=np.int)
-    #A_Y = np.array(list(A_Y), dtype=np.int)
-    #B_Y = np.array(list(B_Y), dtype=np.int)
     X, Y = list(X), list(Y)
     A_X, A_Y = list(A_X), list(A_Y)
     B_X, B_Y = list(B_X), list(B_Y)
@@ -104,105 +107,45 @@ def p_val_permutation_test(X, Y, A_X, B_X, A_Y, B_Y, n_samples,
     s_wAB_X_memo = s_wAB(A_X, B_X, cossims=cossims_X) # avg cos_sim for each x across A_X and B_X
     s_wAB_Y_memo = s_wAB(A_Y, B_Y, cossims=cossims_Y) # avg cos_sim for each y across A_Y and B_Y
 
-    #XY = np.concatenate((X, Y))
-    XY = X + Y
-    if parametric:
-        raise Exception('not implemented')
-        # log.info('Using parametric test')
-        # s = s_XYAB(X, Y, s_wAB_memo)
-
-        # log.info('Drawing {} samples'.format(n_samples))
-        # samples = []
-        # for _ in range(n_samples):
-        #     np.random.shuffle(XY)
-        #     Xi = XY[:size]
-        #     Yi = XY[size:]
-        #     assert len(Xi) == len(Yi)
-        #     si = s_XYAB(Xi, Yi, s_wAB_memo)
-        #     samples.append(si)
-
-        # # Compute sample standard deviation and compute p-value by
-        # # assuming normality of null distribution
-        # log.info('Inferring p-value based on normal distribution')
-        # (shapiro_test_stat, shapiro_p_val) = scipy.stats.shapiro(samples)
-        # log.info('Shapiro-Wilk normality test statistic: {:.2g}, p-value: {:.2g}'.format(
-        #     shapiro_test_stat, shapiro_p_val))
-        # sample_mean = np.mean(samples)
-        # sample_std = np.std(samples, ddof=1)
-        # log.info('Sample mean: {:.2g}, sample standard deviation: {:.2g}'.format(
-        #     sample_mean, sample_std))
-        # p_val = scipy.stats.norm.sf(s, loc=sample_mean, scale=sample_std)
-        # return p_val
+    # for each partition, w in X is scored against A_X, B_X and w in Y against A_Y, B_Y
+    s_wAB_XY_memo = concatenate((s_wAB_X_memo[X], s_wAB_Y_memo[Y]))
 
-    else:
-        log.info('Using non-parametric test')
-        s = s_XAB(X, s_wAB_X_memo) # really just s_wAB_X_memo.sum() bc X is only target
-        total_true = 0
-        total_equal = 0
-        total = 0
-
-        run_sampling = len(X) > 20 # large to compute num partitions, so sample
-        if run_sampling:
-            # We only have as much precision as the number of samples drawn;
-            # bias the p-value (hallucinate a positive observation) to
-            # reflect that.
-            total_true += 1
-            total += 1
-            log.info('Drawing {} samples (and biasing by 1)'.format(n_samples - total))
-            for _ in range(n_samples - 1):
-                np.random.shuffle(XY)
-                Xi = set(XY[:size])
-                
-                # for random samples, sort by w \in X and w \in Y
-                #Xi_X = np.array(list(Xi.intersection(X)), dtype=np.int)
-                #Xi_Y = np.array(list(Xi.intersection(Y)), dtype=np.int)
-                Xi_X = list(Xi.intersection(X))
-                Xi_Y = list(Xi.intersection(Y))
-
-                assert 2 * len(Xi) == len(XY)
-                si = s_XAB(Xi_X, s_wAB_X_memo) + s_XAB(Xi_Y, s_wAB_Y_memo)
-                     
-                if si > s:
-                    total_true += 1
-                elif si == s:  # use conservative test
-                    total_true += 1
-                    total_equal += 1
-                total += 1
-        else:
-            num_partitions = int(scipy.special.binom(2 * len(X), len(X)))
-            
-            log.info('Using exact test ({} partitions)'.format(num_partitions))
-            for Xi in it.combinations(XY, len(X)):
-                #Xi_X = np.array(list(Xi.intersection(X)), dtype=np.int)
-                #Xi_Y = np.array(list(Xi.intersection(Y)), dtype=np.int)
-
-                Xi_X = list(Xi.intersection(X))
-                Xi_Y = list(Xi.intersection(Y))
-                
-                assert 2 * len(Xi) == len(XY)
-                si = s_XAB(Xi_X, s_wAB_X_memo) + s_XAB(Xi_Y, s_wAB_Y_memo)
-                if si > s:
-                    total_true += 1
-                elif si == s:  # use conservative test
-                    total_true += 1
-                    total_equal += 1
-                total += 1
-
-        if total_equal:
-            log.warning('Equalities contributed {}/{} to p-value'.format(total_equal, total))
-
-        return total_true / total
+    return s_wAB_XY_memo, size, s_XAB(X, s_wAB_X_memo)
+
+
+def p_val_permutation_test(X, Y, A_X, B_X, A_Y, B_Y, n_samples,
+                           cossims_X, cossims_Y, parametric=False,
+                           chunk_size=DEFAULT_CHUNK_SIZE, max_exact_partitions=DEFAULT_MAX_EXACT_PARTITIONS,
+                           exact_workers=1, dp_resolution=None,
+                           alpha=None, precision=None,
+                           seed=None, sampling_workers=1, edgeworth=False):
+    ''' Compute the p-val for the permutation test, which is defined as
+        the probability that a random even partition X_i, Y_i of X u Y
+        satisfies P[s(X_i, Y_i, A, B) > s(X, Y, A, B)]
+    '''
+    #X = np.array(list(X), dtype=np.int64)
+    #Y = np.array(list(Y), dtype=np.int64)
+    #A_X = np.array(list(A_X), dtype=np.int64)
+    #B_X = np.array(list(B_X), dtype=np.int64)
+    #A_Y = np.array(list(A_Y), dtype=np.int64)
+    #B_Y = np.array(list(B_Y), dtype=np.int64)
+    values, size, s = partition_values(X, Y, A_X, B_X, A_Y, B_Y, cossims_X, cossims_Y)
+
+    return partition_pvalue(values, size, s, n_samples, parametric=parametric, edgeworth=edgeworth,
+                            dp_resolution=dp_resolution, max_exact_partitions=max_exact_partitions,
+                            exact_workers=exact_workers, chunk_size=chunk_size,
+                            alpha=alpha, precision=precision, seed=seed, sampling_workers=sampling_workers)
 
 
 def mean_s_wAB(X, A, B, cossims):
-    return torch.mean(s_wAB(A, B, cossims[X]))
+    return s_wAB(A, B, cossims[X]).mean()
 
 # each attribute varies by target
 def stdev_s_wAB(X, Y, A_X, B_X, A_Y, B_Y, cossims_X, cossims_Y):
     valX = s_wAB(A_X, B_X, cossims_X[X])
     valY = s_wAB(A_Y, B_Y, cossims_Y[Y])
-    vals = torch.cat((valX, valY))
-    return torch.std(vals)
+    vals = concatenate((valX, valY))
+    return std(vals)
     #vals = np.concatenate((valX, valY))
     #return np.std(vals, ddof=1)
 
@@ -231,16 +174,11 @@ def convert_keys_to_ints(X, Y):
         dict((i + len(X), v) for (i, (k, v)) in enumerate(Y.items())),
     )
 
-def run_test(X, Y, A_X, A_Y, B_X, B_Y, n_samples, cat_X, cat_Y, cat_A, cat_B, parametric=False):
-    ''' Run a WEAT with gender-specific images.
-    args:
-        - encs (Dict[str: Dict]): dictionary mapping targ1, targ2, attr1, attr2
-            to dictionaries containing the category and the encodings
-        - n_samples (int): number of samples to draw to estimate p-value
-            (use exact test if number of permutations is less than or
-            equal to n_samples)
+def construct_lookups(X, Y, A_X, A_Y, B_X, B_Y, backend=DEFAULT_BACKEND, tile_size=None, centroid=False):
+    ''' Index the targets and attributes and build the cossim lookups of X and Y.
+    Returns (X, Y, A_X, B_X, A_Y, B_Y, cossims_X, cossims_Y) with the sets mapping
+    indices into the lookups.
     '''
-
     # First convert all keys to ints to facilitate array lookups
     (X, Y) = convert_keys_to_ints(X,Y)
     (A_X, B_X) = convert_keys_to_ints(A_X, B_X)
@@ -252,9 +190,53 @@ def run_test(X, Y, A_X, A_Y, B_X, B_Y, n_samples, cat_X, cat_Y, cat_A, cat_B, pa
     AB_Y = A_Y.copy()
     AB_Y.update(B_Y)
     
-    log.info("Computing cosine similarities...")
-    cossims_X = construct_cossim_lookup(X, AB_X).cuda()
-    cossims_Y = construct_cossim_lookup(Y, AB_Y).cuda()
+    if centroid:
+        log.info("Computing similarities to attribute centroids...")
+        cossims_X = construct_centroid_lookup(X, A_X, B_X, backend=backend, tile_size=tile_size)
+        cossims_Y = construct_centroid_lookup(Y, A_Y, B_Y, backend=backend, tile_size=tile_size)
+        A_X, B_X = {0 : None}, {1 : None} # columns of cossims_X
+        A_Y, B_Y = {0 : None}, {1 : None} # columns of cossims_Y
+    else:
+        log.info("Computing cosine similarities...")
+        cossims_X = construct_cossim_lookup(X, AB_X, backend=backend, tile_size=tile_size)
+        cossims_Y = construct_cossim_lookup(Y, AB_Y, backend=backend, tile_size=tile_size)
+
+    return X, Y, A_X, B_X, A_Y, B_Y, cossims_X, cossims_Y
+
+
+def run_test(X, Y, A_X, A_Y, B_X, B_Y, n_samples, cat_X, cat_Y, cat_A, cat_B, parametric=False,
+             chunk_size=DEFAULT_CHUNK_SIZE, backend=DEFAULT_BACKEND, tile_size=None, centroid=False,
+             max_exact_partitions=DEFAULT_MAX_EXACT_PARTITIONS, exact_workers=1,
+             dp_resolution=None, alpha=None, precision=None,
+             seed=None, sampling_workers=1, edgeworth=False):
+    ''' Run a WEAT with gender-specific images.
+    args:
+        - encs (Dict[str: Dict]): dictionary mapping targ1, targ2, attr1, attr2
+            to dictionaries containing the category and the encodings
+        - n_samples (int): number of samples to draw to estimate p-value
+            (use exact test if number of permutations is less than or
+            equal to n_samples)
+        - backend (str): one of backend.BACKENDS to compute the statistics on
+        - tile_size (int): if set, number of attribute vectors per cosine similarity tile
+        - centroid (bool): score targets against the centroids of A_X, B_X, A_Y and B_Y
+            instead of building the full cosine similarity matrices
+        - max_exact_partitions (int): enumerate all partitions for the p-value if there
+            are at most this many, otherwise sample n_samples of them
+        - exact_workers (int): number of processes for the exact test
+        - dp_resolution (float): if set, compute the exact p-value by dynamic programming
+            over s(w, A, B) rounded to this resolution
+        - alpha (float): if set, stop sampling once the interval on the p-value
+            is entirely above or below alpha
+        - precision (float): if set, stop sampling once the interval on the p-value
+            has at most this half-width
+        - seed (int): master seed for the permutation samples; None draws a fresh one
+        - sampling_workers (int): number of processes to draw permutation samples on
+        - edgeworth (bool): with parametric, correct the normal tail for the skewness
+            and kurtosis of the null distribution
+    '''
+
+    (X, Y, A_X, B_X, A_Y, B_Y, cossims_X, cossims_Y) = construct_lookups(
+        X, Y, A_X, A_Y, B_X, B_Y, backend=backend, tile_size=tile_size, centroid=centroid)
 
     log.info("Null hypothesis: no difference between %s and %s in association to attributes %s and %s", cat_X, cat_Y, cat_A, cat_B)
     log.info("Computing pval...")
@@ -264,10 +246,31 @@ def run_test(X, Y, A_X, A_Y, B_X, B_Y, n_samples, cat_X, cat_Y, cat_A, cat_B, pa
                                   n_samples,
                                   cossims_X=cossims_X,
                                   cossims_Y=cossims_Y,
-                                  parametric=parametric)
+                                  parametric=parametric,
+                                  chunk_size=chunk_size,
+                                  max_exact_partitions=max_exact_partitions,
+                                  exact_workers=exact_workers,
+                                  dp_resolution=dp_resolution,
+                                  alpha=alpha, precision=precision,
+                                  seed=seed, sampling_workers=sampling_workers,
+                                  edgeworth=edgeworth)
     log.info("pval: %g", pval)
 
     log.info("computing effect size...")
     esize = effect_size(X, Y, A_X, B_X, A_Y, B_Y, cossims_X, cossims_Y)
     log.info("esize: %g", esize)
     return esize, pval
+
+
+def run_test_shared(X, Y, A_X, A_Y, B_X, B_Y, cat_X, cat_Y, cat_A, cat_B,
+                    backend=DEFAULT_BACKEND, tile_size=None, centroid=False):
+    ''' Like run_test, but leaves the p-value to permutation.partition_pvalues so
+        that several tests can share one set of permutation draws.
+    Returns esize and the (values, size, s) of the permutation test.
+    '''
+    (X, Y, A_X, B_X, A_Y, B_Y, cossims_X, cossims_Y) = construct_lookups(
+        X, Y, A_X, A_Y, B_X, B_Y, backend=backend, tile_size=tile_size, centroid=centroid)
+    log.info("Null hypothesis: no difference between %s and %s in association to attributes %s and %s", cat_X, cat_Y, cat_A, cat_B)
+    esize = effect_size(X, Y, A_X, B_X, A_Y, B_Y, cossims_X, cossims_Y)
+    log.info("esize: %g", esize)
+    return esize, partition_values(X, Y, A_X, B_X, A_Y, B_Y, cossims_X, cossims_Y)
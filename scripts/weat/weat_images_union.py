@@ -5,33 +5,25 @@
 '''
 
 import logging as log
-import math
-import itertools as it
-import numpy as np
-import scipy.special
-import scipy.stats
-import torch
-from torch.nn.functional import cosine_similarity as f_cossim
+from .backend import DEFAULT_BACKEND, cossim_matrix, std
+from .centroid import centroid_cossims
+from .permutation import DEFAULT_CHUNK_SIZE, DEFAULT_MAX_EXACT_PARTITIONS, partition_pvalue
 
 # X and Y are two sets of target words of equal size.
 # A and B are two sets of attribute words.
 # A = AX \cup AY and B = BX \cup BY
 
-def construct_cossim_lookup(XY, AB):
+def construct_cossim_lookup(XY, AB, backend=DEFAULT_BACKEND, tile_size=None):
     """
     XY: mapping from target string to target vector (either in X or Y)
     AB: mapping from attribute string to attribute vectore (either in A or B)
     Returns an array of size (len(XY), len(AB)) containing cosine similarities
-    between items in XY and items in AB.
+    between items in XY and items in AB, on the given backend.
     """
-
-    AB = torch.stack([AB[i] for i in range(len(AB))])
-    cossims = torch.zeros((len(XY), len(AB)))
-    dims = torch.Size( (len(AB), len(XY[0])) )
-
-    for xy in XY:
-        cossims[xy, :] = f_cossim(XY[xy].expand(dims), AB)
-    return cossims
+    # keys of XY are 0..len(XY)-1 in order, so rows line up with the keys
+    return cossim_matrix([XY[xy] for xy in range(len(XY))],
+                         [AB[i] for i in range(len(AB))],
+                         backend=backend, tile_size=tile_size)
 
 
 def s_wAB(A, B, cossims):
@@ -39,7 +31,7 @@ def s_wAB(A, B, cossims):
     Return vector of s(w, A, B) across w, where
         s(w, A, B) = mean_{a in A} cos(w, a) - mean_{b in B} cos(w, b).
     """
-    return cossims[:, A].mean(dim=1) - cossims[:, B].mean(dim=1)
+    return cossims[:, A].mean(1) - cossims[:, B].mean(1)
 
 
 def s_XAB(X, s_wAB_memo):
@@ -81,15 +73,11 @@ def s_XYAB(X, Y, s_wAB_memo):
     return s_XAB(X, s_wAB_memo) - s_XAB(Y, s_wAB_memo)
 
 
-def p_val_permutation_test(X, Y, A, B, n_samples, cossims, parametric=False):
-    ''' Compute the p-val for the permutation test, which is defined as
-        the probability that a random even partition X_i, Y_i of X u Y
-        satisfies P[s(X_i, Y_i, A, B) > s(X, Y, A, B)]
+def partition_values(X, Y, A, B, cossims):
+    ''' The permutation test only needs s(w, A, B) for w in X u Y (X first), the size
+        of X and the observed statistic s = sum_{x in X} s(x, A, B).
+    Returns (values, size, s).
     '''
-    #X = torch.tensor(list(X), dtype=torch.int)
-    #Y = torch.tensor(list(Y), dtype=torch.int)
-    #A = torch.tensor(list(A), dtype=torch.int)
-    #B = torch.tensor(list(B), dtype=torch.int)
     X,Y = list(X), list(Y)
     A,B = list(A), list(B)
 
@@ -99,91 +87,37 @@ def p_val_permutation_test(X, Y, A, B, n_samples, cossims, parametric=False):
     elif len(X) > len(Y):
         X = X[:len(Y)]
     assert len(X) == len(Y), f'len X {len(X)}, len Y {len(Y)}'
-    size = len(X)
     s_wAB_memo = s_wAB(A, B, cossims=cossims)
-    XY = X + Y
-
-    if parametric:
-        log.info('Using parametric test')
-        s = s_XYAB(X, Y, s_wAB_memo)
-
-        log.info('Drawing {} samples'.format(n_samples))
-        samples = []
-        for _ in range(n_samples):
-            np.random.shuffle(XY)
-            Xi = XY[:size]
-            Yi = XY[size:]
-            assert len(Xi) == len(Yi)
-            si = s_XYAB(Xi, Yi, s_wAB_memo)
-            samples.append(si)
-
-        # Compute sample standard deviation and compute p-value by
-        # assuming normality of null distribution
-        log.info('Inferring p-value based on normal distribution')
-        (shapiro_test_stat, shapiro_p_val) = scipy.stats.shapiro(samples)
-        log.info('Shapiro-Wilk normality test statistic: {:.2g}, p-value: {:.2g}'.format(
-            shapiro_test_stat, shapiro_p_val))
-        sample_mean = torch.mean(samples)
-        sample_std = torch.std(samples)
-        log.info('Sample mean: {:.2g}, sample standard deviation: {:.2g}'.format(
-            sample_mean, sample_std))
-        p_val = scipy.stats.norm.sf(s, loc=sample_mean, scale=sample_std)
-        return p_val
+    return s_wAB_memo[X + Y], len(X), s_XAB(X, s_wAB_memo)
 
-    else:
-        log.info('Using non-parametric test')
-        s = s_XAB(X, s_wAB_memo)
-        total_true = 0
-        total_equal = 0
-        total = 0
-
-        run_sampling = len(X) > 20 # large to compute num partitions, so sample
-        if run_sampling:
-            # We only have as much precision as the number of samples drawn;
-            # bias the p-value (hallucinate a positive observation) to
-            # reflect that.
-            total_true += 1
-            total += 1
-            log.info('Drawing {} samples (and biasing by 1)'.format(n_samples - total))
-            for _ in range(n_samples - 1):
-                np.random.shuffle(XY)
-                Xi = XY[:size]
-                assert 2 * len(Xi) == len(XY)
-                si = s_XAB(Xi, s_wAB_memo)
-                if si > s:
-                    total_true += 1
-                elif si == s:  # use conservative test
-                    total_true += 1
-                    total_equal += 1
-                total += 1
-
-        else:
-            num_partitions = int(scipy.special.binom(2 * len(X), len(X)))
-            log.info(f'Using exact test ({num_partitions} partitions)')
-            for Xi in it.combinations(XY, len(X)):
-                #Xi = torch.tensor(Xi, dtype=torch.int)
-                assert 2 * len(Xi) == len(XY)
-                si = s_XAB(Xi, s_wAB_memo)
-                if si > s:
-                    total_true += 1
-                elif si == s:  # use conservative test
-                    total_true += 1
-                    total_equal += 1
-                total += 1
-
-        if total_equal:
-            log.warning('Equalities contributed {}/{} to p-value'.format(total_equal, total))
-        if not isinstance(total_true / total, float):
-            raise Exception(f'nan {total_true}, {total}')
-        return total_true / total
+
+def p_val_permutation_test(X, Y, A, B, n_samples, cossims, parametric=False,
+                           chunk_size=DEFAULT_CHUNK_SIZE, max_exact_partitions=DEFAULT_MAX_EXACT_PARTITIONS,
+                           exact_workers=1, dp_resolution=None,
+                           alpha=None, precision=None,
+                           seed=None, sampling_workers=1, edgeworth=False):
+    ''' Compute the p-val for the permutation test, which is defined as
+        the probability that a random even partition X_i, Y_i of X u Y
+        satisfies P[s(X_i, Y_i, A, B) > s(X, Y, A, B)]
+    '''
+    #X = torch.tensor(list(X), dtype=torch.int)
+    #Y = torch.tensor(list(Y), dtype=torch.int)
+    #A = torch.tensor(list(A), dtype=torch.int)
+    #B = torch.tensor(list(B), dtype=torch.int)
+    values, size, s = partition_values(X, Y, A, B, cossims)
+
+    return partition_pvalue(values, size, s, n_samples, parametric=parametric, edgeworth=edgeworth,
+                            dp_resolution=dp_resolution, max_exact_partitions=max_exact_partitions,
+                            exact_workers=exact_workers, chunk_size=chunk_size,
+                            alpha=alpha, precision=precision, seed=seed, sampling_workers=sampling_workers)
 
 
 def mean_s_wAB(X, A, B, cossims):
-    return torch.mean(s_wAB(A, B, cossims[X]))
+    return s_wAB(A, B, cossims[X]).mean()
 
 
 def stdev_s_wAB(X, A, B, cossims):
-    return torch.std(s_wAB(A, B, cossims[X]))
+    return std(s_wAB(A, B, cossims[X]))
 
 def effect_size(X, Y, A, B, cossims):
     """
@@ -213,18 +147,10 @@ def convert_keys_to_ints_combine(X, Y):
                                                  list(Y.items())))
     )
 
-''' "classifier case": WEAT where A=AX \cup AY and B=BX \cup BY
-'''
-def run_test(X, Y, AX, AY, BX, BY, n_samples, cat_X, cat_Y, cat_A, cat_B, parametric=False):
-    ''' Run a WEAT.
-    args:
-        - encs (Dict[str: Dict]): dictionary mapping targ1, targ2, attr1, attr2
-            to dictionaries containing the category and the encodings
-        - n_samples (int): number of samples to draw to estimate p-value
-            (use exact test if number of permutations is less than or
-            equal to n_samples)
+def construct_lookups(X, Y, AX, AY, BX, BY, backend=DEFAULT_BACKEND, tile_size=None, centroid=False):
+    ''' Index the targets and attributes and build their cossim lookup.
+    Returns (X, Y, A, B, cossims) with X, Y, A, B mapping indices into cossims.
     '''
-    
     # take union over attribute images; images differ by target XY
     A = convert_keys_to_ints_combine(AX, AY)
     B = convert_keys_to_ints_combine(BX, BY)
@@ -238,12 +164,64 @@ def run_test(X, Y, AX, AY, BX, BY, n_samples, cat_X, cat_Y, cat_A, cat_B, parame
     AB = A.copy()
     AB.update(B)
 
-    log.info("Computing cosine similarities...")
-    cossims = construct_cossim_lookup(XY, AB).cuda()
+    if centroid:
+        log.info("Computing similarities to attribute centroids...")
+        cossims = centroid_cossims([XY[xy] for xy in range(len(XY))],
+                                   A.values(), B.values(),
+                                   backend=backend, tile_size=tile_size)
+        A, B = {0 : None}, {1 : None} # columns of cossims
+    else:
+        log.info("Computing cosine similarities...")
+        cossims = construct_cossim_lookup(XY, AB, backend=backend, tile_size=tile_size)
+
+    return X, Y, A, B, cossims
+
+
+''' "classifier case": WEAT where A=AX \cup AY and B=BX \cup BY
+'''
+def run_test(X, Y, AX, AY, BX, BY, n_samples, cat_X, cat_Y, cat_A, cat_B, parametric=False,
+             chunk_size=DEFAULT_CHUNK_SIZE, backend=DEFAULT_BACKEND, tile_size=None, centroid=False,
+             max_exact_partitions=DEFAULT_MAX_EXACT_PARTITIONS, exact_workers=1,
+             dp_resolution=None, alpha=None, precision=None,
+             seed=None, sampling_workers=1, edgeworth=False):
+    ''' Run a WEAT.
+    args:
+        - encs (Dict[str: Dict]): dictionary mapping targ1, targ2, attr1, attr2
+            to dictionaries containing the category and the encodings
+        - n_samples (int): number of samples to draw to estimate p-value
+            (use exact test if number of permutations is less than or
+            equal to n_samples)
+        - backend (str): one of backend.BACKENDS to compute the statistics on
+        - tile_size (int): if set, number of attribute vectors per cosine similarity tile
+        - centroid (bool): score targets against the centroids of A and B instead of
+            building the full cosine similarity matrix
+        - max_exact_partitions (int): enumerate all partitions for the p-value if there
+            are at most this many, otherwise sample n_samples of them
+        - exact_workers (int): number of processes for the exact test
+        - dp_resolution (float): if set, compute the exact p-value by dynamic programming
+            over s(w, A, B) rounded to this resolution
+        - alpha (float): if set, stop sampling once the interval on the p-value
+            is entirely above or below alpha
+        - precision (float): if set, stop sampling once the interval on the p-value
+            has at most this half-width
+        - seed (int): master seed for the permutation samples; None draws a fresh one
+        - sampling_workers (int): number of processes to draw permutation samples on
+        - edgeworth (bool): with parametric, correct the normal tail for the skewness
+            and kurtosis of the null distribution
+    '''
+    (X, Y, A, B, cossims) = construct_lookups(X, Y, AX, AY, BX, BY,
+                                              backend=backend, tile_size=tile_size, centroid=centroid)
 
     log.info(f"Null hypothesis: no difference between {cat_X} and {cat_Y} in association to attributes {cat_A} and {cat_B}")
     log.info("Computing pval...")
-    pval = p_val_permutation_test(X, Y, A, B, n_samples, cossims=cossims, parametric=parametric)
+    pval = p_val_permutation_test(X, Y, A, B, n_samples, cossims=cossims, parametric=parametric,
+                                  chunk_size=chunk_size,
+                                  max_exact_partitions=max_exact_partitions,
+                                  exact_workers=exact_workers,
+                                  dp_resolution=dp_resolution,
+                                  alpha=alpha, precision=precision,
+                                  seed=seed, sampling_workers=sampling_workers,
+                                  edgeworth=edgeworth)
     log.info("pval: %g", pval)
 
     log.info("computing effect size...")
@@ -251,3 +229,18 @@ def run_test(X, Y, AX, AY, BX, BY, n_samples, cat_X, cat_Y, cat_A, cat_B, parame
     log.info("esize: %g", esize)
 
     return esize, pval
+
+
+def run_test_shared(X, Y, AX, AY, BX, BY, cat_X, cat_Y, cat_A, cat_B,
+                    backend=DEFAULT_BACKEND, tile_size=None, centroid=False):
+    ''' Like run_test, but leaves the p-value to permutation.partition_pvalues so
+        that several tests can share one set of permutation draws.
+    Returns esize and the (values, size, s) of the permutation test.
+    '''
+    (X, Y, A, B, cossims) = construct_lookups(X, Y, AX, AY, BX, BY,
+                                              backend=backend, tile_size=tile_size, centroid=centroid)
+    log.info(f"Null hypothesis: no difference between {cat_X} and {cat_Y} in association to attributes {cat_A} and {cat_B}")
+    esize = effect_size(X, Y, A, B, cossims=cossims)
+    log.info("esize: %g", esize)
+    return esize, partition_values(X, Y, A, B, cossims)
+
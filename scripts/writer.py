@@ -1,8 +1,8 @@
 import csv
 import re
-import torch
 
 DELIMITER = ','
+PVAL_COLUMNS = ['pval', 'pval_samples', 'pval_ci_low', 'pval_ci_high']
 
 class Writer:
     def __init__(self, save_dir: str):
@@ -23,11 +23,12 @@ class Writer:
         self.writer_gen = csv.writer(self.f_gen, delimiter=DELIMITER)
             
         # write headers
-        self.writer_exp1.writerow(['test_name', 'esize', 'pval'])
-        self.writer_exp2.writerow(['test_name', 'esize', 'pval'])
-        self.writer_exp3.writerow(['test_name', 'esize_x', 'pval_x', 'esize_y', 'pval_y'])
-        self.writer_exp4_mask_t.writerow(['test_name', 'esize', 'pval'])
-        self.writer_exp4_mask_v.writerow(['test_name', 'esize', 'pval'])
+        self.writer_exp1.writerow(['test_name', 'esize'] + PVAL_COLUMNS)
+        self.writer_exp2.writerow(['test_name', 'esize'] + PVAL_COLUMNS)
+        self.writer_exp3.writerow(['test_name', 'esize_x'] + [f'{c}_x' for c in PVAL_COLUMNS] +
+                                  ['esize_y'] + [f'{c}_y' for c in PVAL_COLUMNS])
+        self.writer_exp4_mask_t.writerow(['test_name', 'esize'] + PVAL_COLUMNS)
+        self.writer_exp4_mask_v.writerow(['test_name', 'esize'] + PVAL_COLUMNS)
         self.writer_gen.writerow(['test_name', 'X_AXonAY', 'X_BXonBY',
                                 'Y_AXonAY', 'Y_BXonBY', 'X_AonB', 'Y_AonB',
                                 'X_ABXonABY', 'Y_ABXonABY'])
@@ -37,37 +38,45 @@ class Writer:
         test_name = test_name[:-1] if test_name[-1] == '_' else test_name # strip trailing underscore
         return test_name
 
+    def format_pval(self, pval: float):
+        ''' p-value followed by the number of partitions it was computed from and
+            its interval, when the WEAT returned them
+        '''
+        low, high = getattr(pval, 'ci', None) or ('', '')
+        return [f'{pval}', getattr(pval, 'num_samples', ''), low, high]
+
     def add_results_exp1(self, test_name: str, test_type: str, esize: float, pval: float):
         test_name = self.format_test_name(test_name)
-        if isinstance(esize, torch.Tensor):
+        if hasattr(esize, 'item'):
             esize = esize.item()
-        self.writer_exp1.writerow([f'{test_name}:{test_type.strip("_")}', esize, f'{pval}'])
+        self.writer_exp1.writerow([f'{test_name}:{test_type.strip("_")}', esize] + self.format_pval(pval))
 
     def add_results_exp2(self, test_name: str, test_type: str, esize: float, pval: float):
         test_name = self.format_test_name(test_name)
-        if isinstance(esize, torch.Tensor):
+        if hasattr(esize, 'item'):
             esize = esize.item()
-        self.writer_exp2.writerow([f'{test_name}:{test_type.strip("_")}', esize, f'{pval}'])
+        self.writer_exp2.writerow([f'{test_name}:{test_type.strip("_")}', esize] + self.format_pval(pval))
 
     def add_results_exp3(self, test_name: str, test_type: str, esize_x: float, pval_x: float, esize_y: float, pval_y: float):
         test_name = self.format_test_name(test_name)
-        if isinstance(esize_x, torch.Tensor):
+        if hasattr(esize_x, 'item'):
             esize_x = esize_x.item()
-        if isinstance(esize_y, torch.Tensor):
+        if hasattr(esize_y, 'item'):
             esize_y = esize_y.item()
-        self.writer_exp3.writerow([f'{test_name}:{test_type.strip("_")}', esize_x, f'{pval_x}', esize_y, f'{pval_y}'])
+        self.writer_exp3.writerow([f'{test_name}:{test_type.strip("_")}', esize_x] + self.format_pval(pval_x) +
+                                  [esize_y] + self.format_pval(pval_y))
 
     def add_results_exp4_mask_t(self, test_name: str, test_type: str, esize: float, pval: float):
         test_name = self.format_test_name(test_name)
-        if isinstance(esize, torch.Tensor):
+        if hasattr(esize, 'item'):
             esize = esize.item()
-        self.writer_exp4_mask_t.writerow([f'{test_name}:mask_t_{test_type.strip("_")}', esize, f'{pval}'])
+        self.writer_exp4_mask_t.writerow([f'{test_name}:mask_t_{test_type.strip("_")}', esize] + self.format_pval(pval))
 
     def add_results_exp4_mask_v(self, test_name: str, test_type: str, esize: float, pval: float):
         test_name = self.format_test_name(test_name)
-        if isinstance(esize, torch.Tensor):
+        if hasattr(esize, 'item'):
             esize = esize.item()
-        self.writer_exp4_mask_t.writerow([f'{test_name}:mask_v_{test_type.strip("_")}', esize, f'{pval}'])
+        self.writer_exp4_mask_t.writerow([f'{test_name}:mask_v_{test_type.strip("_")}', esize] + self.format_pval(pval))
 
     def flush(self):
         self.f_exp1.flush()
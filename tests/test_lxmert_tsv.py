@@ -0,0 +1,37 @@
+''' Id-filtered, parallel loading of LXMERT TSV features.
+'''
+
+import base64
+import numpy as np
+import pytest
+
+pytest.importorskip('lmdb') # imported by lxmert.utils
+from scripts.dataloaders.lxmert.utils import LXMERT_KEYS, load_obj_tsv_parallel
+
+
+def write_tsv(fname, num_images, seed=0):
+    ''' A TSV feature file in the COCO format, ending in a blank line.
+    '''
+    rng = np.random.default_rng(seed)
+    b64 = lambda array: base64.b64encode(array.tobytes()).decode()
+    with open(fname, 'w') as f:
+        for i in range(num_images):
+            num_boxes = int(rng.integers(2, 6))
+            row = [f'img{i}', '480', '640',
+                   b64(rng.integers(0, 1600, num_boxes)), b64(rng.random(num_boxes, dtype=np.float32)),
+                   b64(rng.integers(0, 400, num_boxes)), b64(rng.random(num_boxes, dtype=np.float32)),
+                   str(num_boxes), b64(rng.random((num_boxes, 4), dtype=np.float32)),
+                   b64(rng.random((num_boxes, 8), dtype=np.float32))]
+            f.write('\t'.join(row) + '\n')
+        f.write('\n')
+
+
+@pytest.mark.parametrize('img_ids', [None, {'img1', 'img4'}])
+def test_blank_lines_are_skipped(tmp_path, img_ids):
+    fname = str(tmp_path / 'coco_val.tsv')
+    write_tsv(fname, 5)
+    data = load_obj_tsv_parallel([fname], img_ids, num_workers=1)
+    expected = img_ids or {f'img{i}' for i in range(5)}
+    assert sorted(item['img_id'] for item in data) == sorted(expected)
+    for item in data:
+        assert all(item[key].shape[0] == item['num_boxes'] for key in LXMERT_KEYS)
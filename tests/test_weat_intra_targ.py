@@ -0,0 +1,32 @@
+''' Calibration of the attribute permutation test of weat_images_intra_targ.
+'''
+
+import numpy as np
+import scipy.stats
+from scripts.weat.weat_images_intra_targ import p_val_permutation_test
+
+
+def null_pvalues(num_tests, shift, seed=0):
+    ''' P-values of tests on data with an association of A over B (by shift), but
+        none that depends on the images the attributes were encoded with.
+    '''
+    rng = np.random.default_rng(seed)
+    num_targets, len_AX, len_BX, len_AY, len_BY = 24, 5, 6, 7, 4
+    A_X, B_X = range(len_AX), range(len_AX, len_AX + len_BX)
+    A_Y, B_Y = range(len_AY), range(len_AY, len_AY + len_BY)
+    p_vals = []
+    for i in range(num_tests):
+        cossims_attrX = rng.normal(size=(num_targets, len_AX + len_BX))
+        cossims_attrY = rng.normal(size=(num_targets, len_AY + len_BY))
+        cossims_attrX[:, list(A_X)] += shift
+        cossims_attrY[:, list(A_Y)] += shift
+        p_vals.append(p_val_permutation_test(range(num_targets), A_X, B_X, A_Y, B_Y, 500,
+                                             cossims_attrX, cossims_attrY, seed=i))
+    return np.array(p_vals)
+
+
+def test_pvalues_uniform_under_null():
+    for shift in (1., -1.):
+        p_vals = null_pvalues(200, shift)
+        assert scipy.stats.kstest(p_vals, 'uniform').pvalue > 0.01
+        assert 0.05 < np.mean(p_vals < 0.1) < 0.15